@@ -0,0 +1,106 @@
+"""
+Client Gemini giả lập, chạy offline và cho kết quả xác định (deterministic).
+
+Có cùng giao diện với phần `genai.Client` mà ứng dụng sử dụng:
+`client.models.generate_content(model=..., contents=..., config=...)` trả về đối tượng có `.text`
+và `.usage_metadata`; `client.models.generate_content_stream(...)` sinh ra các mảnh văn bản.
+Câu hỏi được trích bằng biểu thức chính quy từ phần văn bản đề trong prompt.
+`rate_limit_every=N` giả lập lỗi 429 (RESOURCE_EXHAUSTED) ở mỗi lần gọi thứ N; `token_latency`
+thêm độ trễ tỉ lệ với độ dài prompt (giây / 1000 token) như thời gian xử lý đầu vào của API thật.
+"""
+import json
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+from google.genai.errors import APIError
+
+QUESTION_RE = re.compile(r'^\s*Câu\s*\d+\s*[:.)\-]?\s*', re.IGNORECASE | re.MULTILINE)
+OPTION_RE = re.compile(r'(?:^|(?<=\s))\*?([A-F])\s*[.)]\s*')
+ANSWER_RE = re.compile(r'Đáp\s*án(?:\s*đúng)?(?:\s*là)?\s*[:.\-]?\s*([A-F])\b', re.IGNORECASE)
+
+
+def extract_questions(text):
+    """Trích câu hỏi từ văn bản đề theo định dạng "Câu N: ... A. ... B. ... Đáp án: X"."""
+    questions = []
+    starts = [m for m in QUESTION_RE.finditer(text)]
+    for k, m in enumerate(starts):
+        body = text[m.end():starts[k + 1].start() if k + 1 < len(starts) else len(text)]
+        answer = ANSWER_RE.search(body)
+        if answer:
+            body = body[:answer.start()]
+        markers = list(OPTION_RE.finditer(body))
+        options = [
+            body[marker.end():markers[i + 1].start() if i + 1 < len(markers) else len(body)].strip()
+            for i, marker in enumerate(markers)
+        ]
+        questions.append({
+            'question': body[:markers[0].start()].strip() if markers else body.strip(),
+            'options': options,
+            'correct_answer': answer.group(1).upper() if answer else 'A',
+        })
+    return questions
+
+
+def _document_text(contents):
+    """Lấy phần văn bản đề nằm giữa hai dấu '---' trong prompt của ứng dụng."""
+    parts = contents.split("\n---\n")
+    return parts[1] if len(parts) >= 3 else contents
+
+
+class FakeModels:
+    def __init__(self, latency=0.0, stream_pieces=8, fail_every=0, rate_limit_every=0, token_latency=0.0):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.stream_pieces = stream_pieces
+        self.fail_every = fail_every
+        self.rate_limit_every = rate_limit_every
+        self.calls = 0
+        self.prompt_tokens = 0
+        self._lock = threading.Lock()
+
+    def _respond(self, contents):
+        with self._lock:
+            self.calls += 1
+            call = self.calls
+            self.prompt_tokens += len(contents) // 3 + 1
+        if self.rate_limit_every and call % self.rate_limit_every == 0:
+            raise APIError(429, {'error': {'code': 429, 'status': 'RESOURCE_EXHAUSTED', 'message': 'Giả lập quá hạn mức'}})
+        if self.fail_every and call % self.fail_every == 0:
+            raise ValueError(f"Lỗi giả lập ở lần gọi thứ {call}")
+        text = json.dumps(extract_questions(_document_text(contents)), ensure_ascii=False)
+        usage = SimpleNamespace(
+            prompt_token_count=len(contents) // 3 + 1,
+            candidates_token_count=len(text) // 3 + 1,
+        )
+        return text, usage
+
+    def _delay(self, usage):
+        return self.latency + self.token_latency * usage.prompt_token_count / 1000
+
+    def generate_content(self, model, contents, config=None):
+        text, usage = self._respond(contents)
+        delay = self._delay(usage)
+        if delay:
+            time.sleep(delay)
+        return SimpleNamespace(text=text, usage_metadata=usage)
+
+    def generate_content_stream(self, model, contents, config=None):
+        text, usage = self._respond(contents)
+        delay = self._delay(usage)
+        size = max(1, len(text) // self.stream_pieces + 1)
+        for start in range(0, len(text), size):
+            if delay:
+                time.sleep(delay / self.stream_pieces)
+            yield SimpleNamespace(text=text[start:start + size], usage_metadata=usage)
+
+    def count_tokens(self, model, contents):
+        return SimpleNamespace(total_tokens=len(contents) // 3 + 1)
+
+
+class FakeGeminiClient:
+    """Thay thế `genai.Client` trong benchmark: độ trễ cấu hình được (giây / lần gọi, giây / 1000 token)."""
+
+    def __init__(self, latency=0.0, stream_pieces=8, fail_every=0, rate_limit_every=0, token_latency=0.0):
+        self.models = FakeModels(latency, stream_pieces, fail_every, rate_limit_every, token_latency)
@@ -0,0 +1,123 @@
+"""
+Sinh file đề thi trắc nghiệm tiếng Việt (.docx) giả lập cho benchmark.
+
+    python benchmarks/make_docx.py 1000 de_1000.docx --tables --images
+
+Các câu xoay vòng giữa nhiều cách trình bày thường gặp: lựa chọn mỗi dòng một phương án,
+lựa chọn trên cùng dòng, "Đáp án: X", "Đáp án đúng là X", đáp án in đậm, và (tùy chọn)
+lựa chọn đặt trong bảng, kèm ảnh nhúng, và header/footer lặp lại ở mỗi "trang" (số trang, tên
+trường, họ tên/lớp) như đề chép từ bản in.
+"""
+import argparse
+import io
+import random
+import struct
+import zlib
+
+from docx import Document
+
+TOPICS = [
+    "Thủ đô của Việt Nam", "Công thức hóa học của nước", "Tác giả Truyện Kiều",
+    "Sông dài nhất Việt Nam", "Đơn vị đo cường độ dòng điện", "Năm Cách mạng tháng Tám",
+    "Hành tinh gần Mặt Trời nhất", "Số nguyên tố nhỏ nhất", "Thủ phủ tỉnh Lâm Đồng",
+    "Tốc độ ánh sáng trong chân không",
+]
+WORDS = [
+    "Hà Nội", "Huế", "Đà Nẵng", "Sài Gòn", "H2O", "CO2", "Nguyễn Du", "Hồ Xuân Hương",
+    "sông Hồng", "sông Đà", "Ampe", "Vôn", "1945", "1954", "Sao Thủy", "Sao Kim", "2", "3",
+    "Đà Lạt", "Bảo Lộc", "300.000 km/s", "150.000 km/s",
+]
+LABELS = "ABCD"
+# Phần thủ tục lặp lại ở đầu mỗi trang khi bật boilerplate
+PAGE_HEADER = [
+    "SỞ GIÁO DỤC VÀ ĐÀO TẠO - TRƯỜNG THPT MẪU",
+    "Họ và tên thí sinh: .................................... Số báo danh: ..........",
+    "Mã đề thi 132",
+]
+
+
+def _png_bytes(size_kb, rng):
+    """Ảnh PNG xám ngẫu nhiên (không nén được) có kích thước xấp xỉ size_kb."""
+    side = max(8, int((size_kb * 1024) ** 0.5))
+    raw = b"".join(b"\x00" + bytes(rng.getrandbits(8) for _ in range(side)) for _ in range(side))
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", side, side, 8, 0, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw, 0)) + chunk(b"IEND", b"")
+
+
+def write_exam_docx(
+    path, num_questions, tables=False, images=False, image_every=50, image_kb=64, seed=0, boilerplate=False,
+    page_every=10,
+):
+    """
+    Ghi file đề `num_questions` câu vào `path` (đường dẫn hoặc file object). Trả về list đáp án đúng.
+    `boilerplate`: chèn header (PAGE_HEADER) và số trang sau mỗi `page_every` câu.
+    """
+    rng = random.Random(seed)
+    document = Document()
+    document.add_paragraph("SỞ GIÁO DỤC VÀ ĐÀO TẠO - TRƯỜNG THPT MẪU")
+    document.add_paragraph("ĐỀ KIỂM TRA TRẮC NGHIỆM - Thời gian làm bài: 45 phút")
+    image = _png_bytes(image_kb, rng) if images else None
+    answers = []
+
+    for i in range(1, num_questions + 1):
+        correct = rng.randrange(4)
+        answers.append(LABELS[correct])
+        options = [f"{rng.choice(WORDS)} ({i}.{k})" for k in range(4)]
+        style = i % 5 if not tables else i % 6
+
+        if boilerplate and i % page_every == 1 and i > 1:
+            document.add_paragraph(f"Trang {i // page_every}/{(num_questions - 1) // page_every + 1}")
+            for line in PAGE_HEADER:
+                document.add_paragraph(line)
+        document.add_paragraph(f"Câu {i}: {rng.choice(TOPICS)} là gì? (câu số {i})")
+        if images and i % image_every == 0:
+            document.add_picture(io.BytesIO(image))
+
+        if style == 5:
+            table = document.add_table(rows=1, cols=4)
+            for k, option in enumerate(options):
+                table.rows[0].cells[k].text = f"{LABELS[k]}. {option}"
+            document.add_paragraph(f"Đáp án: {LABELS[correct]}")
+        elif style == 1:
+            document.add_paragraph("   ".join(f"{LABELS[k]}. {option}" for k, option in enumerate(options)))
+            document.add_paragraph(f"Đáp án đúng là {LABELS[correct]}")
+        elif style == 2:
+            for k, option in enumerate(options):
+                run = document.add_paragraph().add_run(f"{LABELS[k]}. {option}")
+                run.bold = k == correct
+        else:
+            for k, option in enumerate(options):
+                document.add_paragraph(f"{LABELS[k]}. {option}")
+            document.add_paragraph(f"Đáp án: {LABELS[correct]}")
+
+    if boilerplate:
+        document.add_paragraph("------ HẾT ------")
+    document.save(path)
+    return answers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("num_questions", type=int)
+    parser.add_argument("output")
+    parser.add_argument("--tables", action="store_true", help="đặt một phần lựa chọn trong bảng")
+    parser.add_argument("--images", action="store_true", help="nhúng ảnh PNG vào đề")
+    parser.add_argument("--image-every", type=int, default=50)
+    parser.add_argument("--image-kb", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--boilerplate", action="store_true", help="thêm header/số trang lặp lại mỗi trang")
+    parser.add_argument("--page-every", type=int, default=10)
+    args = parser.parse_args()
+    write_exam_docx(
+        args.output, args.num_questions, tables=args.tables, images=args.images,
+        image_every=args.image_every, image_kb=args.image_kb, seed=args.seed, boilerplate=args.boilerplate,
+        page_every=args.page_every
+    )
+
+
+if __name__ == "__main__":
+    main()
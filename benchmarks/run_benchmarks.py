@@ -0,0 +1,344 @@
+"""
+Bộ benchmark offline cho ứng dụng ôn luyện trắc nghiệm.
+
+    python benchmarks/run_benchmarks.py --sizes 10 1000 10000 --output bench.json
+
+Đo: đọc .docx (read_docx / iter_docx_blocks), phân tích cục bộ, parse_quiz_data_with_gemini với
+client giả lập (độ trễ cấu hình bằng --latency và --token-latency), rút gọn prompt (bật/tắt: token
+gửi đi, số câu, thời gian; --boilerplate thêm header/số trang lặp lại vào đề),
+get_correct_answer_text, dựng bài kiểm tra lấy mẫu (build_exam), tìm kiếm toàn văn (lập chỉ mục,
+truy vấn), calculate_score (bộ chấm điểm vector hóa), gộp câu trùng (MinHash/LSH), lịch ôn tập SM-2
+(dựng lịch, trả lời, ghi theo lô, nạp lại), xuất/nạp đề .qbank, nhiều phiên tải cùng một đề đồng
+thời (số lần gọi API thực tế sau khi gộp yêu cầu trùng, có xen lỗi 429 giả lập), hàng đợi phân tích
+nhiều file với 1 worker và với QUIZ_JOB_WORKERS worker, và thời gian chạy lại toàn bộ script bằng
+Streamlit AppTest ở chế độ ôn luyện và kiểm tra. Kết quả ghi ra JSON để so sánh giữa các commit.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_PATH = os.path.join(ROOT, "quiz_app_streamlit.py")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def timed(fn, repeat):
+    """Chạy fn `repeat` lần, trả về thống kê thời gian (giây)."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return {
+        'median_s': statistics.median(samples),
+        'min_s': min(samples),
+        'max_s': max(samples),
+        'runs': repeat,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_apptest(app, bank_data, mode, repeat):
+    """Thời gian chạy lại toàn bộ script (AppTest) khi đang làm bài ở chế độ `mode`, và khi bấm sang câu kế tiếp."""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP_PATH, default_timeout=600)
+    at.secrets["GEMINI_API_KEY"] = "benchmark"
+    at.run()
+    at.session_state.pending_bank = app.QuizBank(bank_data)
+    at.session_state.current_mode = 'menu'
+    at.run()
+    label = "BẮT ĐẦU ÔN LUYỆN" if mode == 'study' else "BẮT ĐẦU KIỂM TRA"
+    next(b for b in at.button if b.label == label).click().run()
+
+    rerun = timed(at.run, repeat)
+
+    def answer_and_next():
+        at.radio[0].set_value(0).run()
+        key = "next_exam" if mode == 'exam' else f"next_study_{at.session_state.current_index}"
+        at.button(key=key).click().run()
+
+    navigation = timed(answer_and_next, min(repeat, len(bank_data) - 1))
+    if at.exception:
+        raise RuntimeError(f"AppTest lỗi ở chế độ {mode}: {at.exception}")
+    return {'rerun': rerun, 'answer_and_next': navigation}
+
+
+def bench_concurrent_uploads(app, raw_text, latency, sessions):
+    """`sessions` phiên cùng phân tích một đề lúc cache còn trống: đo thời gian và số lần gọi API thực tế."""
+    from fake_gemini import FakeGeminiClient
+
+    app.PARSE_CACHE_PATH = os.path.join(tempfile.mkdtemp(), "parse_cache.sqlite3")
+    # Manager riêng, không chờ thật khi thử lại để số đo phản ánh đường gọi API
+    app._GEMINI = app.GeminiClientManager(rpm=0, tpm=0, sleep=lambda seconds: None, seed=0)
+    client = FakeGeminiClient(latency=latency, rate_limit_every=7)
+    barrier = threading.Barrier(sessions)
+    errors = []
+
+    def session():
+        barrier.wait()
+        try:
+            app.parse_quiz_data_with_gemini.__wrapped__(raw_text, None, _client=client)
+        except Exception as e:
+            errors.append(repr(e))
+
+    threads = [threading.Thread(target=session) for _ in range(sessions)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {
+        'sessions': sessions,
+        'wall_s': time.perf_counter() - start,
+        'api_calls': client.models.calls,
+        'chunks': len(app.prepare_gemini_chunks([raw_text])[0]),
+        'errors': errors,
+    }
+
+
+def bench_prompt_compaction(app, raw_text, latency, token_latency):
+    """parse_quiz_data_with_gemini khi bật và tắt rút gọn prompt: số câu, token gửi đi, số lần gọi và thời gian."""
+    from fake_gemini import FakeGeminiClient
+
+    compaction = app.PROMPT_COMPACTION
+    result = {}
+    try:
+        for enabled in (False, True):
+            app.PROMPT_COMPACTION = enabled
+            app.PARSE_CACHE_PATH = os.path.join(tempfile.mkdtemp(), "parse_cache.sqlite3")
+            client = FakeGeminiClient(latency=latency, token_latency=token_latency)
+            tokens = app.TokenUsage()
+            start = time.perf_counter()
+            data = app.parse_quiz_data_with_gemini.__wrapped__(raw_text, None, _client=client, _tokens=tokens)
+            result['on' if enabled else 'off'] = {
+                'wall_s': time.perf_counter() - start,
+                'questions': len(data or []),
+                'api_calls': client.models.calls,
+                'prompt_tokens': client.models.prompt_tokens,
+                'tokens_raw': tokens.raw,
+                'tokens_sent': tokens.sent,
+                'tokens_output': tokens.output,
+            }
+    finally:
+        app.PROMPT_COMPACTION = compaction
+    result['tokens_saved'] = result['off']['prompt_tokens'] - result['on']['prompt_tokens']
+    return result
+
+
+def bench_job_queue(app, path, latency, files):
+    """Phân tích `files` bản sao của một đề qua hàng đợi nền, so sánh 1 worker với PARSE_JOB_WORKERS worker."""
+    from fake_gemini import FakeGeminiClient
+
+    with open(path, "rb") as f:
+        data = f.read()
+    result = {'files': files}
+    for workers in sorted({1, app.PARSE_JOB_WORKERS}):
+        # Cache trống cho mỗi lần đo; client giả lập dùng chung như manager thật
+        app.PARSE_CACHE_PATH = os.path.join(tempfile.mkdtemp(), "parse_cache.sqlite3")
+        queue = app.ParseJobQueue(workers)
+        client = FakeGeminiClient(latency=latency)
+        start = time.perf_counter()
+        jobs = [queue.submit(app.ParseJob(f"{k}.docx", data), None, client) for k in range(files)]
+        for job in jobs:
+            job.future.result()
+        result[f'workers_{workers}_s'] = time.perf_counter() - start
+        result[f'workers_{workers}_failed'] = sum(1 for job in jobs if job.stage != 'done')
+    return result
+
+
+def bench_review_scheduler(app, bank, answers):
+    """Lịch ôn tập SM-2 trên `bank`: dựng lịch, trả lời `answers` câu (ghi theo lô), nạp lại từ SQLite."""
+    import numpy as np
+
+    log = app.AttemptLog(os.path.join(tempfile.mkdtemp(), "review.sqlite3"))
+    gradable = np.asarray(bank.correct) >= 0
+    start = time.perf_counter()
+    keys = app.bank_question_keys.__wrapped__("benchmark", bank)
+    result = {'question_keys_s': time.perf_counter() - start}
+    start = time.perf_counter()
+    scheduler = app.ReviewScheduler("benchmark", keys, gradable, log)
+    result['build_s'] = time.perf_counter() - start
+
+    answered = 0
+    start = time.perf_counter()
+    while answered < answers:
+        i = scheduler.next_item(ahead=True)
+        if i is None:
+            break
+        scheduler.answer(i, answered % 4 != 0)
+        answered += 1
+    result['answer_s'] = (time.perf_counter() - start) / max(1, answered)
+    start = time.perf_counter()
+    log.flush()
+    result['flush_s'] = time.perf_counter() - start
+    start = time.perf_counter()
+    app.ReviewScheduler("benchmark", keys, gradable, log)
+    result['reload_s'] = time.perf_counter() - start
+    result['answered'] = answered
+    return result
+
+
+def bench_search(app, bank, repeat):
+    """Chỉ mục tìm kiếm của `bank`: thời gian lập chỉ mục, bộ nhớ và thời gian một số truy vấn (từ, tiền tố, lọc)."""
+    start = time.perf_counter()
+    index = app.SearchIndex(bank)
+    result = {'build_s': time.perf_counter() - start, 'index_bytes': index.nbytes(), 'words': len(index.words)}
+    queries = {
+        'word': ("thủ đô", 'all', False),
+        'no_diacritics': ("thu do viet nam", 'all', False),
+        'prefix': ("ng*", 'all', False),
+        'question_gradable': ("song*", 'question', True),
+    }
+    for name, (query, scope, gradable_only) in queries.items():
+        terms = app.parse_search_query(query)
+        result[name] = timed(lambda: index.search(terms, scope, gradable_only), repeat)
+        result[name]['matched'] = index.search(terms, scope, gradable_only)[2]
+    return result
+
+
+def run(sizes, repeat, latency, tables, images, skip_apptest, sessions, job_files, boilerplate=False, token_latency=0.0):
+    from fake_gemini import FakeGeminiClient
+    from make_docx import write_exam_docx
+
+    workdir = tempfile.mkdtemp(prefix="quiz_bench_")
+    # Cache phân tích riêng cho benchmark, không đụng tới cache thật
+    os.environ["QUIZ_PARSE_CACHE_PATH"] = os.path.join(workdir, "parse_cache.sqlite3")
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    import quiz_app_streamlit as app
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith("streamlit"):
+            logging.getLogger(name).setLevel(logging.ERROR)
+
+    results = {}
+    for size in sizes:
+        path = os.path.join(workdir, f"exam_{size}.docx")
+        start = time.perf_counter()
+        write_exam_docx(path, size, tables=tables, images=images, boilerplate=boilerplate)
+        entry = {
+            'questions': size,
+            'docx_bytes': os.path.getsize(path),
+            'generate_docx_s': time.perf_counter() - start,
+        }
+
+        def read():
+            # __wrapped__: gọi thẳng hàm gốc, bỏ qua st.cache_data
+            with open(path, "rb") as f:
+                return app.read_docx.__wrapped__(f)
+
+        raw_text = read()
+        entry['read_docx'] = timed(read, repeat)
+
+        def local_parse():
+            with open(path, "rb") as f:
+                return app.parse_quiz_locally(app.iter_docx_blocks(f))
+
+        entries = local_parse()
+        entry['local_resolved'] = sum(1 for kind, _ in entries if kind == 'local')
+        entry['parse_quiz_locally'] = timed(local_parse, repeat)
+
+        def gemini_parse():
+            # Mỗi lần đo dùng cache trống để đo đúng đường gọi API (giả lập)
+            app.PARSE_CACHE_PATH = os.path.join(tempfile.mkdtemp(dir=workdir), "parse_cache.sqlite3")
+            client = FakeGeminiClient(latency=latency, token_latency=token_latency)
+            data = app.parse_quiz_data_with_gemini.__wrapped__(raw_text, None, _client=client)
+            return data, client.models.calls
+
+        data, calls = gemini_parse()
+        entry['gemini_calls'] = calls
+        entry['parse_quiz_data_with_gemini'] = timed(gemini_parse, repeat)
+        entry['prompt_compaction'] = bench_prompt_compaction(app, raw_text, latency, token_latency)
+        entry['concurrent_uploads'] = bench_concurrent_uploads(app, raw_text, latency, sessions)
+        entry['job_queue'] = bench_job_queue(app, path, latency, job_files)
+
+        bank_data = [question for kind, question in entries if kind == 'local'] or data
+        bank = app.QuizBank(bank_data)
+        entry['compile_quiz_bank'] = timed(lambda: app.QuizBank(bank_data), repeat)
+        entry['get_correct_answer_text'] = timed(
+            lambda: [app.get_correct_answer_text(bank, i) for i in range(len(bank))], repeat
+        )
+        entry['dedupe_bank'] = timed(lambda: app.dedupe_bank(bank, app.DEDUP_THRESHOLD), repeat)
+        qbank = app.export_qbank(bank)
+        entry['export_qbank'] = timed(lambda: app.export_qbank(bank), repeat)
+        entry['load_qbank'] = timed(lambda: app.load_qbank(qbank), repeat)
+        entry['memory_bytes'] = {
+            'quiz_bank': bank.nbytes(),
+            'mapped_qbank': app.load_qbank(qbank).nbytes(),
+            'qbank_file': len(qbank),
+        }
+        entry['review_scheduler'] = bench_review_scheduler(app, bank, min(len(bank), 2000))
+        entry['search'] = bench_search(app, bank, repeat)
+        entry['build_exam'] = timed(lambda: app.build_exam(bank, app.EXAM_DEFAULT_QUESTIONS, 0), repeat)
+        sheet = app.new_answer_sheet(len(bank))
+        entry['calculate_score'] = timed(
+            lambda: app.score_attempts(bank, app.answers_matrix([sheet], len(bank))), repeat
+        )
+
+        if not skip_apptest:
+            entry['apptest_study'] = bench_apptest(app, bank_data, 'study', repeat)
+            entry['apptest_exam'] = bench_apptest(app, bank_data, 'exam', repeat)
+
+        results[str(size)] = entry
+        print(f"[{size} câu] xong", file=sys.stderr)
+
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {
+            'sizes': sizes, 'repeat': repeat, 'latency': latency, 'tables': tables, 'images': images,
+            'sessions': sessions, 'job_files': job_files, 'boilerplate': boilerplate, 'token_latency': token_latency,
+        },
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.0, help="độ trễ giả lập mỗi lần gọi Gemini (giây)")
+    parser.add_argument(
+        "--token-latency", type=float, default=0.0, help="độ trễ giả lập theo độ dài prompt (giây / 1000 token)"
+    )
+    parser.add_argument("--tables", action="store_true")
+    parser.add_argument("--boilerplate", action="store_true", help="thêm header/số trang lặp lại vào đề sinh ra")
+    parser.add_argument("--images", action="store_true")
+    parser.add_argument("--sessions", type=int, default=20, help="số phiên tải cùng một đề đồng thời")
+    parser.add_argument("--job-files", type=int, default=8, help="số file đưa vào hàng đợi phân tích nền")
+    parser.add_argument("--skip-apptest", action="store_true", help="bỏ qua đo chạy lại script bằng AppTest")
+    parser.add_argument("--output", help="file JSON kết quả (mặc định in ra stdout)")
+    args = parser.parse_args()
+
+    report = run(
+        args.sizes, args.repeat, args.latency, args.tables, args.images, args.skip_apptest, args.sessions,
+        args.job_files, args.boilerplate, args.token_latency
+    )
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Nạp trước (pre-warm) cache phân tích khi khởi động server: mọi file .docx / .qbank trong một thư mục
+được phân tích bằng một process pool nhỏ và kết quả cả file được lưu vào cache trên đĩa, nên người
+dùng tải các file này lên sẽ nhận đề ngay mà không phải chờ đọc Word hay gọi Gemini.
+
+    python prewarm.py /srv/de_thi --workers 2
+
+setup.sh chạy script này ở nền trước `streamlit run` (xem Procfile.txt) khi đặt biến môi trường
+QUIZ_PREWARM_DIR: server khởi động ngay, các file được đưa vào cache dần. Nếu không sửa được lệnh khởi động,
+đặt thêm QUIZ_PREWARM_IN_APP=1 để ứng dụng tự chạy script ở nền (một lần cho mỗi tiến trình server).
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+EXTENSIONS = (".docx", ".qbank")
+
+
+def find_files(directory):
+    """Các file đề trong thư mục (kể cả thư mục con), theo thứ tự tên."""
+    paths = []
+    for folder, _, names in os.walk(directory):
+        paths.extend(os.path.join(folder, name) for name in names if name.lower().endswith(EXTENSIONS))
+    return sorted(paths)
+
+
+def _init_worker():
+    # Tiến trình con import ứng dụng: không để nó tự khởi động một lần nạp trước nữa
+    os.environ.pop("QUIZ_PREWARM_DIR", None)
+    sys.path.insert(0, ROOT)
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+
+def _warm(path):
+    import quiz_app_streamlit as app
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith("streamlit"):
+            logging.getLogger(name).setLevel(logging.ERROR)
+
+    start = time.perf_counter()
+    name, questions, error = app.prewarm_file(path)
+    return name, questions, error, time.perf_counter() - start
+
+
+def prewarm(directory, workers=2):
+    """Phân tích mọi file đề trong `directory`; trả về số file lỗi."""
+    paths = find_files(directory)
+    failed = 0
+    if not paths:
+        return failed
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(paths))), initializer=_init_worker) as pool:
+        for name, questions, error, seconds in pool.map(_warm, paths):
+            if error:
+                failed += 1
+                print(f"[prewarm] {name}: lỗi - {error}", file=sys.stderr)
+            else:
+                print(f"[prewarm] {name}: {questions} câu ({seconds:.2f}s)", file=sys.stderr)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory")
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    failed = prewarm(args.directory, args.workers)
+    print(f"[prewarm] xong sau {time.perf_counter() - start:.1f}s, {failed} file lỗi", file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
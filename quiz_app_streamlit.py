@@ -1,137 +1,3331 @@
+import time
+
+# Mốc thời gian bắt đầu lần chạy script hiện tại (dùng cho metrics và hồ sơ khởi động)
+_SCRIPT_START = time.perf_counter()
+
 import streamlit as st
+import atexit
+import bisect
+import codecs
 import io
-# Cần cài đặt thư viện python-docx: pip install python-docx
-try:
-    from docx import Document
-except ImportError:
-    st.error("Cần cài đặt thư viện 'python-docx' để đọc file Word: pip install python-docx")
-    Document = None # Đặt Document = None nếu import thất bại
-    
-from google import genai
-from google.genai.errors import APIError
+import itertools
+import contextlib
+import functools
+import hashlib
+import heapq
 import json
+import mmap
+import os
+import random
+import re
+import sqlite3
+import struct
+import subprocess
+import sys
+import threading
+import unicodedata
+import uuid
+import zipfile
+import zlib
+from array import array
+
+import numpy as np
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from xml.etree import ElementTree
+
+# google-genai (import mất khoảng 1 giây) chỉ được nạp khi thật sự gọi Gemini, xem load_genai()
+_IMPORTS_DONE = time.perf_counter()
+
+# --- Cấu hình Trang Streamlit ---
+st.set_page_config(
+    page_title="App Ôn Luyện Đề Thi Trắc Nghiệm",
+    layout="wide"
+)
+
+st.title("📚 Ứng dụng Ôn Luyện Trắc Nghiệm (Word File)")
+
+@st.cache_resource
+def load_api_key():
+    """
+    Khóa API để gọi Gemini - Lấy từ Streamlit Secrets, đọc một lần cho cả tiến trình
+    (đổi secrets cần khởi động lại app).
+    """
+    try:
+        return st.secrets.get("GEMINI_API_KEY")
+    except FileNotFoundError:
+        # Chưa có file secrets.toml (VD: chạy benchmark offline)
+        return None
+
+API_KEY = load_api_key()
+
+# Model Gemini dùng để phân tích và phiên bản schema JSON kết quả.
+# Tăng PARSE_SCHEMA_VERSION mỗi khi đổi prompt/schema để vô hiệu hóa cache cũ.
+GEMINI_MODEL = 'gemini-2.5-flash-preview-05-20'
+PARSE_SCHEMA_VERSION = 1
+
+# Cache kết quả phân tích trên đĩa (dùng chung cho mọi worker trên cùng máy)
+PARSE_CACHE_PATH = os.environ.get(
+    "QUIZ_PARSE_CACHE_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "tracnghiem", "parse_cache.sqlite3")
+)
+PARSE_CACHE_MAX_BYTES = int(os.environ.get("QUIZ_PARSE_CACHE_MAX_MB", "256")) * 1024 * 1024
+PARSE_CACHE_MAX_AGE = int(os.environ.get("QUIZ_PARSE_CACHE_MAX_DAYS", "30")) * 24 * 3600
+
+# --- ĐO LƯỜNG HIỆU NĂNG (METRICS) ---
+
+# Bật bằng QUIZ_METRICS=1. Khi tắt, các hàm đo chỉ là lệnh return (không tốn chi phí đáng kể)
+# và các hàm render không bị bọc.
+METRICS_ENABLED = os.environ.get("QUIZ_METRICS", "0") == "1"
+# File xuất metrics dạng Prometheus text (dùng với textfile collector của node_exporter)
+METRICS_FILE = os.environ.get("QUIZ_METRICS_FILE")
+METRICS_EXPORT_INTERVAL = 10
+
+class MetricsRegistry:
+    """Bộ đếm (counter) và thống kê thời gian (summary: count/sum/max) dùng chung toàn tiến trình."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {} # (tên, nhãn) -> giá trị
+        self._summaries = {} # (tên, nhãn) -> [count, sum, max]
+        self._last_export = 0.0
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                self._summaries[key] = [1, value, value]
+            else:
+                summary[0] += 1
+                summary[1] += value
+                summary[2] = max(summary[2], value)
+
+    def snapshot(self):
+        """List dòng {metric, labels, count, sum, max/value} để hiển thị trong bảng debug."""
+        with self._lock:
+            rows = [
+                {'metric': name, 'labels': dict(labels), 'count': c, 'sum': total, 'max': peak}
+                for (name, labels), (c, total, peak) in sorted(self._summaries.items())
+            ]
+            rows += [
+                {'metric': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+        return rows
+
+    def to_prometheus(self):
+        """Xuất toàn bộ metrics theo định dạng Prometheus text exposition."""
+        def fmt(name, labels):
+            if not labels:
+                return name
+            return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+        lines = []
+        with self._lock:
+            seen = set()
+            for (name, labels), (count, total, peak) in sorted(self._summaries.items()):
+                if name not in seen:
+                    seen.add(name)
+                    lines.append(f"# TYPE {name} summary")
+                lines.append(f"{fmt(name + '_count', labels)} {count}")
+                lines.append(f"{fmt(name + '_sum', labels)} {total:.6f}")
+            for (name, labels), (count, total, peak) in sorted(self._summaries.items()):
+                if name + "_max" not in seen:
+                    seen.add(name + "_max")
+                    lines.append(f"# TYPE {name}_max gauge")
+                lines.append(f"{fmt(name + '_max', labels)} {peak:.6f}")
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in seen:
+                    seen.add(name)
+                    lines.append(f"# TYPE {name} counter")
+                lines.append(f"{fmt(name, labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path, force=False):
+        """Ghi file Prometheus (ghi ra file tạm rồi đổi tên để bên đọc không thấy file dở)."""
+        now = time.time()
+        if not force and now - self._last_export < METRICS_EXPORT_INTERVAL:
+            return
+        self._last_export = now
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+class _MetricSpan:
+    """Context manager đo thời gian một đoạn mã, ghi vào summary `<name>_seconds`."""
+
+    __slots__ = ('registry', 'name', 'labels', 'start')
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name + "_seconds", time.perf_counter() - self.start, **self.labels)
+        return False
+
+_NULL_SPAN = contextlib.nullcontext()
+
+@st.cache_resource
+def get_metrics():
+    return MetricsRegistry()
+
+# Lấy registry một lần trong luồng script; luồng nền dùng lại tham chiếu này
+_METRICS = get_metrics() if METRICS_ENABLED else None
+
+def metric_span(name, **labels):
+    if _METRICS is None:
+        return _NULL_SPAN
+    return _MetricSpan(_METRICS, name, labels)
+
+def metric_inc(name, value=1, **labels):
+    if _METRICS is not None and value:
+        _METRICS.inc(name, value, **labels)
+
+def timed_iter(iterable, name, **labels):
+    """Bọc một iterator (VD: generator đọc .docx) và cộng dồn thời gian nằm trong các lần next()."""
+    if _METRICS is None:
+        return iterable
+    return _timed_iter(iterable, name, labels)
+
+def _timed_iter(iterable, name, labels):
+    elapsed = 0.0
+    iterator = iter(iterable)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        _METRICS.observe(name + "_seconds", elapsed, **labels)
+
+def instrument_render(fn):
+    """Decorator đo thời gian các hàm render_*; khi tắt metrics trả về nguyên hàm gốc."""
+    if _METRICS is None:
+        return fn
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with _MetricSpan(_METRICS, "quiz_render", {'view': fn.__name__}):
+            return fn(*args, **kwargs)
+    return wrapper
+
+def record_gemini_usage(response, kind, tokens=None):
+    """Ghi số token prompt/đầu ra từ usage_metadata của phản hồi Gemini (nếu có), cộng vào `tokens` (TokenUsage)."""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return
+    if tokens is not None:
+        tokens.add_response(usage)
+    metric_inc("quiz_gemini_prompt_tokens_total", getattr(usage, 'prompt_token_count', None) or 0, kind=kind)
+    metric_inc("quiz_gemini_output_tokens_total", getattr(usage, 'candidates_token_count', None) or 0, kind=kind)
+
+def render_metrics_debug_panel():
+    """Bảng debug ẩn trong sidebar (mở bằng ?debug=1)."""
+    with st.sidebar.expander("🛠️ Debug: metrics hiệu năng"):
+        st.markdown("**Hồ sơ khởi động** (giây, lần đầu trong tiến trình)")
+        st.dataframe(
+            [{'phase': phase, 'seconds': round(seconds, 4)} for phase, seconds in _STARTUP.items()],
+            use_container_width=True
+        )
+        if _METRICS is None:
+            st.caption("Metrics đang tắt. Đặt biến môi trường QUIZ_METRICS=1 để bật.")
+            return
+        st.dataframe(_METRICS.snapshot(), use_container_width=True)
+        text = _METRICS.to_prometheus()
+        st.download_button("Tải metrics (Prometheus)", text, file_name="quiz_metrics.prom")
+        if METRICS_FILE:
+            st.caption(f"Đang ghi định kỳ ra {METRICS_FILE}")
+
+# --- KHỞI ĐỘNG: HỒ SƠ THỜI GIAN, NẠP TRỄ SDK GEMINI, NẠP TRƯỚC CACHE ---
+
+@st.cache_resource
+def get_startup_profile():
+    """Thời gian (giây) các bước khởi động của tiến trình: chỉ giữ giá trị lần đầu (cold start)."""
+    return {}
+
+_STARTUP = get_startup_profile()
+
+def record_startup(phase, seconds):
+    if phase in _STARTUP:
+        return
+    _STARTUP[phase] = seconds
+    if _METRICS is not None:
+        _METRICS.observe("quiz_startup_seconds", seconds, phase=phase)
+
+record_startup("imports", _IMPORTS_DONE - _SCRIPT_START)
+
+def load_genai():
+    """Nạp google-genai ở lần đầu cần gọi Gemini (không nạp lúc khởi động)."""
+    loaded = "google.genai" in sys.modules
+    start = time.perf_counter()
+    from google import genai
+    if not loaded:
+        record_startup("import google.genai", time.perf_counter() - start)
+    return genai
+
+class _GeminiSdkNotLoaded(Exception):
+    """Đứng thay APIError khi SDK chưa được nạp (khi đó chưa thể có lỗi API nào); không bao giờ được ném."""
+
+def gemini_api_error():
+    """Lớp APIError của google-genai, dùng trong `except` mà không buộc phải nạp SDK."""
+    errors = sys.modules.get("google.genai.errors")
+    return errors.APIError if errors is not None else _GeminiSdkNotLoaded
+
+# Thư mục đề (.docx / .qbank) được phân tích sẵn vào cache khi server khởi động, xem prewarm.py.
+# Mặc định setup.sh chạy prewarm.py ở nền khi khởi động; QUIZ_PREWARM_IN_APP=1 để ứng dụng tự chạy
+# ở nền (khi không sửa được lệnh khởi động).
+PREWARM_DIR = os.environ.get("QUIZ_PREWARM_DIR")
+PREWARM_WORKERS = int(os.environ.get("QUIZ_PREWARM_WORKERS", "2"))
+PREWARM_IN_APP = os.environ.get("QUIZ_PREWARM_IN_APP") == "1"
+
+@st.cache_resource
+def start_prewarm(directory):
+    """Chạy prewarm.py ở tiến trình riêng, một lần cho mỗi tiến trình server. Trả về Popen."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prewarm.py")
+    process = subprocess.Popen([sys.executable, script, directory, "--workers", str(PREWARM_WORKERS)])
+    # Thu hồi tiến trình con khi nó kết thúc (không để lại zombie); returncode vẫn đọc được qua poll()
+    threading.Thread(target=process.wait, name="quiz-prewarm-reaper", daemon=True).start()
+    return process
+
+if PREWARM_DIR and PREWARM_IN_APP:
+    start_prewarm(PREWARM_DIR)
+
+# --- CACHE PHÂN TÍCH TRÊN ĐĨA (SQLITE) ---
+
+def normalize_raw_text(raw_text):
+    """Chuẩn hóa văn bản thô (Unicode NFC, khoảng trắng, dòng trống) trước khi băm."""
+    text = unicodedata.normalize("NFC", raw_text)
+    lines = (" ".join(line.split()) for line in text.splitlines())
+    return "\n".join(line for line in lines if line)
+
+def parse_cache_key(raw_text, model=GEMINI_MODEL):
+    """Khóa cache: SHA-256 của văn bản đã chuẩn hóa + tên model + phiên bản schema."""
+    digest = hashlib.sha256()
+    digest.update(f"{model}\0{PARSE_SCHEMA_VERSION}\0".encode("utf-8"))
+    digest.update(normalize_raw_text(raw_text).encode("utf-8"))
+    return digest.hexdigest()
+
+def file_cache_key(data, model=GEMINI_MODEL):
+    """Khóa cache cấp file: SHA-256 nội dung file (.docx / .qbank) + tên model + phiên bản schema."""
+    digest = hashlib.sha256()
+    digest.update(f"file\0{model}\0{PARSE_SCHEMA_VERSION}\0".encode("utf-8"))
+    digest.update(data)
+    return digest.hexdigest()
+
+def _parse_cache_connect():
+    """Mở kết nối SQLite tới file cache (WAL để nhiều tiến trình đọc/ghi đồng thời)."""
+    os.makedirs(os.path.dirname(PARSE_CACHE_PATH), exist_ok=True)
+    conn = sqlite3.connect(PARSE_CACHE_PATH, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS entries ("
+        " key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL,"
+        " created REAL NOT NULL, last_access REAL NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries(last_access)")
+    conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    return conn
+
+def _parse_cache_bump(conn, name):
+    conn.execute(
+        "INSERT INTO stats(name, value) VALUES (?, 1) "
+        "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+        (name,)
+    )
+
+def parse_cache_get(key):
+    """Trả về kết quả đã cache (list câu hỏi) hoặc None. Lỗi cache không làm hỏng luồng chính."""
+    try:
+        conn = _parse_cache_connect()
+        try:
+            row = conn.execute("SELECT value, created FROM entries WHERE key = ?", (key,)).fetchone()
+            now = time.time()
+            if row is not None and now - row[1] > PARSE_CACHE_MAX_AGE:
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                _parse_cache_bump(conn, "misses")
+                metric_inc("quiz_parse_cache_total", result="miss")
+                return None
+            conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+            _parse_cache_bump(conn, "hits")
+            metric_inc("quiz_parse_cache_total", result="hit")
+            return json.loads(zlib.decompress(row[0]).decode("utf-8"))
+        finally:
+            conn.close()
+    except (sqlite3.Error, OSError, zlib.error, ValueError):
+        return None
+
+def parse_cache_put(key, data):
+    """Lưu kết quả vào cache, sau đó loại bỏ mục quá hạn và mục ít dùng nhất (LRU) nếu vượt dung lượng."""
+    try:
+        value = zlib.compress(json.dumps(data, ensure_ascii=False).encode("utf-8"))
+        now = time.time()
+        conn = _parse_cache_connect()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries(key, value, size, created, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), now, now)
+            )
+            conn.execute("DELETE FROM entries WHERE created < ?", (now - PARSE_CACHE_MAX_AGE,))
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total > PARSE_CACHE_MAX_BYTES:
+                for old_key, size in conn.execute(
+                    "SELECT key, size FROM entries ORDER BY last_access ASC"
+                ).fetchall():
+                    if total <= PARSE_CACHE_MAX_BYTES:
+                        break
+                    conn.execute("DELETE FROM entries WHERE key = ?", (old_key,))
+                    total -= size
+                    _parse_cache_bump(conn, "evictions")
+        finally:
+            conn.close()
+    except (sqlite3.Error, OSError):
+        pass
+
+def parse_cache_stats():
+    """Thống kê cache: số lần hit/miss/evict, số mục và tổng dung lượng (byte)."""
+    try:
+        conn = _parse_cache_connect()
+        try:
+            stats = dict(conn.execute("SELECT name, value FROM stats").fetchall())
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        finally:
+            conn.close()
+    except (sqlite3.Error, OSError):
+        return None
+    return {
+        'hits': stats.get('hits', 0),
+        'misses': stats.get('misses', 0),
+        'evictions': stats.get('evictions', 0),
+        'entries': entries,
+        'bytes': size,
+    }
+
+# --- HÀM XỬ LÝ DOCX VÀ PARSING BẰNG GEMINI ---
+
+W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+W_VAL = W_NS + 'val'
+
+def _rpr_is_marked(rpr):
+    """Run được coi là "đánh dấu" nếu in đậm, gạch chân hoặc tô sáng (cách đánh dấu đáp án phổ biến)."""
+    if rpr is None:
+        return False
+    bold = rpr.find(W_NS + 'b')
+    if bold is not None and bold.get(W_VAL, 'true') not in ('0', 'false', 'off'):
+        return True
+    for tag in ('u', 'highlight'):
+        elem = rpr.find(W_NS + tag)
+        if elem is not None and elem.get(W_VAL, 'single') != 'none':
+            return True
+    return False
+
+def _paragraph_blocks(runs):
+    """Ghép các run (text, marked) của một đoạn thành các block (text, marks), tách dòng tại ngắt dòng."""
+    blocks = []
+    parts = []
+    marks = []
+    pos = 0
+    for text, marked in runs + [("\n", False)]:
+        for k, piece in enumerate(text.split("\n")):
+            if k:
+                line = "".join(parts)
+                if line.strip():
+                    blocks.append((line, tuple(marks)))
+                parts, marks, pos = [], [], 0
+            if piece:
+                if marked:
+                    marks.append((pos, pos + len(piece)))
+                parts.append(piece)
+                pos += len(piece)
+    return blocks
+
+def _row_blocks(cells):
+    """
+    Một hàng bảng mà mỗi ô chỉ có tối đa một dòng (VD: "1 | A" trong bảng đáp án, hoặc "Câu 1 | A. x | B. y")
+    được gộp thành một block, các ô cách nhau bởi tab. Hàng có ô nhiều dòng được trả về từng dòng.
+    """
+    if any(len(cell) > 1 for cell in cells):
+        return [block for cell in cells for block in cell]
+    parts = []
+    marks = []
+    pos = 0
+    for cell in cells:
+        if not cell:
+            continue
+        text, cell_marks = cell[0]
+        if parts:
+            parts.append("\t")
+            pos += 1
+        marks.extend((start + pos, end + pos) for start, end in cell_marks)
+        parts.append(text)
+        pos += len(text)
+    return [("".join(parts), tuple(marks))] if parts else []
+
+def iter_docx_blocks(uploaded_file):
+    """
+    Đọc file Word (.docx) theo luồng: phân tích `word/document.xml` trực tiếp trong file zip bằng
+    iterparse và giải phóng từng phần tử sau khi xử lý, nên bộ nhớ gần như không đổi theo kích thước file
+    (ảnh nhúng không bao giờ được nạp). Sinh ra các tuple (text, marks) cho từng dòng của đoạn văn
+    và ô bảng; `marks` là các khoảng ký tự [start, end) được in đậm/gạch chân/tô sáng, dùng để nhận
+    diện đáp án được đánh dấu trực tiếp trong file.
+    Ném zipfile.BadZipFile / KeyError / ParseError nếu file không phải .docx hợp lệ.
+    """
+    with zipfile.ZipFile(uploaded_file) as archive, archive.open('word/document.xml') as xml_stream:
+        body = None
+        depth = 0
+        runs = []
+        # Ngăn xếp cho bảng lồng nhau: mỗi phần tử là (list ô của hàng hiện tại, list block của ô hiện tại)
+        rows = []
+        for event, elem in ElementTree.iterparse(xml_stream, events=('start', 'end')):
+            tag = elem.tag
+            if event == 'start':
+                depth += 1
+                if tag == W_NS + 'body':
+                    body = elem
+                elif tag == W_NS + 'p':
+                    runs = []
+                elif tag == W_NS + 'tr':
+                    rows.append([[], None])
+                elif tag == W_NS + 'tc' and rows:
+                    rows[-1][1] = []
+                continue
+
+            depth -= 1
+            if tag == W_NS + 'r':
+                text = []
+                for child in elem:
+                    if child.tag == W_NS + 't':
+                        text.append(child.text or "")
+                    elif child.tag == W_NS + 'tab':
+                        text.append("\t")
+                    elif child.tag in (W_NS + 'br', W_NS + 'cr'):
+                        text.append("\n")
+                if text:
+                    runs.append(("".join(text), _rpr_is_marked(elem.find(W_NS + 'rPr'))))
+                elem.clear()
+            elif tag == W_NS + 'p':
+                blocks = _paragraph_blocks(runs)
+                runs = []
+                if rows and rows[-1][1] is not None:
+                    rows[-1][1].extend(blocks)
+                else:
+                    yield from blocks
+                elem.clear()
+            elif tag == W_NS + 'tc' and rows:
+                rows[-1][0].append(rows[-1][1] or [])
+                rows[-1][1] = None
+            elif tag == W_NS + 'tr' and rows:
+                cells, _ = rows.pop()
+                blocks = _row_blocks(cells)
+                if rows and rows[-1][1] is not None:
+                    rows[-1][1].extend(blocks)
+                else:
+                    yield from blocks
+                elem.clear()
+
+            # Phần tử cấp cao nhất trong <w:body> đã xử lý xong: bỏ khỏi cây để giữ bộ nhớ ổn định
+            if depth == 2 and body is not None and tag != W_NS + 'body':
+                body.clear()
+
+@st.cache_data(show_spinner=False)
+def read_docx(uploaded_file):
+    """Đọc toàn bộ văn bản (kể cả nội dung bảng) từ file Word (.docx)."""
+    try:
+        return "\n".join(text for text, _ in iter_docx_blocks(uploaded_file))
+    except (zipfile.BadZipFile, KeyError, ElementTree.ParseError) as e:
+        st.error(f"Lỗi đọc file Word: {e}")
+        return None
+
+GEMINI_SYSTEM_INSTRUCTION = (
+    "Bạn là một chuyên gia phân tích cú pháp đề thi trắc nghiệm. Nhiệm vụ của bạn là đọc văn bản thô "
+    "từ file Word và trích xuất tất cả các câu hỏi trắc nghiệm thành một mảng JSON. "
+    "Mỗi câu hỏi phải bao gồm 'question', 'options' (một mảng chứa tất cả các lựa chọn), "
+    "và 'correct_answer' (chỉ là chữ cái (A, B, C...) hoặc nội dung văn bản đáp án đúng)."
+    "Đảm bảo kết quả là JSON hợp lệ và CHỈ chứa JSON, không thêm lời nói đầu hay giải thích."
+    "Bạn phải luôn luôn trả về một mảng JSON."
+)
+
+# Định nghĩa Schema cho kết quả JSON
+GEMINI_RESPONSE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "question": {"type": "STRING", "description": "Nội dung câu hỏi."},
+            "options": {
+                "type": "ARRAY",
+                "items": {"type": "STRING"},
+                "description": "Mảng chứa các lựa chọn đáp án (A, B, C...)."
+            },
+            "correct_answer": {"type": "STRING", "description": "Chữ cái (A, B, C...) hoặc nội dung của đáp án đúng."}
+        },
+        "required": ["question", "options", "correct_answer"]
+    }
+}
+
+# Chia đề lớn thành nhiều đoạn (theo ranh giới "Câu N") để gọi Gemini song song.
+# QUIZ_CHUNK_TOKENS=0 tắt chế độ chia đoạn (gửi toàn bộ văn bản trong một lần gọi).
+GEMINI_CHUNK_TOKENS = int(os.environ.get("QUIZ_CHUNK_TOKENS", "6000"))
+GEMINI_MAX_WORKERS = int(os.environ.get("QUIZ_GEMINI_WORKERS", "4"))
+GEMINI_CHUNK_RETRIES = 2
+
+QUESTION_START_RE = re.compile(r'^[ \t]*Câu[ \t]+\d+', re.IGNORECASE | re.MULTILINE)
+
+def estimate_tokens(text):
+    """Ước lượng số token (tiếng Việt trung bình ~3 ký tự / token), đủ để giới hạn kích thước đoạn."""
+    return len(text) // 3 + 1
+
+def split_into_chunks(raw_text, max_tokens=GEMINI_CHUNK_TOKENS):
+    """
+    Chia văn bản thành các đoạn liền nhau, mỗi đoạn gồm nhiều câu hỏi trọn vẹn và không vượt quá
+    max_tokens (trừ khi một câu hỏi đơn lẻ đã lớn hơn giới hạn). Phần mở đầu trước "Câu 1" được
+    gộp vào đoạn đầu tiên.
+    """
+    starts = [m.start() for m in QUESTION_START_RE.finditer(raw_text)]
+    if not max_tokens or len(starts) < 2:
+        return [raw_text]
+
+    bounds = [0] + starts[1:] + [len(raw_text)]
+    chunks = []
+    chunk_start = 0
+    chunk_tokens = 0
+    for begin, finish in zip(bounds, bounds[1:]):
+        block_tokens = estimate_tokens(raw_text[begin:finish])
+        if chunk_tokens and chunk_tokens + block_tokens > max_tokens:
+            chunks.append(raw_text[chunk_start:begin])
+            chunk_start = begin
+            chunk_tokens = 0
+        chunk_tokens += block_tokens
+    chunks.append(raw_text[chunk_start:])
+    return chunks
+
+# --- RÚT GỌN PROMPT VÀ ĐẾM TOKEN ---
+
+# Bỏ số trang, phần thủ tục của đề (tên trường, họ tên, lớp...) và header/footer lặp lại trước khi gửi Gemini
+PROMPT_COMPACTION = os.environ.get("QUIZ_PROMPT_COMPACTION", "1") != "0"
+# Hạn mức token (ước tính) của một request; đoạn lớn hơn được chia nhỏ tiếp. 0 = không giới hạn.
+GEMINI_REQUEST_TOKEN_BUDGET = int(os.environ.get("QUIZ_GEMINI_TOKEN_BUDGET", "8000"))
+# Đếm token chính xác bằng API count_tokens trước mỗi request (thêm một lời gọi nhẹ) thay vì ước tính
+GEMINI_COUNT_TOKENS = os.environ.get("QUIZ_GEMINI_COUNT_TOKENS") == "1"
+
+# Dòng lặp lại từ COMPACT_REPEAT_MIN lần trở lên ngoài thân câu hỏi được coi là header/footer của trang
+COMPACT_REPEAT_MIN = 3
+COMPACT_REPEAT_MIN_CHARS = 12
+
+# Dòng thủ tục / số trang (chỉ khớp cả dòng; chữ hoa phân biệt để không bắt nhầm nội dung câu hỏi)
+NOISE_LINE_RE = re.compile(
+    r'^(?:'
+    r'(?:SỞ|BỘ|PHÒNG) GIÁO DỤC\b.*|TRƯỜNG\b.*|(?:ĐỀ THI|ĐỀ KIỂM TRA|KỲ THI|ĐỀ CHÍNH THỨC)\b.*'
+    r'|(?i:họ\s*(?:và\s*)?tên(?:\s*(?:thí sinh|học sinh))?\s*[:.…_].*)'
+    r'|(?i:(?:lớp|số báo danh|sbd|phòng thi)\s*[:.…_].*)'
+    r'|(?i:mã\s*đề(?:\s*thi)?\s*[:.]?\s*\d+.*)'
+    r'|(?i:\(?thời gian(?: làm bài)?\s*:?\s*\d+\s*phút.*)'
+    r'|(?i:\(?đề (?:thi )?(?:gồm|có) \d+ trang.*)'
+    r'|(?i:(?:thí sinh không được|giám thị không|cán bộ coi thi).*)'
+    r'|[-–—_.* ]*HẾT[-–—_.* ]*'
+    r'|(?i:(?:trang|page)\s*\d+(?:\s*(?:/|của|of)\s*\d+)?)'
+    r'|[-–—]\s*\d{1,3}\s*[-–—]'
+    r')$'
+)
+# Dòng cấu trúc của đề (câu hỏi, lựa chọn, đáp án) không bao giờ bị bỏ dù lặp lại
+STRUCTURE_LINE_RE = re.compile(r'^\s*(?:Câu\s*\d+|\*?\s*[A-F]\s*[.):]|Đáp\s*án)', re.IGNORECASE)
+
+GEMINI_USER_PROMPT = "Trích xuất tất cả câu hỏi trắc nghiệm từ văn bản sau:\n\n---\n{}\n---"
+# Phần cố định của mỗi request (system instruction + khung prompt), trừ vào hạn mức khi chia đoạn
+PROMPT_OVERHEAD_TOKENS = estimate_tokens(GEMINI_SYSTEM_INSTRUCTION + GEMINI_USER_PROMPT)
+
+def gemini_user_prompt(chunk_text):
+    return GEMINI_USER_PROMPT.format(chunk_text)
+
+def _compaction_lines(text):
+    """
+    Các dòng không trống của `text` (chuẩn hóa NFC và khoảng trắng) kèm cờ "nằm trong thân câu hỏi":
+    từ dòng "Câu N" tới dòng đáp án của câu đó (hoặc tới câu kế tiếp nếu không có dòng đáp án).
+    """
+    in_body = False
+    for line in unicodedata.normalize("NFC", text).splitlines():
+        line = " ".join(line.split())
+        if not line:
+            continue
+        if QUESTION_START_RE.match(line):
+            in_body = True
+        yield line, in_body
+        if ANSWER_LINE_RE.match(line):
+            in_body = False
+
+def repeated_lines(texts, min_count=COMPACT_REPEAT_MIN):
+    """
+    Các dòng lặp lại ít nhất min_count lần ngoài thân câu hỏi trong `texts`, trừ dòng cấu trúc. Dòng
+    trong thân câu hỏi không được đếm: đề lặp lại nguyên văn (VD: "Chọn phát biểu đúng về hàm số sau:").
+    """
+    counts = {}
+    for text in texts:
+        for line, in_body in _compaction_lines(text):
+            if not in_body and len(line) >= COMPACT_REPEAT_MIN_CHARS and not STRUCTURE_LINE_RE.match(line):
+                counts[line] = counts.get(line, 0) + 1
+    return {line for line, count in counts.items() if count >= min_count}
+
+def compact_quiz_text(text, repeated=None):
+    """
+    Văn bản gửi Gemini sau khi rút gọn: chuẩn hóa Unicode NFC và khoảng trắng, bỏ dòng trống, số
+    trang, dòng thủ tục (NOISE_LINE_RE) và các dòng trong `repeated` (mặc định: dòng lặp lại trong
+    chính văn bản này). Dòng câu hỏi, lựa chọn và đáp án luôn được giữ nguyên; trong thân câu hỏi chỉ
+    bỏ dòng thủ tục, không bỏ dòng chỉ vì lặp lại.
+    """
+    if repeated is None:
+        repeated = repeated_lines([text])
+    kept = []
+    for line, in_body in _compaction_lines(text):
+        if STRUCTURE_LINE_RE.match(line):
+            kept.append(line)
+        elif not NOISE_LINE_RE.match(line) and (in_body or line not in repeated):
+            kept.append(line)
+    return "\n".join(kept)
+
+def enforce_token_budget(chunks, budget=GEMINI_REQUEST_TOKEN_BUDGET):
+    """
+    Bảo đảm mỗi đoạn (cộng phần cố định của prompt) không vượt `budget` token: đoạn lớn được chia
+    tiếp theo ranh giới "Câu N", rồi theo dòng, cuối cùng theo ký tự nếu một dòng đã quá lớn.
+    """
+    if not budget:
+        return chunks
+    limit = max(1, budget - PROMPT_OVERHEAD_TOKENS)
+    result = []
+    for chunk in chunks:
+        if estimate_tokens(chunk) <= limit:
+            result.append(chunk)
+            continue
+        metric_inc("quiz_gemini_budget_splits_total")
+        for piece in split_into_chunks(chunk, limit):
+            if estimate_tokens(piece) <= limit:
+                result.append(piece)
+                continue
+            lines = []
+            tokens = 0
+            # Dòng dài hơn hạn mức được cắt theo số ký tự (estimate_tokens: ~3 ký tự / token)
+            step = max(1, 3 * (limit - 1))
+            for line in piece.split("\n"):
+                for start in range(0, max(1, len(line)), step):
+                    part = line[start:start + step]
+                    part_tokens = estimate_tokens(part)
+                    if lines and tokens + part_tokens > limit:
+                        result.append("\n".join(lines))
+                        lines, tokens = [], 0
+                    lines.append(part)
+                    tokens += part_tokens
+            result.append("\n".join(lines))
+    return result
+
+class TokenUsage:
+    """
+    Token của một lần phân tích (một tài liệu): ước tính trước và sau khi rút gọn, và số token thực tế
+    Gemini báo về (prompt / output) cho các request thật sự được gửi (không tính đoạn lấy từ cache).
+    """
+
+    def __init__(self):
+        self.raw = 0
+        self.sent = 0
+        self.prompt = 0
+        self.output = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def add_estimate(self, raw, sent):
+        with self._lock:
+            self.raw += raw
+            self.sent += sent
+
+    def add_response(self, usage):
+        with self._lock:
+            self.prompt += getattr(usage, 'prompt_token_count', None) or 0
+            self.output += getattr(usage, 'candidates_token_count', None) or 0
+            self.requests += 1
+
+    @property
+    def saved(self):
+        return self.raw - self.sent
+
+    def report(self):
+        """Các khóa token của báo cáo phân tích (xem EMPTY_PARSE_REPORT)."""
+        return {
+            'tokens_raw': self.raw, 'tokens_sent': self.sent,
+            'tokens_prompt': self.prompt, 'tokens_output': self.output,
+        }
+
+def prepare_gemini_chunks(texts, chunk_tokens=GEMINI_CHUNK_TOKENS, usage=None):
+    """
+    Chuẩn bị các phần văn bản cần gửi Gemini của một tài liệu: rút gọn (dòng lặp được tính trên toàn
+    tài liệu), chia đoạn theo chunk_tokens rồi áp hạn mức token mỗi request. Trả về list đoạn của
+    từng phần; số token ước tính trước/sau khi rút gọn được cộng vào `usage`.
+    """
+    repeated = repeated_lines(texts) if PROMPT_COMPACTION else None
+    prepared = []
+    for text in texts:
+        compact = compact_quiz_text(text, repeated) if PROMPT_COMPACTION else text
+        chunks = enforce_token_budget(split_into_chunks(compact, chunk_tokens))
+        raw = estimate_tokens(text)
+        sent = sum(estimate_tokens(chunk) for chunk in chunks)
+        metric_inc("quiz_prompt_tokens_estimated_total", raw, stage="raw")
+        metric_inc("quiz_prompt_tokens_estimated_total", sent, stage="sent")
+        metric_inc("quiz_prompt_tokens_saved_total", raw - sent)
+        if usage is not None:
+            usage.add_estimate(raw, sent)
+        prepared.append(chunks)
+    return prepared
+
+def count_prompt_tokens(client, user_prompt):
+    """Số token của prompt trước khi gửi: đếm bằng API nếu bật GEMINI_COUNT_TOKENS, ngược lại ước tính."""
+    if GEMINI_COUNT_TOKENS and hasattr(client.models, 'count_tokens'):
+        try:
+            return client.models.count_tokens(model=GEMINI_MODEL, contents=user_prompt).total_tokens
+        except Exception:
+            metric_inc("quiz_gemini_errors_total", kind="count_tokens")
+    return estimate_tokens(user_prompt)
+
+# --- CLIENT GEMINI DÙNG CHUNG (GIỚI HẠN TỐC ĐỘ, THỬ LẠI, GỘP YÊU CẦU TRÙNG) ---
+
+# Hạn mức gọi API của cả tiến trình (mọi phiên cộng lại). 0 = không giới hạn.
+GEMINI_RPM = int(os.environ.get("QUIZ_GEMINI_RPM", "60"))
+GEMINI_TPM = int(os.environ.get("QUIZ_GEMINI_TPM", "1000000"))
+# Số lần thử lại khi API trả lỗi tạm thời (429, 5xx), chờ theo hàm mũ có jitter
+GEMINI_API_RETRIES = int(os.environ.get("QUIZ_GEMINI_API_RETRIES", "4"))
+GEMINI_BACKOFF_BASE = 1.0
+GEMINI_BACKOFF_MAX = 30.0
+RETRYABLE_API_CODES = frozenset({408, 429, 500, 502, 503, 504})
+
+class TokenBucket:
+    """Token bucket an toàn luồng: nạp lại `per_minute` đơn vị mỗi phút, tối đa `per_minute` đơn vị tích lũy."""
+
+    def __init__(self, per_minute, clock=time.monotonic):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self._clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, amount):
+        """Lấy `amount` đơn vị nếu đủ và trả về 0; nếu không, trả về số giây cần chờ (không lấy gì)."""
+        # Yêu cầu lớn hơn cả dung lượng bucket vẫn được phục vụ khi bucket đầy
+        amount = min(float(amount), self.capacity)
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return 0.0
+            return (amount - self._tokens) / self.rate
+
+class GeminiClientManager:
+    """
+    Quản lý client Gemini dùng chung toàn tiến trình:
+    - tái sử dụng một `genai.Client` (và kết nối HTTP của nó) cho mỗi API Key;
+    - giới hạn số request và số token mỗi phút bằng token bucket;
+    - thử lại lỗi tạm thời (429, 5xx) với thời gian chờ tăng theo hàm mũ có jitter;
+    - gộp các yêu cầu giống hệt nhau đang chạy đồng thời (single-flight): chỉ một lần gọi API,
+      các bên còn lại chờ và dùng chung kết quả.
+    `client_factory` và `sleep` thay được để kiểm thử với client giả lập.
+    """
+
+    def __init__(self, client_factory=None, rpm=GEMINI_RPM, tpm=GEMINI_TPM, max_retries=GEMINI_API_RETRIES,
+                 backoff_base=GEMINI_BACKOFF_BASE, backoff_max=GEMINI_BACKOFF_MAX, sleep=time.sleep, seed=None):
+        self._client_factory = client_factory or (lambda api_key: load_genai().Client(api_key=api_key))
+        self._requests = TokenBucket(rpm) if rpm else None
+        self._tokens = TokenBucket(tpm) if tpm else None
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._sleep = sleep
+        self._random = random.Random(seed)
+        self._clients = {}
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def client(self, api_key):
+        """Client dùng chung cho `api_key` (tạo ở lần đầu)."""
+        with self._lock:
+            client = self._clients.get(api_key)
+            if client is None:
+                client = self._clients[api_key] = self._client_factory(api_key)
+            return client
+
+    def acquire(self, tokens):
+        """Chờ tới khi hạn mức cho phép gửi một request ước tính `tokens` token; trả về số giây đã chờ."""
+        waited = 0.0
+        for bucket, amount in ((self._requests, 1), (self._tokens, tokens)):
+            if bucket is None:
+                continue
+            while True:
+                delay = bucket.try_acquire(amount)
+                if not delay:
+                    break
+                self._sleep(delay)
+                waited += delay
+        if waited:
+            metric_inc("quiz_gemini_ratelimit_waits_total")
+            if _METRICS is not None:
+                _METRICS.observe("quiz_gemini_ratelimit_wait_seconds", waited)
+        return waited
+
+    @staticmethod
+    def is_retryable(error):
+        return isinstance(error, gemini_api_error()) and error.code in RETRYABLE_API_CODES
+
+    def backoff_delay(self, attempt):
+        """Thời gian chờ trước lần thử lại thứ `attempt` (từ 0): nửa cố định, nửa ngẫu nhiên."""
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        with self._lock:
+            return delay / 2 + self._random.uniform(0, delay / 2)
+
+    def backoff(self, attempt):
+        metric_inc("quiz_gemini_retries_total", kind="api")
+        self._sleep(self.backoff_delay(attempt))
+
+    def call(self, fn, tokens):
+        """Gọi `fn()` trong hạn mức; lỗi tạm thời được thử lại tối đa `max_retries` lần."""
+        attempt = 0
+        while True:
+            self.acquire(tokens)
+            try:
+                return fn()
+            except gemini_api_error() as e:
+                if not self.is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                self.backoff(attempt)
+                attempt += 1
+
+    def join(self, key):
+        """
+        Đăng ký yêu cầu có khóa `key`. Trả về (flight, leader): leader=True nghĩa là bên gọi phải tự
+        thực hiện rồi gọi land(); ngược lại chờ `flight.result()` của bên đang thực hiện.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                metric_inc("quiz_gemini_deduplicated_total")
+                return flight, False
+            flight = self._flights[key] = Future()
+            return flight, True
+
+    def land(self, key, flight, result=None, error=None):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        if error is not None:
+            flight.set_exception(error)
+        else:
+            flight.set_result(result)
+
+    def run_once(self, key, fn):
+        """Thực hiện `fn()` một lần cho mỗi `key` đang chạy đồng thời; các bên trùng nhận cùng kết quả."""
+        flight, leader = self.join(key)
+        if not leader:
+            return flight.result()
+        try:
+            result = fn()
+        except Exception as e:
+            self.land(key, flight, error=e)
+            raise
+        self.land(key, flight, result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {'clients': len(self._clients), 'in_flight': len(self._flights)}
+
+@st.cache_resource
+def get_gemini_manager():
+    return GeminiClientManager()
+
+# Lấy một lần trong luồng script; các luồng nền dùng lại tham chiếu này
+_GEMINI = get_gemini_manager()
+
+def gemini_request_tokens(client, user_prompt):
+    """Số token cho hạn mức TPM: prompt cộng phần JSON trả về (cỡ tương đương văn bản đề)."""
+    return 2 * count_prompt_tokens(client, user_prompt)
+
+def _parse_chunk_with_gemini(client, chunk_text, tokens=None):
+    """
+    Gọi Gemini cho một đoạn văn bản và lưu kết quả vào cache trên đĩa. Ném lỗi nếu thất bại.
+    Các lời gọi đồng thời cho cùng một đoạn (VD: nhiều học sinh tải cùng một đề) dùng chung một request.
+    Token thực tế của request (nếu có gửi) được cộng vào `tokens`.
+    """
+    key = parse_cache_key(chunk_text)
+    return _GEMINI.run_once(key, lambda: _request_chunk_with_gemini(client, chunk_text, key, tokens))
+
+def _request_chunk_with_gemini(client, chunk_text, key, tokens=None):
+    # Một request trùng có thể vừa hoàn tất ngay trước khi ta trở thành bên thực hiện
+    cached = parse_cache_get(key)
+    if cached is not None:
+        return cached
+    user_prompt = gemini_user_prompt(chunk_text)
+    config = {
+        "response_mime_type": "application/json",
+        "response_schema": GEMINI_RESPONSE_SCHEMA,
+        "system_instruction": GEMINI_SYSTEM_INSTRUCTION
+    }
+
+    def request():
+        metric_inc("quiz_gemini_requests_total", kind="generate")
+        with metric_span("quiz_gemini_call", kind="generate"):
+            return client.models.generate_content(
+                model=GEMINI_MODEL,
+                contents=user_prompt,
+                config=config
+            )
+
+    response = _GEMINI.call(request, gemini_request_tokens(client, user_prompt))
+    record_gemini_usage(response, "generate", tokens)
+    with metric_span("quiz_stage", stage="json_decode"):
+        parsed_data = json.loads(response.text)
+    if not isinstance(parsed_data, list):
+        raise ValueError("Gemini không trả về mảng JSON.")
+    parse_cache_put(key, parsed_data)
+    return parsed_data
+
+def parse_chunks_with_gemini(chunks, client, max_workers=GEMINI_MAX_WORKERS, retries=GEMINI_CHUNK_RETRIES, tokens=None):
+    """
+    Phân tích song song các đoạn qua một thread pool giới hạn, trả về list kết quả theo đúng thứ tự
+    đoạn. Đoạn trả về JSON lỗi được thử lại riêng lẻ tối đa `retries` lần; hết lượt thì ném lỗi cuối
+    cùng. Lỗi API tạm thời đã được GeminiClientManager thử lại (có backoff) nên không thử lại ở đây.
+    """
+    results = [None] * len(chunks)
+    if not chunks:
+        return results
+
+    attempts = [0] * len(chunks)
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as pool:
+        pending = {pool.submit(_parse_chunk_with_gemini, client, chunk, tokens): i for i, chunk in enumerate(chunks)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = pending.pop(future)
+                try:
+                    results[i] = future.result()
+                except (json.JSONDecodeError, ValueError):
+                    attempts[i] += 1
+                    metric_inc("quiz_gemini_errors_total", kind="generate")
+                    if attempts[i] > retries:
+                        for other in pending:
+                            other.cancel()
+                        raise
+                    metric_inc("quiz_gemini_retries_total", kind="generate")
+                    pending[pool.submit(_parse_chunk_with_gemini, client, chunks[i], tokens)] = i
+    return results
+
+def gemini_parse_chunks(chunks, api_key, _client=None, tokens=None):
+    """
+    Trả về list kết quả (list câu hỏi) cho từng đoạn theo thứ tự, hoặc None nếu lỗi (đã hiển thị
+    thông báo). Đoạn đã có trong cache trên đĩa không gọi API; các đoạn còn lại gọi song song.
+    `_client` cho phép truyền client giả lập (cùng giao diện `models.generate_content`) khi kiểm thử.
+    """
+    results = [parse_cache_get(parse_cache_key(chunk)) for chunk in chunks]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if not missing:
+        return results
+
+    if not api_key and _client is None:
+        st.error("Lỗi: Không tìm thấy Khóa API. Vui lòng cấu hình Khóa 'GEMINI_API_KEY' trong Streamlit Secrets.")
+        return None
+
+    try:
+        client = _client if _client is not None else _GEMINI.client(api_key)
+        fresh = parse_chunks_with_gemini([chunks[i] for i in missing], client, tokens=tokens)
+        for i, result in zip(missing, fresh):
+            results[i] = result
+        return results
+        
+    except gemini_api_error() as e:
+        st.error(f"Lỗi gọi Gemini API: {e}. Vui lòng kiểm tra Khóa API hoặc giới hạn sử dụng.")
+        return None
+    except (json.JSONDecodeError, ValueError):
+        st.error("Lỗi phân tích cú pháp JSON từ API. Vui lòng kiểm tra lại cấu trúc đề thi trong file Word.")
+        return None
+    except Exception as e:
+        st.error(f"Đã xảy ra lỗi không xác định trong quá trình phân tích: {e}")
+        return None
+
+@st.cache_data(show_spinner="Đang phân tích cấu trúc đề thi với AI...")
+def parse_quiz_data_with_gemini(raw_text, api_key, chunk_tokens=GEMINI_CHUNK_TOKENS, _client=None, _tokens=None):
+    """
+    Sử dụng Gemini API để phân tích cú pháp (parse) văn bản thô thành cấu trúc JSON.
+    Cần đảm bảo file Word có cấu trúc rõ ràng (ví dụ: Câu 1, A, B, C, D, Đáp án đúng là X).
+    Văn bản được rút gọn (bỏ số trang, phần thủ tục, header/footer lặp lại) rồi chia thành nhiều
+    đoạn trong hạn mức token và gọi song song; kết quả từng đoạn được lưu trong cache trên đĩa nên
+    file đã phân tích trước đó trả về ngay, không gọi API. `_tokens` (TokenUsage) nhận số token.
+    """
+    if not raw_text:
+        return []
+
+    chunks, = prepare_gemini_chunks([raw_text], chunk_tokens, _tokens)
+    results = gemini_parse_chunks(chunks, api_key, _client, _tokens)
+    if results is None:
+        return None
+    return [question for result in results for question in result]
+
+# --- PHÂN TÍCH CỤC BỘ (KHÔNG CẦN AI) ---
+
+OPTION_LABELS = ['A', 'B', 'C', 'D', 'E', 'F']
+
+QUESTION_LINE_RE = re.compile(r'^\s*Câu\s*(\d+)\s*[:.)\-]?\s*(.*)$', re.IGNORECASE | re.DOTALL)
+OPTION_MARKER_RE = re.compile(r'(?:^|(?<=\s))(\*?)([A-F])\s*[.)]\s*')
+ANSWER_LINE_RE = re.compile(
+    r'^\s*(?:Đáp\s*án(?:\s*đúng)?(?:\s*là)?|ĐA|Chọn)\s*[:.\-]?\s*\(?([A-F])\b', re.IGNORECASE
+)
+ANSWER_KEY_HEADER_RE = re.compile(r'^\s*(?:BẢNG\s+)?ĐÁP\s+ÁN\s*:?\s*$', re.IGNORECASE)
+ANSWER_KEY_PAIR_RE = re.compile(r'(\d+)\s*[.\-:)|\t]?\s*([A-F])\b', re.IGNORECASE)
+ANSWER_KEY_LINE_RE = re.compile(r'^\s*(?:\d+\s*[.\-:)|\t]?\s*[A-F]\b[\s,;|]*)+$', re.IGNORECASE)
+SECTION_LINE_RE = re.compile(r'^\s*(?:PHẦN|CHƯƠNG|BÀI)\s+[\dIVXLC]+\b', re.IGNORECASE)
+# Bảng đáp án nằm ngang: hàng số câu ("Câu | 1 | 2 | 3") rồi hàng đáp án ("Đáp án | B | C | D")
+KEY_ROW_NUMBERS_LABEL_RE = re.compile(r'^(?:Câu(?:\s*hỏi)?|Số\s*câu|STT)\s*[:.]?$', re.IGNORECASE)
+KEY_ROW_LETTERS_LABEL_RE = re.compile(r'^(?:Đáp\s*án(?:\s*đúng)?|ĐA|Chọn)\s*[:.]?$', re.IGNORECASE)
+# Lời giải / hướng dẫn giải ghi sau dòng đáp án (bỏ qua tới câu hỏi kế tiếp)
+EXPLANATION_LINE_RE = re.compile(
+    r'^\s*(?:(?:Lời\s*giải|Hướng\s*dẫn\s*giải|Giải\s*thích)\b|(?:Giải(?:\s*chi\s*tiết)?|HDG?|Hướng\s*dẫn)\s*[:.\-])',
+    re.IGNORECASE
+)
+
+def _find_option_markers(text, next_label, at_line_start=True):
+    """
+    Tìm các nhãn lựa chọn (A. B) ...) xuất hiện đúng thứ tự bắt đầu từ `next_label`.
+    Trả về list (label_index, marker_start, text_start, starred). Dấu * trước nhãn đánh dấu đáp án đúng.
+    """
+    markers = []
+    expected = next_label
+    for m in OPTION_MARKER_RE.finditer(text):
+        if m.group(2) != OPTION_LABELS[expected]:
+            continue
+        if not markers and at_line_start and text[:m.start()].strip():
+            break
+        markers.append((expected, m.start(), m.end(), bool(m.group(1))))
+        expected += 1
+        if expected >= len(OPTION_LABELS):
+            break
+    return markers
+
+def _span_is_marked(marks, start, end, text):
+    """Một lựa chọn được coi là đánh dấu nếu ít nhất một nửa ký tự (không tính khoảng trắng) nằm trong marks."""
+    length = len(text[start:end].strip())
+    if not length or not marks:
+        return False
+    covered = sum(max(0, min(end, m_end) - max(start, m_start)) for m_start, m_end in marks)
+    return covered * 2 >= length
+
+def _add_options(question, text, marks, markers):
+    """Tách một dòng thành các lựa chọn theo vị trí nhãn và ghi nhận lựa chọn được đánh dấu."""
+    for k, (label_index, _, text_start, starred) in enumerate(markers):
+        end = markers[k + 1][1] if k + 1 < len(markers) else len(text)
+        question['options'].append({
+            'text': text[text_start:end].strip(),
+            'marked': _span_is_marked(marks, text_start, end, text),
+            'starred': starred,
+        })
+
+def _answer_key_row(text):
+    """
+    Nhận diện một hàng của bảng đáp án nằm ngang (các ô cách nhau bởi tab, xem _row_blocks). Trả về
+    ('numbers', [số câu]) hoặc ('letters', [đáp án]) nếu mọi ô (trừ ô nhãn đầu hàng) là số câu / chữ
+    cái đáp án, ngược lại None.
+    """
+    if "\t" not in text:
+        return None
+    cells = [cell.strip() for cell in text.split("\t") if cell.strip()]
+    label = None
+    if cells and not cells[0].isdigit() and len(cells[0]) > 1:
+        label, cells = cells[0], cells[1:]
+    if len(cells) < (1 if label else 2):
+        return None
+    if all(cell.isdigit() for cell in cells) and (label is None or KEY_ROW_NUMBERS_LABEL_RE.match(label)):
+        return 'numbers', [int(cell) for cell in cells]
+    if all(len(cell) == 1 and cell.upper() in OPTION_LABELS for cell in cells) and (
+        label is None or KEY_ROW_LETTERS_LABEL_RE.match(label)
+    ):
+        return 'letters', [cell.upper() for cell in cells]
+    return None
+
+def _resolve_local_question(question, answer_key):
+    """Xác định đáp án và độ tin cậy của một câu phân tích cục bộ. Trả về dict chuẩn hoặc None nếu không chắc chắn."""
+    options = question['options']
+    text = " ".join(question['question']).strip()
+    if question['broken'] or not text or len(options) < 2 or any(not opt['text'] for opt in options):
+        return None
+
+    explicit = question['answer'] or answer_key.get(question['number'])
+    starred = [i for i, opt in enumerate(options) if opt['starred']]
+    marked = [i for i, opt in enumerate(options) if opt['marked']]
+    # Cả dòng được in đậm thì định dạng không mang thông tin về đáp án
+    if len(marked) == len(options):
+        marked = []
+    flagged = starred or marked
+
+    if explicit:
+        index = OPTION_LABELS.index(explicit)
+        if index >= len(options) or (flagged and flagged != [index]):
+            return None
+    elif len(flagged) == 1:
+        index = flagged[0]
+    else:
+        return None
+
+    return {
+        'question': text,
+        'options': [opt['text'] for opt in options],
+        'correct_answer': OPTION_LABELS[index],
+    }
+
+def parse_quiz_locally(blocks):
+    """
+    Phân tích đề theo quy tắc (máy trạng thái) cho bố cục phổ biến: "Câu N:", lựa chọn "A." đến "F.",
+    đáp án ghi "Đáp án: X" / "Đáp án đúng là X", bảng đáp án cuối đề, hoặc lựa chọn được đánh dấu
+    (in đậm/gạch chân/tô sáng, dấu *). `blocks` là iterable các tuple (text, marks), thường là
+    generator từ iter_docx_blocks nên file được phân tích ngay trong lúc đọc.
+
+    Trả về list các mục theo thứ tự xuất hiện: ('local', question_dict) với câu chắc chắn, hoặc
+    ('remote', segment_text) với đoạn độ tin cậy thấp cần gửi Gemini. Nếu không tìm thấy câu nào
+    theo mẫu, toàn bộ văn bản là một đoạn 'remote'.
+    """
+    questions = []
+    answer_key = {}
+    current = None
+    in_key_section = False
+    key_numbers = None # hàng số câu của bảng đáp án nằm ngang, chờ hàng đáp án ngay sau
+    # Chỉ giữ các dòng trước câu hỏi đầu tiên (cho trường hợp không nhận diện được câu nào)
+    all_lines = []
+
+    for text, marks in blocks:
+        if not questions:
+            all_lines.append(text)
+
+        # Hàng "Câu | 1 | 2 | 3" của bảng đáp án không phải câu hỏi 1
+        key_row = _answer_key_row(text)
+        if key_row is not None and key_row[0] == 'numbers':
+            key_numbers = key_row[1]
+            current = None
+            continue
+        if key_row is not None and key_numbers is not None and len(key_row[1]) == len(key_numbers):
+            answer_key.update(zip(key_numbers, key_row[1]))
+            key_numbers = None
+            continue
+        key_numbers = None
+
+        m = QUESTION_LINE_RE.match(text)
+        if m:
+            in_key_section = False
+            current = {
+                'number': int(m.group(1)), 'question': [], 'options': [],
+                'answer': None, 'broken': False, 'explanation': False, 'lines': [text],
+            }
+            questions.append(current)
+            rest_start = m.start(2)
+            rest = text[rest_start:]
+            # Lựa chọn có thể nằm ngay trên dòng câu hỏi: "Câu 1: 2 + 2 = ? A. 3 B. 4"
+            markers = _find_option_markers(rest, 0, at_line_start=False)
+            if len(markers) >= 2:
+                current['question'].append(rest[:markers[0][1]].strip())
+                markers = [(i, start + rest_start, end + rest_start, starred) for i, start, end, starred in markers]
+                _add_options(current, text, marks, markers)
+            else:
+                current['question'].append(rest.strip())
+            continue
+
+        if ANSWER_KEY_HEADER_RE.match(text) or (ANSWER_KEY_LINE_RE.match(text) and len(ANSWER_KEY_PAIR_RE.findall(text)) >= 2):
+            in_key_section = True
+            current = None
+        if in_key_section:
+            if ANSWER_KEY_LINE_RE.match(text):
+                for number, letter in ANSWER_KEY_PAIR_RE.findall(text):
+                    answer_key[int(number)] = letter.upper()
+            continue
+
+        if SECTION_LINE_RE.match(text):
+            current = None
+            continue
+
+        if current is None or current['explanation']:
+            continue
+        current['lines'].append(text)
+
+        m = ANSWER_LINE_RE.match(text)
+        if m:
+            if current['answer'] and current['answer'] != m.group(1).upper():
+                current['broken'] = True
+            current['answer'] = m.group(1).upper()
+            continue
+        if current['answer']:
+            # Dòng đáp án kết thúc câu hỏi: lời giải phía sau được bỏ qua, dòng thủ tục (số trang...) cũng
+            # vậy; dòng khác không rõ thuộc phần nào nên cả câu được gửi Gemini thay vì ghép vào lựa chọn
+            if EXPLANATION_LINE_RE.match(text):
+                current['explanation'] = True
+            elif text.strip() and not NOISE_LINE_RE.match(" ".join(text.split())):
+                current['broken'] = True
+            continue
+
+        markers = _find_option_markers(text, len(current['options']))
+        if markers:
+            _add_options(current, text, marks, markers)
+        elif OPTION_MARKER_RE.match(text):
+            # Nhãn lựa chọn sai thứ tự (lặp lại hoặc nhảy cóc)
+            current['broken'] = True
+        elif current['options']:
+            # Dòng tiếp nối của lựa chọn cuối cùng
+            current['options'][-1]['text'] += " " + text.strip()
+        else:
+            current['question'].append(text.strip())
+
+    if not questions:
+        raw_text = "\n".join(all_lines)
+        return [('remote', raw_text)] if raw_text.strip() else []
+
+    entries = []
+    for question in questions:
+        resolved = _resolve_local_question(question, answer_key)
+        if resolved is not None:
+            entries.append(('local', resolved))
+        else:
+            entries.append(('remote', "\n".join(question['lines'])))
+    return entries
+
+def plan_quiz_document(blocks, chunk_tokens=GEMINI_CHUNK_TOKENS, tokens=None):
+    """
+    Chạy bộ phân tích cục bộ và lập kế hoạch gọi Gemini. Trả về (plan, chunks, low_confidence):
+    `plan` là list theo thứ tự gốc gồm ('local', question_dict) hoặc ('remote', range chỉ số đoạn),
+    `chunks` là các đoạn văn bản cần gửi Gemini (các đoạn 'remote' liên tiếp được gộp, rút gọn rồi
+    chia theo giới hạn token; số token ước tính trước/sau khi rút gọn cộng vào `tokens`).
+    """
+    with metric_span("quiz_stage", stage="local_parse"):
+        entries = parse_quiz_locally(timed_iter(blocks, "quiz_stage", stage="read_docx"))
+
+    plan = []
+    chunks = []
+    low_confidence = 0
+    for kind, value in entries:
+        if kind == 'local':
+            plan.append(('local', value))
+            continue
+        low_confidence += 1
+        if plan and plan[-1][0] == 'remote':
+            plan[-1][1].append(value)
+        else:
+            plan.append(('remote', [value]))
+
+    remote = [i for i, (kind, _) in enumerate(plan) if kind == 'remote']
+    prepared = prepare_gemini_chunks(["\n".join(plan[i][1]) for i in remote], chunk_tokens, tokens)
+    for i, run_chunks in zip(remote, prepared):
+        plan[i] = ('remote', range(len(chunks), len(chunks) + len(run_chunks)))
+        chunks.extend(run_chunks)
+
+    return plan, chunks, low_confidence
+
+# --- PHÂN TÍCH DẠNG LUỒNG (STREAMING) ---
+
+# Bật chế độ streaming: câu hỏi được thêm dần vào đề trong khi Gemini vẫn đang trả kết quả.
+# Khi tắt, mỗi đoạn được gửi bằng một lời gọi thường và thêm vào đề khi đoạn đó hoàn tất.
+GEMINI_STREAMING = os.environ.get("QUIZ_STREAMING", "1") != "0"
+# Số câu tối thiểu cần có trước khi mở menu ôn luyện
+STREAM_MIN_QUESTIONS = int(os.environ.get("QUIZ_STREAM_MIN_QUESTIONS", "5"))
+
+class JsonArrayStreamDecoder:
+    """
+    Giải mã tăng dần một mảng JSON nhận theo từng mảnh văn bản: feed() trả về các phần tử
+    đã hoàn chỉnh, phần còn dở được giữ lại trong bộ đệm cho lần feed tiếp theo.
+    """
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._started = False
+        self.finished = False
+
+    def feed(self, text):
+        self._buffer += text
+        items = []
+        pos = 0
+        buffer = self._buffer
+        while not self.finished:
+            skip = " \t\r\n," if self._started else " \t\r\n"
+            while pos < len(buffer) and buffer[pos] in skip:
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if not self._started:
+                if buffer[pos] != "[":
+                    raise json.JSONDecodeError("Kết quả không bắt đầu bằng mảng JSON", buffer, pos)
+                self._started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                self.finished = True
+                pos += 1
+                break
+            try:
+                item, pos = self._decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Phần tử chưa nhận đủ
+                break
+            items.append(item)
+        self._buffer = buffer[pos:]
+        return items
+
+    def close(self):
+        """Kiểm tra mảng đã kết thúc hợp lệ."""
+        if not self.finished:
+            raise json.JSONDecodeError("Mảng JSON chưa kết thúc", self._buffer, len(self._buffer))
+
+def _stream_chunk_with_gemini(client, chunk_text, tokens=None):
+    """
+    Gọi Gemini dạng streaming cho một đoạn, sinh ra từng câu hỏi ngay khi giải mã xong; lưu cache khi
+    hoàn tất. Nếu cùng đoạn đó đang được phân tích ở nơi khác, chờ và dùng chung kết quả.
+    """
+    key = parse_cache_key(chunk_text)
+    cached = parse_cache_get(key)
+    if cached is not None:
+        yield from cached
+        return
+
+    flight, leader = _GEMINI.join(key)
+    if not leader:
+        yield from flight.result()
+        return
+    parsed_data = None
+    try:
+        parsed_data = yield from _request_chunk_stream(client, chunk_text, key, tokens)
+    except Exception as e:
+        _GEMINI.land(key, flight, error=e)
+        raise
+    finally:
+        if parsed_data is None and not flight.done():
+            # Bên đọc dừng giữa chừng: các bên đang chờ tự gọi lại (lỗi ValueError được thử lại)
+            _GEMINI.land(key, flight, error=ValueError("Phân tích đoạn bị dừng giữa chừng."))
+    _GEMINI.land(key, flight, parsed_data)
+
+def _request_chunk_stream(client, chunk_text, key, tokens=None):
+    user_prompt = gemini_user_prompt(chunk_text)
+    config = {
+        "response_mime_type": "application/json",
+        "response_schema": GEMINI_RESPONSE_SCHEMA,
+        "system_instruction": GEMINI_SYSTEM_INSTRUCTION
+    }
+    decoder = JsonArrayStreamDecoder()
+    parsed_data = []
+    response = None
+    # Chỉ chiếm hạn mức ở đây; lỗi tạm thời được _run_parse_stream thử lại với backoff
+    _GEMINI.acquire(gemini_request_tokens(client, user_prompt))
+    metric_inc("quiz_gemini_requests_total", kind="stream")
+    with metric_span("quiz_gemini_call", kind="stream"):
+        for response in client.models.generate_content_stream(
+            model=GEMINI_MODEL,
+            contents=user_prompt,
+            config=config
+        ):
+            with metric_span("quiz_stage", stage="json_decode"):
+                items = decoder.feed(response.text or "")
+            for item in items:
+                parsed_data.append(item)
+                yield item
+    # Phản hồi cuối cùng của luồng mang usage_metadata tổng
+    record_gemini_usage(response, "stream", tokens)
+    decoder.close()
+    parse_cache_put(key, parsed_data)
+    return parsed_data
+
+def validate_question(item):
+    """
+    Chuẩn hóa một câu hỏi do Gemini trả về; None nếu không dùng được (không phải object, thiếu nội
+    dung câu hỏi, hoặc ít hơn 2 lựa chọn).
+    """
+    if not isinstance(item, dict):
+        return None
+    question = item.get('question')
+    options = item.get('options')
+    if not isinstance(question, str) or not question.strip() or not isinstance(options, list):
+        return None
+    options = [str(option).strip() for option in options if option is not None and str(option).strip()]
+    if len(options) < 2:
+        return None
+    answer = item.get('correct_answer')
+    return {
+        'question': question.strip(),
+        'options': options,
+        'correct_answer': answer.strip() if isinstance(answer, str) else '',
+    }
+
+class ParseStream:
+    """
+    Trạng thái một lần phân tích dạng luồng, dùng chung giữa luồng nền và script Streamlit.
+    `questions` chỉ được nối thêm theo đúng thứ tự gốc: câu cục bộ có ngay, câu từ Gemini của
+    đoạn sau được giữ trong bộ đệm cho tới khi các đoạn trước hoàn tất.
+    """
+
+    def __init__(self, plan, chunks, low_confidence, tokens=None):
+        self.plan = plan
+        self.chunks = chunks
+        self.low_confidence = low_confidence
+        self.tokens = tokens if tokens is not None else TokenUsage()
+        self.questions = []
+        self.local_count = 0
+        self.chunks_done = 0
+        self.invalid = 0 # số câu Gemini trả về nhưng không hợp lệ (đã bỏ)
+        self.error = None
+        self.done = False
+        self.cancelled = False
+        self._buffers = [[] for _ in chunks]
+        self._received = [0] * len(chunks) # số phần tử đã nhận (kể cả không hợp lệ) của từng đoạn
+        self._chunk_done = [False] * len(chunks)
+        self._cursor = 0 # vị trí trong plan
+        self._chunk_cursor = 0 # đoạn hiện tại trong mục 'remote' đang xuất
+        self._emitted = 0 # số câu của đoạn hiện tại đã xuất
+        self._cond = threading.Condition()
+
+    @property
+    def total_chunks(self):
+        return len(self.chunks)
+
+    @property
+    def report(self):
+        return {
+            'local': self.local_count,
+            'remote': len(self.questions) - self.local_count,
+            'low_confidence': self.low_confidence,
+            'invalid': self.invalid,
+            **self.tokens.report(),
+        }
+
+    def _publish(self):
+        """Đẩy các câu đã sẵn sàng theo thứ tự vào `questions` (gọi khi đang giữ khóa)."""
+        while self._cursor < len(self.plan):
+            kind, value = self.plan[self._cursor]
+            if kind == 'local':
+                self.questions.append(value)
+                self.local_count += 1
+                self._cursor += 1
+                continue
+            chunk_index = value[self._chunk_cursor]
+            buffer = self._buffers[chunk_index]
+            self.questions.extend(buffer[self._emitted:])
+            self._emitted = len(buffer)
+            if not self._chunk_done[chunk_index]:
+                break
+            self._emitted = 0
+            self._chunk_cursor += 1
+            if self._chunk_cursor >= len(value):
+                self._chunk_cursor = 0
+                self._cursor += 1
+        self._cond.notify_all()
+
+    def add_item(self, chunk_index, item):
+        question = validate_question(item)
+        with self._cond:
+            self._received[chunk_index] += 1
+            if question is None:
+                self.invalid += 1
+                return
+            self._buffers[chunk_index].append(question)
+            self._publish()
+
+    def finish_chunk(self, chunk_index):
+        with self._cond:
+            self._chunk_done[chunk_index] = True
+            self.chunks_done += 1
+            self._publish()
+
+    def cancel(self):
+        """Yêu cầu dừng: các đoạn chưa xong không gọi/đọc thêm; câu đã xuất được giữ nguyên."""
+        with self._cond:
+            self.cancelled = True
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        with self._cond:
+            self.error = error
+            self.done = True
+            self._cond.notify_all()
+
+    def wait_for(self, count, timeout=None):
+        """Chờ tới khi có ít nhất `count` câu hoặc quá trình phân tích kết thúc."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.done or len(self.questions) >= count, timeout)
+            return len(self.questions)
+
+def _run_parse_stream(stream, client, max_workers=GEMINI_MAX_WORKERS, retries=GEMINI_CHUNK_RETRIES):
+    """
+    Chạy trong luồng nền: phân tích song song từng đoạn (streaming hoặc lời gọi thường, theo
+    GEMINI_STREAMING), thử lại riêng đoạn lỗi, rồi đánh dấu hoàn tất. Dừng sớm khi stream bị hủy.
+    """
+    fetch = _stream_chunk_with_gemini if GEMINI_STREAMING else _parse_chunk_with_gemini
+
+    def consume(chunk_index):
+        attempt = api_attempt = 0
+        while not stream.cancelled:
+            received = 0
+            try:
+                for item in fetch(client, stream.chunks[chunk_index], stream.tokens):
+                    if stream.cancelled:
+                        return
+                    received += 1
+                    # Khi thử lại, bỏ qua các câu đã nhận ở lần trước
+                    if received > stream._received[chunk_index]:
+                        stream.add_item(chunk_index, item)
+                stream.finish_chunk(chunk_index)
+                return
+            except gemini_api_error() as e:
+                metric_inc("quiz_gemini_errors_total", kind="stream")
+                if not _GEMINI.is_retryable(e) or api_attempt >= _GEMINI.max_retries:
+                    raise
+                _GEMINI.backoff(api_attempt)
+                api_attempt += 1
+            except (json.JSONDecodeError, ValueError):
+                metric_inc("quiz_gemini_errors_total", kind="stream")
+                if attempt == retries:
+                    raise
+                metric_inc("quiz_gemini_retries_total", kind="stream")
+                attempt += 1
+
+    try:
+        with stream._cond:
+            stream._publish()
+        if stream.chunks:
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(stream.chunks)))) as pool:
+                for future in [pool.submit(consume, i) for i in range(len(stream.chunks))]:
+                    future.result()
+        stream.finish()
+    except Exception as e:
+        stream.finish(e)
+
+# --- HÀNG ĐỢI PHÂN TÍCH NỀN (NHIỀU FILE) ---
+
+# Số file được phân tích đồng thời trên toàn tiến trình (mỗi file còn tự gọi Gemini song song theo đoạn)
+PARSE_JOB_WORKERS = int(os.environ.get("QUIZ_JOB_WORKERS", "4"))
+# Thời gian tối đa script chờ những câu đầu tiên trước khi chuyển sang hiển thị tiến độ
+PARSE_FIRST_WAIT = 1.5
+
+def is_qbank_name(file_name):
+    return file_name.lower().endswith(".qbank")
+
+class ParseJob:
+    """
+    Một file .docx trong hàng đợi: đọc → phân tích (cục bộ + Gemini) → kiểm tra từng câu, chạy trên
+    worker nền. `stage`: queued | reading | parsing | done | failed | cancelled.
+    """
+
+    FINAL_STAGES = ('done', 'failed', 'cancelled')
+
+    def __init__(self, name, data):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.data = data # nội dung file; bỏ đi sau khi đọc xong
+        self.stage = 'queued'
+        self.stream = None
+        self.error = None
+        self.future = None
+        self.imported = is_qbank_name(name) # file .qbank đã biên dịch sẵn
+        self.cached = False # kết quả cả file lấy từ cache (không phân tích lại)
+        self._cancel = threading.Event()
+
+    @property
+    def questions(self):
+        return self.stream.questions if self.stream is not None else []
+
+    @property
+    def finished(self):
+        return self.stage in self.FINAL_STAGES
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def cancel(self):
+        self._cancel.set()
+        if self.future is not None and self.future.cancel():
+            # Chưa tới lượt chạy: hủy ngay
+            self.stage = 'cancelled'
+        stream = self.stream
+        if stream is not None:
+            stream.cancel()
+
+    def fail(self, error):
+        self.error = error
+        self.stage = 'failed'
+
+def _run_parse_job(job, api_key, client=None):
+    """Chạy trên worker của hàng đợi. Không gọi API của Streamlit (luồng nền)."""
+    if job.cancelled:
+        job.stage = 'cancelled'
+        return
+    job.stage = 'reading'
+    file_key = file_cache_key(job.data)
+    tokens = TokenUsage()
+    try:
+        cached = parse_cache_get(file_key)
+        if cached is not None:
+            job.cached = True
+            plan, chunks, low_confidence = [('local', question) for question in cached], [], 0
+        elif job.imported:
+            # Đề đã biên dịch: không cần phân tích, chỉ gộp lại theo thứ tự file
+            plan = [('local', question) for question in load_qbank(job.data).to_quiz_data()]
+            chunks, low_confidence = [], 0
+        else:
+            with metric_span("quiz_stage", stage="job_plan"):
+                plan, chunks, low_confidence = plan_quiz_document(
+                    iter_docx_blocks(io.BytesIO(job.data)), tokens=tokens
+                )
+    except (zipfile.BadZipFile, KeyError, ElementTree.ParseError) as e:
+        job.fail(f"Lỗi đọc file Word: {e}")
+        return
+    except ValueError as e:
+        job.fail(str(e))
+        return
+    finally:
+        job.data = None
+
+    if chunks and client is None:
+        if api_key:
+            client = _GEMINI.client(api_key)
+        elif any(parse_cache_get(parse_cache_key(chunk)) is None for chunk in chunks):
+            job.fail("Không tìm thấy Khóa API. Vui lòng cấu hình Khóa 'GEMINI_API_KEY' trong Streamlit Secrets.")
+            return
+
+    stream = ParseStream(plan, chunks, low_confidence, tokens)
+    job.stream = stream
+    if job.cancelled:
+        stream.cancel()
+    job.stage = 'parsing'
+    _run_parse_stream(stream, client)
+
+    if job.cancelled:
+        job.stage = 'cancelled'
+    elif stream.error is not None:
+        job.fail(f"Phân tích bị gián đoạn sau {len(stream.questions)} câu: {stream.error}")
+    elif not stream.questions:
+        job.fail("Không tìm thấy câu hỏi nào hoặc cấu trúc đề thi không rõ ràng.")
+    else:
+        if not job.cached:
+            # Lần sau tải lại đúng file này (ở bất kỳ phiên nào) không cần đọc hay phân tích nữa
+            parse_cache_put(file_key, stream.questions)
+        job.stage = 'done'
+
+def prewarm_file(path, api_key=None):
+    """Phân tích một file đề như một job (đồng bộ) để lưu kết quả vào cache. Trả về (tên, số câu, lỗi)."""
+    with open(path, "rb") as f:
+        job = ParseJob(os.path.basename(path), f.read())
+    _run_parse_job(job, api_key or API_KEY)
+    return job.name, len(job.questions), job.error
+
+class ParseJobQueue:
+    """Worker pool giới hạn, dùng chung toàn tiến trình, phân tích các file .docx của mọi phiên."""
+
+    def __init__(self, max_workers=PARSE_JOB_WORKERS):
+        self._pool = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="quiz-parse")
+        self._jobs = set()
+        self._lock = threading.Lock()
+
+    def submit(self, job, api_key, client=None):
+        with self._lock:
+            self._jobs.add(job)
+        job.future = self._pool.submit(_run_parse_job, job, api_key, client)
+        job.future.add_done_callback(lambda future: self._forget(job))
+        return job
+
+    def _forget(self, job):
+        with self._lock:
+            self._jobs.discard(job)
+
+    def stats(self):
+        """Số job đang chờ / đang chạy."""
+        with self._lock:
+            jobs = list(self._jobs)
+        queued = sum(1 for job in jobs if job.stage == 'queued')
+        return {'queued': queued, 'running': len(jobs) - queued}
+
+@st.cache_resource
+def get_parse_job_queue():
+    return ParseJobQueue()
+
+def cancel_parse_jobs():
+    for job in st.session_state.parse_jobs:
+        job.cancel()
+
+def reset_parse_state(uploaded_files):
+    """Hủy các job cũ của phiên và bỏ đề hiện tại trước khi nạp bộ file mới."""
+    cancel_parse_jobs()
+    release_bank(st.session_state.bank_id)
+    st.session_state.bank_id = None
+    st.session_state.pending_bank = QuizBank()
+    st.session_state.parse_report = None
+    st.session_state.parse_jobs = []
+    st.session_state.parse_merged = []
+    st.session_state.parse_file_ids = tuple(uploaded_file.file_id for uploaded_file in uploaded_files)
+
+def start_parse_jobs(uploaded_files, api_key, _client=None):
+    """Đưa mỗi file vào hàng đợi thành một job (giữ thứ tự); các job cũ của phiên bị hủy."""
+    reset_parse_state(uploaded_files)
+    queue = get_parse_job_queue()
+    st.session_state.parse_jobs = [
+        queue.submit(ParseJob(uploaded_file.name, uploaded_file.getvalue()), api_key, _client)
+        for uploaded_file in uploaded_files
+    ]
+    st.session_state.parse_merged = [0] * len(uploaded_files)
+
+def import_qbank_file(uploaded_file):
+    """Nạp trực tiếp một file .qbank (không qua hàng đợi): đề được dùng ngay, không sao chép nội dung."""
+    reset_parse_state([uploaded_file])
+    try:
+        with metric_span("quiz_stage", stage="qbank_load"):
+            bank = load_qbank(uploaded_file.getvalue())
+    except ValueError as e:
+        st.session_state.parse_report = dict(EMPTY_PARSE_REPORT, files=1, errors=[f"{uploaded_file.name}: {e}"])
+        return None
+    publish_bank(bank, uploaded_file.name)
+    st.session_state.parse_report = dict(
+        EMPTY_PARSE_REPORT, files=1, imported=len(bank), errors=[], sources=[(uploaded_file.name, 0, len(bank))]
+    )
+    return bank
+
+def wait_for_first_questions(count, timeout=PARSE_FIRST_WAIT):
+    """Chờ (có giới hạn) tới khi job đầu tiên còn chạy có đủ `count` câu hoặc mọi job kết thúc."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        jobs = [job for job in st.session_state.parse_jobs if not job.finished]
+        if not jobs:
+            return
+        if len(jobs[0].questions) >= count:
+            return
+        time.sleep(0.02)
+
+EMPTY_PARSE_REPORT = {
+    'local': 0, 'remote': 0, 'low_confidence': 0, 'invalid': 0, 'imported': 0, 'cached': 0, 'files': 0,
+    'sources': (), # [(tên file, câu đầu, câu cuối + 1)]: khoảng câu của từng file trong đề đã gộp
+    # Token gửi Gemini: ước tính trước/sau khi rút gọn, và số thực tế Gemini báo về (prompt/đầu ra)
+    'tokens_raw': 0, 'tokens_sent': 0, 'tokens_prompt': 0, 'tokens_output': 0,
+    'token_files': (), # [(tên file, tokens_raw, tokens_sent, tokens_prompt, tokens_output)]
+}
+
+def merge_parse_reports(jobs):
+    report = dict(EMPTY_PARSE_REPORT, files=len(jobs), errors=[], token_files=[])
+    for job in jobs:
+        if job.cached:
+            report['cached'] += len(job.questions)
+        elif job.imported:
+            report['imported'] += len(job.questions)
+        elif job.stream is not None:
+            stream_report = job.stream.report
+            for key, value in stream_report.items():
+                report[key] += value
+            if stream_report['tokens_raw']:
+                report['token_files'].append((
+                    job.name, stream_report['tokens_raw'], stream_report['tokens_sent'],
+                    stream_report['tokens_prompt'], stream_report['tokens_output'],
+                ))
+        if job.stage == 'cancelled':
+            report['errors'].append(f"{job.name}: đã hủy")
+        elif job.error is not None:
+            report['errors'].append(f"{job.name}: {job.error}")
+    return report
+
+def sync_parse_jobs():
+    """
+    Gộp các câu mới từ các job vào đề tạm của phiên (st.session_state.pending_bank) theo đúng thứ tự
+    file: câu của file sau chỉ được thêm khi các file trước đã kết thúc. Khi mọi job kết thúc, đề được
+    đưa vào kho dùng chung.
+    """
+    jobs = st.session_state.get('parse_jobs')
+    if not jobs:
+        return
+    bank = st.session_state.pending_bank
+    merged = st.session_state.parse_merged
+    for i, job in enumerate(jobs):
+        # Đọc trạng thái trước rồi mới lấy câu: job đã kết thúc thì không còn câu nào tới sau
+        finished = job.finished
+        new_questions = job.questions[merged[i]:]
+        if new_questions:
+            bank.extend(new_questions)
+            merged[i] += len(new_questions)
+        if not finished:
+            return
+    st.session_state.parse_report = report = merge_parse_reports(jobs)
+    st.session_state.parse_jobs = []
+    # Câu của mỗi file nằm liên tiếp trong đề, theo thứ tự file
+    bounds = np.cumsum([0] + merged)
+    if len(bank) and DEDUP_ENABLED:
+        with metric_span("quiz_stage", stage="dedup"):
+            bank, report['dedup'], index_map = dedupe_bank(bank)
+        # Câu giữ lại không đổi thứ tự nên khoảng của mỗi file chỉ co lại: đếm số câu giữ lại trước mỗi mốc
+        kept = np.maximum.accumulate(np.asarray(index_map, dtype=np.int64)) + 1
+        bounds = np.concatenate(([0], kept))[bounds]
+        if st.session_state.current_mode == 'study' and st.session_state.current_index < len(index_map):
+            # Đang ôn luyện trên đề tạm: giữ nguyên câu đang xem sau khi đánh số lại
+            st.session_state.current_index = index_map[st.session_state.current_index]
+    report['sources'] = [(job.name, int(start), int(stop)) for job, start, stop in zip(jobs, bounds[:-1], bounds[1:])]
+    if len(bank):
+        publish_bank(bank, ", ".join(job.name for job in jobs))
+
+def parse_in_progress():
+    return bool(st.session_state.get('parse_jobs'))
+
+def bank_ready_for_menu():
+    """Đủ câu để mở menu: ít nhất STREAM_MIN_QUESTIONS câu, hoặc đã phân tích xong và có ít nhất một câu."""
+    count = len(current_bank())
+    return count >= STREAM_MIN_QUESTIONS or (count > 0 and not parse_in_progress())
+
+JOB_STAGE_LABELS = {
+    'queued': "⏳ Đang chờ", 'reading': "📄 Đang đọc file", 'parsing': "🤖 Đang phân tích",
+    'done': "✅ Xong", 'failed': "❌ Lỗi", 'cancelled': "⛔ Đã hủy",
+}
+
+@st.fragment(run_every=1)
+@instrument_render
+def render_parse_progress():
+    """Tiến độ từng file đang phân tích nền; tự cập nhật mỗi giây mà không chạy lại toàn bộ script."""
+    jobs = st.session_state.get('parse_jobs')
+    if not jobs:
+        return
+    sync_parse_jobs()
+    if not st.session_state.parse_jobs or (st.session_state.current_mode == 'upload' and bank_ready_for_menu()):
+        # Vừa hoàn tất (hoặc đã đủ vài câu đầu tiên): chạy lại toàn bộ để cập nhật tổng số câu và chế độ
+        if st.session_state.current_mode == 'upload' and bank_ready_for_menu():
+            set_mode('menu')
+        st.rerun()
+
+    st.caption(f"Đang phân tích {len(jobs)} file... đã có {len(current_bank())} câu")
+    for job in jobs:
+        stream = job.stream
+        col_name, col_progress, col_cancel = st.columns([3, 5, 1])
+        col_name.markdown(f"**{job.name}** · {JOB_STAGE_LABELS[job.stage]}")
+        if stream is not None and stream.total_chunks:
+            col_progress.progress(
+                stream.chunks_done / stream.total_chunks,
+                text=f"{len(stream.questions)} câu ({stream.chunks_done}/{stream.total_chunks} đoạn AI)"
+            )
+        elif stream is not None:
+            col_progress.progress(1.0, text=f"{len(stream.questions)} câu")
+        elif job.error:
+            col_progress.caption(job.error)
+        if not job.finished:
+            col_cancel.button("Hủy", key=f"cancel_job_{job.id}", on_click=job.cancel)
+    if len(jobs) > 1:
+        st.button("Hủy tất cả", key="cancel_all_jobs", on_click=cancel_parse_jobs)
+
+# --- ĐỀ THI ĐÃ BIÊN DỊCH (QUIZBANK) ---
+
+LABEL_PREFIX_RE = re.compile(r'^\s*([A-F])\s*[.):]\s*')
+
+def _normalize_option_text(text):
+    return " ".join(unicodedata.normalize("NFC", text).split()).casefold()
+
+def option_label(i):
+    """Nhãn hiển thị của lựa chọn thứ i (A, B, C...; từ lựa chọn thứ 7 dùng số thứ tự)."""
+    return OPTION_LABELS[i] if i < len(OPTION_LABELS) else str(i + 1)
+
+def _strip_option_labels(options):
+    """Bỏ tiền tố "A. ", "B) "... nếu mọi lựa chọn đều có tiền tố đúng thứ tự (Gemini đôi khi giữ lại nhãn)."""
+    matches = [LABEL_PREFIX_RE.match(opt) for opt in options]
+    if options and len(options) <= len(OPTION_LABELS) and all(
+        m and m.group(1) == OPTION_LABELS[i] for i, m in enumerate(matches)
+    ):
+        return [opt[m.end():] for opt, m in zip(options, matches)]
+    return options
+
+def resolve_correct_index(correct_key, options):
+    """
+    Xác định chỉ số lựa chọn đúng từ correct_answer (chữ cái, "B. nội dung" hoặc nội dung đáp án).
+    Trả về (index, None) hoặc (-1, lý do) nếu không xác định được hoặc khớp nhiều lựa chọn.
+    """
+    key = (correct_key or "").strip()
+    if not key:
+        return -1, "thiếu đáp án"
+
+    # Ưu tiên tìm theo chữ cái
+    if len(key) == 1 and key.upper() in OPTION_LABELS:
+        index = OPTION_LABELS.index(key.upper())
+        if index < len(options):
+            return index, None
+        return -1, f"đáp án {key} vượt quá số lựa chọn"
+
+    # So khớp chính xác theo nội dung (không dùng "in" để tránh nhầm lựa chọn chứa nhau)
+    normalized = _normalize_option_text(key)
+    matches = [i for i, opt in enumerate(options) if _normalize_option_text(opt) == normalized]
+    if not matches:
+        m = LABEL_PREFIX_RE.match(key)
+        if m and OPTION_LABELS.index(m.group(1)) < len(options):
+            return OPTION_LABELS.index(m.group(1)), None
+        return -1, f"đáp án \"{key}\" không khớp lựa chọn nào"
+    if len(matches) > 1:
+        return -1, f"đáp án \"{key}\" khớp nhiều lựa chọn"
+    return matches[0], None
+
+class QuizBank:
+    """
+    Đề thi được biên dịch một lần khi nạp, lưu dạng mảng song song: nội dung câu hỏi, toàn bộ lựa chọn
+    nối liền với bảng offset (lựa chọn của câu i là options[offsets[i]:offsets[i + 1]]) và chỉ số
+    lựa chọn đúng đã giải sẵn (-1 nếu không xác định). Hiển thị và chấm điểm không cần xử lý chuỗi.
+    """
+
+    __slots__ = ('questions', 'options', 'offsets', 'correct', 'ambiguous', 'frozen')
+
+    def __init__(self, quiz_data=()):
+        self.questions = []
+        self.options = []
+        self.offsets = array('I', [0])
+        self.correct = array('b')
+        self.ambiguous = {} # {chỉ số câu: (correct_answer gốc, lý do)}
+        self.frozen = False
+        self.extend(quiz_data)
+
+    def __len__(self):
+        return len(self.questions)
+
+    def append(self, question_data):
+        """Biên dịch và thêm một câu dạng {question, options, correct_answer}."""
+        if self.frozen:
+            raise TypeError("QuizBank đã được chia sẻ nên không thể sửa đổi.")
+        options = _strip_option_labels([str(opt).strip() for opt in question_data.get('options') or []])
+        index, reason = resolve_correct_index(str(question_data.get('correct_answer') or ""), options)
+        if reason is not None:
+            self.ambiguous[len(self.questions)] = (question_data.get('correct_answer'), reason)
+        self.questions.append(str(question_data.get('question') or "").strip())
+        self.options.extend(options)
+        self.offsets.append(len(self.options))
+        self.correct.append(index)
+
+    def extend(self, quiz_data):
+        for question_data in quiz_data:
+            self.append(question_data)
+
+    def question(self, i):
+        return self.questions[i]
+
+    def option_count(self, i):
+        return self.offsets[i + 1] - self.offsets[i]
+
+    def options_of(self, i):
+        return self.options[self.offsets[i]:self.offsets[i + 1]]
+
+    def option(self, i, k):
+        return self.options[self.offsets[i] + k]
+
+    def correct_index(self, i):
+        return self.correct[i]
+
+    def select(self, indices):
+        """Đề mới chỉ gồm các câu `indices` (theo thứ tự đã cho), sao chép dữ liệu đã biên dịch."""
+        bank = QuizBank()
+        for new_index, i in enumerate(indices):
+            bank.questions.append(self.questions[i])
+            bank.options.extend(self.options_of(i))
+            bank.offsets.append(len(bank.options))
+            bank.correct.append(self.correct[i])
+            if i in self.ambiguous:
+                bank.ambiguous[new_index] = self.ambiguous[i]
+        return bank
+
+    def freeze(self):
+        """Đánh dấu bất biến trước khi chia sẻ giữa các phiên."""
+        self.frozen = True
+        return self
+
+    def content_hash(self):
+        """Mã định danh theo nội dung (câu hỏi, lựa chọn, đáp án): hai file giống nhau cho cùng một mã."""
+        digest = hashlib.sha256()
+        digest.update("\0".join(self.questions).encode("utf-8"))
+        digest.update(b"\1")
+        digest.update("\0".join(self.options).encode("utf-8"))
+        digest.update(self.offsets.tobytes())
+        digest.update(self.correct.tobytes())
+        return digest.hexdigest()[:16]
+
+    def nbytes(self):
+        """Ước lượng bộ nhớ chiếm dụng (byte)."""
+        return (
+            sys.getsizeof(self.questions) + sum(map(sys.getsizeof, self.questions))
+            + sys.getsizeof(self.options) + sum(map(sys.getsizeof, self.options))
+            + sys.getsizeof(self.offsets) + sys.getsizeof(self.correct)
+        )
+
+    def to_quiz_data(self):
+        """Chuyển ngược về list dict {question, options, correct_answer} (VD: để xuất file)."""
+        return [
+            {
+                'question': self.questions[i],
+                'options': self.options_of(i),
+                'correct_answer': option_label(self.correct[i]) if self.correct[i] >= 0 else self.ambiguous[i][0],
+            }
+            for i in range(len(self))
+        ]
+
+def new_answer_sheet(size):
+    """Phiếu trả lời: mỗi câu một số nguyên nhỏ (chỉ số lựa chọn), -1 là chưa trả lời."""
+    return array('b', [-1]) * size
+
+# --- ĐỊNH DẠNG ĐỀ ĐÃ BIÊN DỊCH (.qbank) ---
+
+# File nhị phân little-endian, mọi vị trí tính từ đầu file:
+#   header (32 byte): magic "QBNK", version, số câu, số lựa chọn, số chuỗi, kích thước vùng chuỗi,
+#                     kích thước JSON các câu không xác định đáp án
+#   u32 × (số chuỗi + 1)  offset của từng chuỗi trong vùng chuỗi (bảng chuỗi đã intern, không trùng)
+#   u32 × số câu          mã chuỗi nội dung câu hỏi
+#   u32 × số lựa chọn     mã chuỗi của từng lựa chọn (nối liền như QuizBank.options)
+#   u32 × (số câu + 1)    offset lựa chọn (như QuizBank.offsets)
+#   i8  × số câu          chỉ số lựa chọn đúng (-1 nếu không xác định)
+#   JSON                  {"chỉ số câu": [correct_answer gốc, lý do]}
+#   UTF-8                 vùng chuỗi
+QBANK_MAGIC = b"QBNK"
+QBANK_VERSION = 1
+QBANK_HEADER = struct.Struct("<4sHHIIIII4x")
+# Kích thước khối khi kiểm tra UTF-8 vùng chuỗi lúc nạp (bộ nhớ tạm không phụ thuộc kích thước file)
+QBANK_VALIDATE_BLOCK = 1 << 20
+
+def export_qbank(bank):
+    """Đóng gói một đề (QuizBank hoặc MappedQuizBank) thành nội dung file .qbank (bytes)."""
+    interned = {}
+    def intern(text):
+        string_id = interned.get(text)
+        if string_id is None:
+            string_id = interned[text] = len(interned)
+        return string_id
+
+    question_ids = array('I', (intern(bank.question(i)) for i in range(len(bank))))
+    option_ids = array('I', (intern(option) for i in range(len(bank)) for option in bank.options_of(i)))
+    offsets = array('I', [0])
+    for i in range(len(bank)):
+        offsets.append(offsets[-1] + bank.option_count(i))
+    correct = array('b', (bank.correct_index(i) for i in range(len(bank))))
+
+    encoded = [text.encode("utf-8") for text in interned]
+    string_offsets = array('I', [0])
+    for data in encoded:
+        string_offsets.append(string_offsets[-1] + len(data))
+    ambiguous = json.dumps(
+        {str(i): list(value) for i, value in bank.ambiguous.items()}, ensure_ascii=False
+    ).encode("utf-8")
+    tables = [string_offsets, question_ids, option_ids, offsets]
+    if sys.byteorder != "little":
+        for table in tables:
+            table.byteswap()
+
+    header = QBANK_HEADER.pack(
+        QBANK_MAGIC, QBANK_VERSION, 0, len(question_ids), len(option_ids), len(encoded),
+        string_offsets[-1], len(ambiguous)
+    )
+    return b"".join([header] + [table.tobytes() for table in tables] + [correct.tobytes(), ambiguous] + encoded)
+
+class MappedQuizBank:
+    """
+    Đề đọc trực tiếp từ nội dung file .qbank (bytes hoặc mmap) mà không sao chép: các bảng số là
+    view numpy trên buffer, chuỗi chỉ được giải mã khi cần hiển thị. Cùng giao diện đọc với
+    QuizBank và luôn bất biến.
+    """
+
+    __slots__ = ('offsets', 'correct', 'ambiguous', 'frozen', '_buffer', '_blob', '_string_offsets',
+                 '_question_ids', '_option_ids', '_hash')
+
+    def __init__(self, buffer):
+        view = memoryview(buffer)
+        if len(view) < QBANK_HEADER.size:
+            raise ValueError("File .qbank quá ngắn.")
+        magic, version, _, n_questions, n_options, n_strings, blob_size, ambiguous_size = (
+            QBANK_HEADER.unpack_from(view)
+        )
+        if magic != QBANK_MAGIC:
+            raise ValueError("Không phải file đề .qbank.")
+        if version != QBANK_VERSION:
+            raise ValueError(f"Phiên bản .qbank {version} không được hỗ trợ (cần {QBANK_VERSION}).")
+
+        pos = QBANK_HEADER.size
+        def table(dtype, count):
+            nonlocal pos
+            values = np.frombuffer(view, dtype=dtype, count=count, offset=pos)
+            pos += values.nbytes
+            return values
+
+        expected = QBANK_HEADER.size + 4 * (n_strings + 1 + n_questions + n_options + n_questions + 1) \
+            + n_questions + ambiguous_size + blob_size
+        if len(view) != expected:
+            raise ValueError("File .qbank bị hỏng (sai kích thước).")
+        self._string_offsets = table("<u4", n_strings + 1)
+        self._question_ids = table("<u4", n_questions)
+        self._option_ids = table("<u4", n_options)
+        self.offsets = table("<u4", n_questions + 1)
+        self.correct = table("i1", n_questions)
+        ambiguous = json.loads(str(view[pos:pos + ambiguous_size], "utf-8"))
+        pos += ambiguous_size
+        self._blob = view[pos:]
+
+        # Kiểm tra tính nhất quán một lần (vector hóa) để các lần truy cập sau không cần kiểm tra
+        counts = np.diff(self.offsets.astype(np.int64))
+        if (
+            self._string_offsets[0] != 0 or self._string_offsets[-1] != blob_size
+            or np.any(np.diff(self._string_offsets.astype(np.int64)) < 0)
+            or self.offsets[0] != 0 or self.offsets[-1] != n_options or np.any(counts < 0)
+            or (n_questions and max(self._question_ids.max(), self._option_ids.max(initial=0)) >= n_strings)
+            or np.any(self.correct >= np.minimum(counts, 127)) or np.any(self.correct < -1)
+        ):
+            raise ValueError("File .qbank bị hỏng (bảng chỉ mục không hợp lệ).")
+        # Kiểm tra vùng chuỗi là UTF-8 hợp lệ (giải mã tăng dần theo từng khối, bỏ kết quả nên không sao
+        # chép cả vùng) và mọi chuỗi bắt đầu ở ranh giới ký tự (không phải byte tiếp nối 10xxxxxx), nên
+        # _string() về sau không thể gặp UnicodeDecodeError. File tải lên không đáng tin nên không dựa vào
+        # cờ ghi sẵn trong file.
+        blob = np.frombuffer(self._blob, dtype=np.uint8)
+        starts = self._string_offsets[:-1]
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        try:
+            for start in range(0, blob_size, QBANK_VALIDATE_BLOCK):
+                decoder.decode(self._blob[start:start + QBANK_VALIDATE_BLOCK])
+            decoder.decode(b"", final=True)
+        except UnicodeDecodeError:
+            raise ValueError("File .qbank bị hỏng (chuỗi không phải UTF-8 hợp lệ).") from None
+        if np.any(blob[starts[starts < blob_size]] & 0xC0 == 0x80):
+            raise ValueError("File .qbank bị hỏng (chuỗi không phải UTF-8 hợp lệ).")
+        self.ambiguous = {int(i): tuple(value) for i, value in ambiguous.items()}
+        self.frozen = True
+        self._buffer = buffer
+        self._hash = None
+
+    def __len__(self):
+        return len(self._question_ids)
+
+    def _string(self, string_id):
+        return str(self._blob[self._string_offsets[string_id]:self._string_offsets[string_id + 1]], "utf-8")
+
+    def question(self, i):
+        return self._string(self._question_ids[i])
+
+    def option_count(self, i):
+        return int(self.offsets[i + 1] - self.offsets[i])
+
+    def options_of(self, i):
+        return [self._string(string_id) for string_id in self._option_ids[self.offsets[i]:self.offsets[i + 1]]]
+
+    def option(self, i, k):
+        return self._string(self._option_ids[self.offsets[i] + k])
+
+    def correct_index(self, i):
+        return int(self.correct[i])
+
+    def freeze(self):
+        return self
+
+    def content_hash(self):
+        """
+        Mã định danh tính từ toàn bộ nội dung file (không tin giá trị nào ghi trong file). Khác mã của
+        QuizBank cùng nội dung: đề nạp từ .qbank chỉ dùng chung với các lần nạp cùng file đó.
+        """
+        if self._hash is None:
+            self._hash = "q" + hashlib.sha256(self._buffer).hexdigest()[:15]
+        return self._hash
+
+    def nbytes(self):
+        """Kích thước buffer (với mmap, hệ điều hành chỉ nạp các trang thực sự được đọc)."""
+        return memoryview(self._buffer).nbytes + sys.getsizeof(self.ambiguous)
+
+    def to_quiz_data(self):
+        return [
+            {
+                'question': self.question(i),
+                'options': self.options_of(i),
+                'correct_answer': option_label(self.correct[i]) if self.correct[i] >= 0 else self.ambiguous[i][0],
+            }
+            for i in range(len(self))
+        ]
+
+def load_qbank(data):
+    """Nạp đề từ nội dung file .qbank (bytes). Ném ValueError nếu file không hợp lệ."""
+    return MappedQuizBank(data)
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def qbank_export_bytes(bank_id, _bank):
+    """Nội dung .qbank của đề trong kho (cache theo bank_id)."""
+    return export_qbank(_bank)
+
+def open_qbank(path):
+    """Nạp đề từ file .qbank trên đĩa bằng mmap (chỉ đọc); trang dữ liệu được nạp khi truy cập."""
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return MappedQuizBank(mapped)
+
+# --- LOẠI BỎ CÂU TRÙNG LẶP (MINHASH + LSH) ---
+
+# Gộp câu gần trùng sau khi phân tích xong (tắt bằng QUIZ_DEDUP=0). Hai câu được coi là trùng khi
+# độ tương đồng Jaccard ước tính trên tập shingle (câu hỏi + các lựa chọn) đạt DEDUP_THRESHOLD.
+DEDUP_ENABLED = os.environ.get("QUIZ_DEDUP", "1") != "0"
+DEDUP_THRESHOLD = float(os.environ.get("QUIZ_DEDUP_THRESHOLD", "0.8"))
+# 8 band × 8 hàng: cặp có Jaccard 0.8 gần như chắc chắn chung ít nhất một bucket (~99%)
+MINHASH_BANDS = 8
+MINHASH_ROWS = 8
+# Số câu tính chữ ký MinHash trong một lượt numpy (giới hạn bộ nhớ tạm)
+MINHASH_BLOCK = 2048
+DEDUP_WORD_RE = re.compile(r'\w+')
+
+_minhash_rng = np.random.default_rng(20240611)
+# Họ hàm băm multiply-shift: h(x) = (a * x + b) >> 32 trên uint64 (tràn số được bỏ qua)
+MINHASH_A = _minhash_rng.integers(1, 2 ** 63, size=MINHASH_BANDS * MINHASH_ROWS, dtype=np.uint64) | np.uint64(1)
+MINHASH_B = _minhash_rng.integers(0, 2 ** 63, size=MINHASH_BANDS * MINHASH_ROWS, dtype=np.uint64)
+MINHASH_BAND_MIX = _minhash_rng.integers(1, 2 ** 63, size=MINHASH_ROWS, dtype=np.uint64) | np.uint64(1)
+
+def _dedup_words(text):
+    return DEDUP_WORD_RE.findall(unicodedata.normalize("NFC", text).casefold())
+
+def question_shingles(bank, i):
+    """
+    Tập shingle của câu i: cặp 2 từ liên tiếp của câu hỏi (bỏ "Câu N") và mỗi lựa chọn (đã chuẩn
+    hóa) là một shingle riêng, nên đảo thứ tự lựa chọn không làm thay đổi tập.
+    """
+    words = _dedup_words(QUESTION_START_RE.sub("", bank.question(i), count=1))
+    shingles = {" ".join(words[k:k + 2]) for k in range(max(1, len(words) - 1))}
+    shingles.update("\1" + " ".join(_dedup_words(option)) for option in bank.options_of(i))
+    return shingles
+
+def minhash_signatures(shingle_sets):
+    """Ma trận chữ ký MinHash (số câu × MINHASH_BANDS·MINHASH_ROWS, uint32), tính theo khối bằng numpy."""
+    hashes = array('I')
+    lengths = array('I')
+    for shingles in shingle_sets:
+        hashes.extend(zlib.crc32(shingle.encode("utf-8")) for shingle in shingles)
+        lengths.append(len(shingles))
+
+    hashes = np.frombuffer(hashes, dtype=np.uint32).astype(np.uint64)
+    lengths = np.frombuffer(lengths, dtype=np.uint32).astype(np.int64)
+    starts = np.concatenate(([0], np.cumsum(lengths)))
+    n = len(lengths)
+    signatures = np.empty((n, len(MINHASH_A)), dtype=np.uint32)
+    for lo in range(0, n, MINHASH_BLOCK):
+        hi = min(lo + MINHASH_BLOCK, n)
+        block = hashes[starts[lo]:starts[hi], None]
+        permuted = (block * MINHASH_A + MINHASH_B) >> np.uint64(32)
+        # Mỗi câu có ít nhất một shingle nên không có đoạn rỗng khi reduceat
+        signatures[lo:hi] = np.minimum.reduceat(permuted, starts[lo:hi] - starts[lo], axis=0)
+    return signatures
+
+def lsh_candidate_pairs(signatures):
+    """
+    Các cặp (đại diện, thành viên) rơi cùng bucket ở ít nhất một band; đại diện là câu có chỉ số
+    nhỏ nhất trong bucket. Mỗi band chỉ cần một lần sắp xếp nên tổng thời gian gần tuyến tính.
+    """
+    n = len(signatures)
+    pairs = []
+    bands = signatures.reshape(n, MINHASH_BANDS, MINHASH_ROWS).astype(np.uint64)
+    for band in range(MINHASH_BANDS):
+        keys = (bands[:, band, :] * MINHASH_BAND_MIX).sum(axis=1)
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        group_start = np.flatnonzero(np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1])))
+        representative = order[np.repeat(group_start, np.diff(np.append(group_start, n)))]
+        duplicate = representative != order
+        if duplicate.any():
+            pairs.append(np.stack([representative[duplicate], order[duplicate]], axis=1))
+    if not pairs:
+        return np.empty((0, 2), dtype=np.int64)
+    return np.unique(np.concatenate(pairs), axis=0)
+
+def _correct_option_text(bank, i):
+    index = bank.correct_index(i)
+    return " ".join(_dedup_words(bank.option(i, index))) if index >= 0 else None
+
+def dedupe_bank(bank, threshold=DEDUP_THRESHOLD):
+    """
+    Gộp các câu gần trùng: mỗi cụm giữ câu xuất hiện đầu tiên. Bản sao có đáp án đúng (theo nội dung
+    lựa chọn) khác câu giữ lại thì không bị gộp mà được đánh dấu mâu thuẫn.
+    Trả về (đề mới, báo cáo, index_map) với index_map[chỉ số cũ] = chỉ số trong đề mới.
+    """
+    n = len(bank)
+    report = {'duplicates': 0, 'groups': [], 'conflicts': []}
+    if n < 2:
+        return bank, report, list(range(n))
+
+    shingles = [question_shingles(bank, i) for i in range(n)]
+    pairs = lsh_candidate_pairs(minhash_signatures(shingles))
+
+    # Loại cặp dương tính giả của LSH bằng độ tương đồng Jaccard chính xác (chỉ tính cho cặp ứng viên)
+    def jaccard(a, b):
+        return len(shingles[a] & shingles[b]) / len(shingles[a] | shingles[b])
+
+    parent = list(range(n))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    for a, b in pairs.tolist():
+        root_a, root_b = find(a), find(b)
+        if root_a == root_b or jaccard(a, b) < threshold:
+            continue
+        # Gốc luôn là chỉ số nhỏ nhất: câu xuất hiện đầu tiên được giữ lại
+        parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    roots = [find(i) for i in range(n)]
+    collapsed = {} # gốc -> số bản sao đã gộp
+    conflicting = {} # gốc -> các bản sao có đáp án khác
+    answers = {}
+    kept = []
+    for i, root in enumerate(roots):
+        if root == i:
+            kept.append(i)
+            continue
+        if root not in answers:
+            answers[root] = _correct_option_text(bank, root)
+        if answers[root] is not None and _correct_option_text(bank, i) == answers[root]:
+            collapsed[root] = collapsed.get(root, 0) + 1
+        else:
+            conflicting.setdefault(root, []).append(i)
+            kept.append(i)
+
+    new_index = {old: new for new, old in enumerate(kept)}
+    index_map = [new_index[i] if i in new_index else new_index[roots[i]] for i in range(n)]
+    report['duplicates'] = n - len(kept)
+    report['groups'] = sorted((new_index[root], count) for root, count in collapsed.items())
+    report['conflicts'] = sorted(
+        [new_index[root]] + [new_index[i] for i in members] for root, members in conflicting.items()
+    )
+    if not report['duplicates']:
+        return bank, report, index_map
+    return bank.select(kept), report, index_map
 
-# --- Cấu hình Trang Streamlit ---
-st.set_page_config(
-    page_title="App Ôn Luyện Đề Thi Trắc Nghiệm",
-    layout="wide"
-)
+# --- CHẤM ĐIỂM VÀ PHÂN TÍCH CÂU HỎI (VECTOR HÓA) ---
 
-st.title("📚 Ứng dụng Ôn Luyện Trắc Nghiệm (Word File)")
+def answers_matrix(answer_sheets, num_questions):
+    """Gộp nhiều phiếu trả lời (array/list chỉ số lựa chọn, -1 = bỏ trống) thành ma trận int8 (lượt làm × câu hỏi)."""
+    matrix = np.full((len(answer_sheets), num_questions), -1, dtype=np.int8)
+    for row, sheet in enumerate(answer_sheets):
+        sheet = np.asarray(sheet, dtype=np.int8)[:num_questions]
+        matrix[row, :len(sheet)] = sheet
+    return matrix
 
-# Khóa API để gọi Gemini - Lấy từ Streamlit Secrets
-API_KEY = st.secrets.get("GEMINI_API_KEY") 
+def score_attempts(bank, answers, questions=None):
+    """
+    Chấm điểm và phân tích câu hỏi cho nhiều lượt làm bài cùng lúc, hoàn toàn bằng phép toán mảng.
+    `answers` là ma trận số nguyên (lượt làm × câu hỏi), -1 là bỏ trống. Cột j ứng với câu questions[j]
+    của đề (bài kiểm tra lấy mẫu), mặc định là câu j. Câu không xác định được đáp án luôn tính là sai.
+    Trả về dict:
+      - 'hits': ma trận bool đúng/sai
+      - 'scores': số câu đúng của từng lượt; 'percentiles': thứ hạng phần trăm của từng lượt
+      - 'difficulty': tỉ lệ làm đúng từng câu (chỉ số độ khó p)
+      - 'discrimination': chỉ số phân biệt D = p(nhóm 27% cao nhất) - p(nhóm 27% thấp nhất)
+      - 'distractors': số lượt chọn từng lựa chọn của từng câu (câu hỏi × lựa chọn)
+      - 'unanswered': số lượt bỏ trống từng câu
+    """
+    answers = np.atleast_2d(np.asarray(answers, dtype=np.int8))
+    num_attempts, num_questions = answers.shape
+    correct = np.frombuffer(bank.correct, dtype=np.int8) if len(bank) else np.empty(0, dtype=np.int8)
+    offsets = np.frombuffer(bank.offsets, dtype=np.uint32)
+    if questions is not None:
+        # Chỉ đọc các câu có trong bài: chi phí theo số câu của bài, không theo kích thước đề
+        questions = np.asarray(questions, dtype=np.int64)
+        correct = correct[questions]
+        counts = offsets[questions + 1] - offsets[questions]
+    else:
+        counts = np.diff(offsets)
 
-# --- HÀM XỬ LÝ DOCX VÀ PARSING BẰNG GEMINI ---
+    hits = (answers == correct) & (correct >= 0)
+    scores = hits.sum(axis=1)
 
-@st.cache_data(show_spinner=False)
-def read_docx(uploaded_file):
-    """Đọc toàn bộ văn bản từ file Word (.docx)."""
-    if Document is None:
-        st.error("Không thể đọc file Word. Vui lòng kiểm tra đã cài đặt 'python-docx' chưa.")
-        return None
-    try:
-        # docx.Document() có thể nhận file object (uploaded_file)
-        document = Document(uploaded_file)
-        full_text = []
-        for para in document.paragraphs:
-            # Loại bỏ các dòng trống
-            if para.text.strip():
-                 full_text.append(para.text)
-        return "\n".join(full_text)
-    except Exception as e:
-        st.error(f"Lỗi đọc file Word: {e}")
-        return None
+    # Thứ hạng phần trăm: (số lượt thấp hơn + một nửa số lượt bằng điểm) / tổng số lượt
+    sorted_scores = np.sort(scores)
+    below = np.searchsorted(sorted_scores, scores, side='left')
+    equal = np.searchsorted(sorted_scores, scores, side='right') - below
+    percentiles = (below + 0.5 * equal) / max(num_attempts, 1) * 100
 
-@st.cache_data(show_spinner="Đang phân tích cấu trúc đề thi với AI...")
-def parse_quiz_data_with_gemini(raw_text, api_key):
+    difficulty = hits.mean(axis=0) if num_attempts else np.zeros(num_questions)
+
+    group = max(1, int(round(num_attempts * 0.27)))
+    if num_attempts >= 2:
+        order = np.argsort(scores, kind='stable')
+        discrimination = hits[order[-group:]].mean(axis=0) - hits[order[:group]].mean(axis=0)
+    else:
+        discrimination = np.zeros(num_questions)
+
+    width = int(counts.max()) if len(counts) else 0
+    answered = (answers >= 0) & (answers < width)
+    flat = (np.arange(num_questions) * width + answers.astype(np.int64))[answered]
+    distractors = np.bincount(flat, minlength=num_questions * width).reshape(num_questions, width)
+
+    return {
+        'hits': hits,
+        'scores': scores,
+        'percentiles': percentiles,
+        'difficulty': difficulty,
+        'discrimination': discrimination,
+        'distractors': distractors,
+        'unanswered': (answers < 0).sum(axis=0),
+    }
+
+# --- ĐỀ KIỂM TRA NGẪU NHIÊN (LẤY MẪU CÓ SEED, MẢNG HOÁN VỊ) ---
+
+EXAM_DEFAULT_QUESTIONS = 50
+EXAM_MAX_SEED = 2 ** 31
+EXAM_STRATA_LABELS = {'none': "Không phân tầng", 'source': "Theo file nguồn", 'difficulty': "Theo độ khó (lịch ôn tập)"}
+
+class ExamAttempt:
     """
-    Sử dụng Gemini API để phân tích cú pháp (parse) văn bản thô thành cấu trúc JSON.
-    Cần đảm bảo file Word có cấu trúc rõ ràng (ví dụ: Câu 1, A, B, C, D, Đáp án đúng là X).
+    Một lượt kiểm tra lấy mẫu từ đề, chỉ gồm các mảng chỉ số (không sao chép nội dung câu hỏi):
+    câu thứ j của bài là câu questions[j] trong đề, lựa chọn hiển thị thứ k của câu đó là lựa chọn
+    gốc options[offsets[j] + k]. Dựng lại được y hệt từ cùng đề, cùng tham số (kể cả các tầng) và cùng
+    seed; `reproducible` = False khi các tầng không cố định (lấy mẫu theo độ khó trong lịch ôn tập).
     """
-    if not api_key:
-        st.error("Lỗi: Không tìm thấy Khóa API. Vui lòng cấu hình Khóa 'GEMINI_API_KEY' trong Streamlit Secrets.")
-        return None
-    
-    if not raw_text:
-        return []
 
-    system_instruction = (
-        "Bạn là một chuyên gia phân tích cú pháp đề thi trắc nghiệm. Nhiệm vụ của bạn là đọc văn bản thô "
-        "từ file Word và trích xuất tất cả các câu hỏi trắc nghiệm thành một mảng JSON. "
-        "Mỗi câu hỏi phải bao gồm 'question', 'options' (một mảng chứa tất cả các lựa chọn), "
-        "và 'correct_answer' (chỉ là chữ cái (A, B, C...) hoặc nội dung văn bản đáp án đúng)."
-        "Đảm bảo kết quả là JSON hợp lệ và CHỈ chứa JSON, không thêm lời nói đầu hay giải thích."
-        "Bạn phải luôn luôn trả về một mảng JSON."
-    )
-    
-    user_prompt = f"Trích xuất tất cả câu hỏi trắc nghiệm từ văn bản sau:\n\n---\n{raw_text}\n---"
-    
-    try:
-        client = genai.Client(api_key=api_key)
-        
-        # Định nghĩa Schema cho kết quả JSON
-        response_schema = {
-            "type": "ARRAY",
-            "items": {
-                "type": "OBJECT",
-                "properties": {
-                    "question": {"type": "STRING", "description": "Nội dung câu hỏi."},
-                    "options": {
-                        "type": "ARRAY",
-                        "items": {"type": "STRING"},
-                        "description": "Mảng chứa các lựa chọn đáp án (A, B, C...)."
-                    },
-                    "correct_answer": {"type": "STRING", "description": "Chữ cái (A, B, C...) hoặc nội dung của đáp án đúng."}
-                },
-                "required": ["question", "options", "correct_answer"]
-            }
-        }
-        
-        config = {
-            "response_mime_type": "application/json",
-            "response_schema": response_schema
+    __slots__ = ('seed', 'questions', 'offsets', 'options', 'reproducible')
+
+    def __init__(self, seed, questions, offsets, options, reproducible=True):
+        self.seed = seed
+        self.questions = questions
+        self.offsets = offsets
+        self.options = options
+        self.reproducible = reproducible
+
+    def __len__(self):
+        return len(self.questions)
+
+    def question_index(self, j):
+        return self.questions[j]
+
+    def permutation(self, j):
+        """Hoán vị lựa chọn của câu thứ j: permutation[k] = chỉ số gốc của lựa chọn hiển thị thứ k."""
+        return self.options[self.offsets[j]:self.offsets[j + 1]]
+
+    def original_answers(self, sheet):
+        """Đổi phiếu trả lời (chỉ số lựa chọn hiển thị, -1 = bỏ trống) sang chỉ số lựa chọn gốc (vector hóa)."""
+        sheet = np.asarray(sheet, dtype=np.int64)
+        answers = np.full(len(sheet), -1, dtype=np.int8)
+        answered = sheet >= 0
+        if answered.any():
+            starts = np.frombuffer(self.offsets, dtype=np.uint32)[:-1].astype(np.int64)
+            permutations = np.frombuffer(self.options, dtype=np.uint8)
+            answers[answered] = permutations[starts[answered] + sheet[answered]]
+        return answers
+
+def sample_indices(rng, population, count):
+    """
+    `count` phần tử khác nhau của `population` (range hoặc mảng chỉ số) theo thuật toán Floyd:
+    O(count) thời gian và bộ nhớ, không phụ thuộc kích thước population.
+    """
+    size = len(population)
+    chosen = set()
+    for j in range(size - count, size):
+        t = rng.randrange(j + 1)
+        chosen.add(j if t in chosen else t)
+    return [int(population[t]) for t in sorted(chosen)]
+
+def allocate_strata(sizes, count):
+    """Chia `count` câu cho các tầng tỉ lệ với kích thước tầng (phương pháp phần dư lớn nhất)."""
+    total = sum(sizes)
+    if not total:
+        return [0] * len(sizes)
+    quotas = [count * size / total for size in sizes]
+    counts = [int(quota) for quota in quotas]
+    by_remainder = sorted(range(len(sizes)), key=lambda k: counts[k] - quotas[k])
+    for k in by_remainder[:count - sum(counts)]:
+        counts[k] += 1
+    return counts
+
+def build_exam(bank, num_questions, seed, strata=None, shuffle_questions=True, shuffle_options=True):
+    """
+    Lấy mẫu `num_questions` câu (phân tầng theo `strata`: danh sách tầng, mỗi tầng là range hoặc mảng
+    chỉ số câu) bằng RNG có seed, xáo thứ tự câu và thứ tự lựa chọn qua mảng hoán vị. O(N) thời gian
+    và bộ nhớ theo số câu của bài, không theo kích thước đề.
+    """
+    rng = random.Random(seed)
+    strata = strata or [range(len(bank))]
+    sizes = [len(population) for population in strata]
+    questions = array('I')
+    for population, count in zip(strata, allocate_strata(sizes, min(num_questions, sum(sizes)))):
+        questions.extend(sample_indices(rng, population, count))
+    if shuffle_questions:
+        rng.shuffle(questions)
+    else:
+        questions = array('I', sorted(questions))
+
+    offsets = array('I', [0])
+    options = array('B')
+    for i in questions:
+        permutation = list(range(bank.option_count(i)))
+        if shuffle_options:
+            rng.shuffle(permutation)
+        options.extend(permutation)
+        offsets.append(len(options))
+    return ExamAttempt(seed, questions, offsets, options)
+
+# --- KHO ĐỀ DÙNG CHUNG GIỮA CÁC PHIÊN ---
+
+# Đề không còn phiên nào dùng (phiên không hoạt động quá thời gian này) sẽ bị giải phóng
+BANK_IDLE_TTL = int(os.environ.get("QUIZ_BANK_IDLE_MINUTES", "30")) * 60
+BANK_EVICT_INTERVAL = 60
+
+class BankRegistry:
+    """
+    Kho đề dùng chung cho toàn tiến trình, khóa theo mã nội dung: mỗi đề chỉ có một bản bất biến
+    trong bộ nhớ dù bao nhiêu phiên đang dùng. Mỗi phiên giữ một "lease" (thời điểm truy cập gần nhất);
+    đề không còn lease nào còn hạn sẽ bị loại bỏ.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._banks = {} # bank_id -> QuizBank
+        self._leases = {} # bank_id -> {session_uid: thời điểm truy cập gần nhất}
+        self._last_evict = time.time()
+
+    def register(self, bank, session_uid):
+        """Đưa đề vào kho (dùng lại bản đã có nếu trùng nội dung) và cấp lease cho phiên. Trả về bank_id."""
+        bank_id = bank.content_hash()
+        with self._lock:
+            if bank_id not in self._banks:
+                self._banks[bank_id] = bank.freeze()
+            self._leases.setdefault(bank_id, {})[session_uid] = time.time()
+        return bank_id
+
+    def get(self, bank_id):
+        return self._banks.get(bank_id)
+
+    def touch(self, bank_id, session_uid):
+        """Gia hạn lease của phiên; định kỳ dọn các đề không còn phiên nào dùng."""
+        now = time.time()
+        with self._lock:
+            if bank_id in self._banks:
+                self._leases.setdefault(bank_id, {})[session_uid] = now
+        if now - self._last_evict > BANK_EVICT_INTERVAL:
+            self.evict_idle(now)
+
+    def release(self, bank_id, session_uid):
+        with self._lock:
+            self._leases.get(bank_id, {}).pop(session_uid, None)
+
+    def evict_idle(self, now=None):
+        """Bỏ lease quá hạn và giải phóng các đề không còn lease. Trả về số đề bị loại bỏ."""
+        now = now or time.time()
+        evicted = 0
+        with self._lock:
+            self._last_evict = now
+            for bank_id in list(self._banks):
+                leases = self._leases.get(bank_id, {})
+                for session_uid, seen in list(leases.items()):
+                    if now - seen > BANK_IDLE_TTL:
+                        del leases[session_uid]
+                if not leases:
+                    del self._banks[bank_id]
+                    self._leases.pop(bank_id, None)
+                    evicted += 1
+        return evicted
+
+    def stats(self):
+        """Danh sách đề đang nằm trong bộ nhớ: mã, số câu, dung lượng ước tính và số phiên đang dùng."""
+        with self._lock:
+            return [
+                {
+                    'bank_id': bank_id,
+                    'questions': len(bank),
+                    'bytes': bank.nbytes(),
+                    'sessions': len(self._leases.get(bank_id, {})),
+                }
+                for bank_id, bank in self._banks.items()
+            ]
+
+@st.cache_resource
+def get_bank_registry():
+    return BankRegistry()
+
+def current_bank():
+    """
+    Đề của phiên hiện tại: bản dùng chung trong kho, hoặc đề đang được phân tích dạng luồng. Mỗi lần đọc
+    đều gia hạn lease, kể cả khi chỉ một fragment chạy lại (VD: làm bài kiểm tra dài hơn BANK_IDLE_TTL).
+    """
+    bank_id = st.session_state.bank_id
+    if bank_id is not None:
+        registry = get_bank_registry()
+        registry.touch(bank_id, st.session_state.session_uid)
+        bank = registry.get(bank_id)
+        if bank is not None:
+            return bank
+    return st.session_state.pending_bank
+
+def release_bank(bank_id):
+    """Trả lease của phiên cho đề, trừ khi đề vẫn nằm trong danh sách tìm kiếm của phiên."""
+    if bank_id is not None and bank_id not in st.session_state.search_banks:
+        get_bank_registry().release(bank_id, st.session_state.session_uid)
+
+def publish_bank(bank, label=None):
+    """
+    Đưa đề đã phân tích xong vào kho dùng chung; phiên chỉ giữ lại bank_id. Đề có `label` (tên file)
+    được thêm vào danh sách đề tìm kiếm được của phiên, giữ lease cho tới khi phiên hết hoạt động và
+    được lập chỉ mục tìm kiếm ngay (mỗi đề một lần khi phân tích xong, không đợi lần tìm đầu tiên).
+    """
+    registry = get_bank_registry()
+    release_bank(st.session_state.bank_id)
+    st.session_state.bank_id = registry.register(bank, st.session_state.session_uid)
+    st.session_state.pending_bank = QuizBank()
+    if label is not None:
+        st.session_state.search_banks[st.session_state.bank_id] = label
+        bank_search_index(st.session_state.bank_id, registry.get(st.session_state.bank_id))
+
+@instrument_render
+def render_bank_registry_admin():
+    """Bảng quản trị (sidebar, mở bằng ?admin=1): các đề đang nằm trong bộ nhớ tiến trình."""
+    registry = get_bank_registry()
+    banks = registry.stats()
+    with st.sidebar.expander(f"🗄️ Kho đề dùng chung ({len(banks)} đề)"):
+        total_bytes = sum(b['bytes'] for b in banks)
+        st.caption(f"Tổng bộ nhớ ước tính: {total_bytes / 1024 / 1024:.1f} MB")
+        jobs = get_parse_job_queue().stats()
+        st.caption(f"Hàng đợi phân tích: {jobs['running']} đang chạy, {jobs['queued']} đang chờ (tối đa {PARSE_JOB_WORKERS} worker)")
+        attempts = get_attempt_log().stats()
+        st.caption(
+            f"Nhật ký ôn tập: đã ghi {attempts['written']} câu, {attempts['pending']} câu chờ ghi, "
+            f"{attempts['errors']} lỗi ghi"
+        )
+        if PREWARM_DIR and PREWARM_IN_APP:
+            process = start_prewarm(PREWARM_DIR)
+            status = "đang chạy" if process.poll() is None else f"đã xong (mã thoát {process.returncode})"
+            st.caption(f"Nạp trước cache từ {PREWARM_DIR}: {status}")
+        elif PREWARM_DIR:
+            st.caption(f"Nạp trước cache từ {PREWARM_DIR}: chạy ở nền khi khởi động server (setup.sh)")
+        for b in banks:
+            st.markdown(
+                f"- `{b['bank_id']}`: {b['questions']} câu, {b['bytes'] / 1024:.0f} KB, "
+                f"{b['sessions']} phiên"
+            )
+        if st.button("Dọn đề không dùng", key="admin_evict_banks"):
+            st.toast(f"Đã giải phóng {registry.evict_idle()} đề.")
+
+# --- TÌM KIẾM TOÀN VĂN (CHỈ MỤC ĐẢO, BỎ DẤU TIẾNG VIỆT) ---
+
+SEARCH_RESULT_LIMIT = 30 # số kết quả hiển thị
+SEARCH_STUDY_LIMIT = int(os.environ.get("QUIZ_SEARCH_STUDY_LIMIT", "200")) # số câu tối đa khi ôn luyện từ kết quả
+SEARCH_INDEX_CACHE = 16 # số chỉ mục giữ trong bộ nhớ (mỗi đề một chỉ mục)
+SEARCH_PREFIX_TERMS = 256 # số từ tối đa một tiền tố "abc*" được mở rộng thành (ưu tiên từ phổ biến)
+SEARCH_QUESTION_WEIGHT = 2 # từ trong câu hỏi nặng gấp đôi từ trong lựa chọn
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+SEARCH_SCOPES = {'all': "Câu hỏi và lựa chọn", 'question': "Chỉ câu hỏi"}
+
+_COMBINING_MARK_RE = re.compile(r'[\u0300-\u036f]')
+_INDEX_TOKEN_RE = re.compile(r'\w+|\x00')
+_QUERY_TERM_RE = re.compile(r'(\w+)(\*?)')
+
+def fold_text(text):
+    """Chữ thường, bỏ dấu tiếng Việt (cả đ → d): "Đà Nẵng" và "da nang" cho cùng các từ."""
+    return _COMBINING_MARK_RE.sub("", unicodedata.normalize("NFD", text.casefold())).replace("đ", "d")
+
+def parse_search_query(query):
+    """Danh sách (từ đã bỏ dấu, có phải tiền tố không) của truy vấn; "abc*" khớp mọi từ bắt đầu bằng abc."""
+    return [(term, bool(star)) for term, star in _QUERY_TERM_RE.findall(fold_text(query))]
+
+class SearchIndex:
+    """
+    Chỉ mục đảo của một đề (bất biến như đề): từ điển đã sắp xếp (tra tiền tố bằng bisect) và danh sách
+    posting dạng CSR trên mảng numpy — posting của từ t là postings[term_offsets[t]:term_offsets[t + 1]],
+    mỗi posting gồm chỉ số câu và số lần xuất hiện trong câu hỏi / trong các lựa chọn. Xếp hạng BM25,
+    câu phải chứa mọi từ của truy vấn.
+    """
+
+    def __init__(self, bank):
+        n = len(bank)
+        self.size = n
+        # Tách từ cả đề trong một lần cho mỗi trường (\x00 ngăn cách các văn bản), mã từ gán bằng dict
+        tokens_q = _INDEX_TOKEN_RE.findall(fold_text("\x00".join(bank.question(i) for i in range(n))))
+        tokens_o = _INDEX_TOKEN_RE.findall(
+            fold_text("\x00".join(option for i in range(n) for option in bank.options_of(i)))
+        )
+        vocab = {word: k for k, word in enumerate(dict.fromkeys(itertools.chain(("\x00",), tokens_q, tokens_o)))}
+        counts = np.diff(np.asarray(bank.offsets, dtype=np.int64))
+        terms_q, docs_q = self._term_docs(tokens_q, vocab, np.arange(n, dtype=np.int64))
+        terms_o, docs_o = self._term_docs(tokens_o, vocab, np.repeat(np.arange(n, dtype=np.int64), counts))
+
+        # Gộp (từ, câu, trường) rồi đếm theo đoạn liên tiếp sau khi sắp xếp: posting theo từ rồi theo câu
+        keys = np.concatenate(((terms_q * n + docs_q) * 2, (terms_o * n + docs_o) * 2 + 1))
+        keys.sort()
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        keys, runs = keys[starts], np.diff(np.append(starts, len(keys)))
+        pairs = keys >> 1
+        first = np.concatenate(([True], pairs[1:] != pairs[:-1]))
+        slot = np.cumsum(first) - 1
+        is_option = (keys & 1).astype(bool)
+        pairs = pairs[first]
+        self.tf_question = np.zeros(len(pairs), dtype=np.float32)
+        self.tf_question[slot[~is_option]] = runs[~is_option]
+        self.tf_option = np.zeros(len(pairs), dtype=np.float32)
+        self.tf_option[slot[is_option]] = runs[is_option]
+        self.postings = (pairs % max(n, 1)).astype(np.int32)
+        self.term_offsets = np.searchsorted(pairs // max(n, 1), np.arange(len(vocab) + 1))
+
+        words = sorted(word for word in vocab if word != "\x00")
+        self.words = words
+        self.word_ids = np.fromiter((vocab[word] for word in words), dtype=np.int64, count=len(words))
+        self.doc_freq = np.diff(self.term_offsets)
+        # Số câu chứa từ trong chính câu hỏi: idf của phạm vi 'question' không tính câu chỉ khớp ở lựa chọn
+        in_question = np.concatenate(([0], np.cumsum(self.tf_question > 0)))
+        self.doc_freq_question = in_question[self.term_offsets[1:]] - in_question[self.term_offsets[:-1]]
+        self.gradable = np.asarray(bank.correct) >= 0
+        # Mẫu số BM25 theo độ dài câu, tính sẵn cho từng phạm vi tìm kiếm
+        length_q = np.bincount(docs_q, minlength=n).astype(np.float32)
+        length_all = SEARCH_QUESTION_WEIGHT * length_q + np.bincount(docs_o, minlength=n)
+        self._norm = {
+            scope: BM25_K1 * (1 - BM25_B + BM25_B * length / max(float(length.mean()) if n else 0.0, 1.0))
+            for scope, length in (('question', length_q), ('all', length_all))
         }
 
-        response = client.models.generate_content(
-            model='gemini-2.5-flash-preview-05-20',
-            contents=user_prompt,
-            config=config,
-            system_instruction=system_instruction
+    @staticmethod
+    def _term_docs(tokens, vocab, text_docs):
+        """(mã từ, chỉ số câu) của từng từ; text_docs[k] là câu chứa văn bản thứ k."""
+        ids = np.fromiter(map(vocab.__getitem__, tokens), dtype=np.int64, count=len(tokens))
+        separators = ids == 0
+        text_index = np.cumsum(separators)[~separators]
+        return ids[~separators], text_docs[text_index]
+
+    def __len__(self):
+        return self.size
+
+    def nbytes(self):
+        arrays = (
+            self.tf_question, self.tf_option, self.postings, self.term_offsets, self.word_ids, self.doc_freq,
+            self.doc_freq_question,
         )
-        
-        json_data = response.text
-        return json.loads(json_data)
-        
-    except APIError as e:
-        st.error(f"Lỗi gọi Gemini API: {e}. Vui lòng kiểm tra Khóa API hoặc giới hạn sử dụng.")
-        return None
-    except json.JSONDecodeError:
-        st.error("Lỗi phân tích cú pháp JSON từ API. Vui lòng kiểm tra lại cấu trúc đề thi trong file Word.")
-        return None
-    except Exception as e:
-        st.error(f"Đã xảy ra lỗi không xác định trong quá trình phân tích: {e}")
+        return sum(array.nbytes for array in arrays) + sum(map(sys.getsizeof, self.words))
+
+    def expand(self, term, prefix):
+        """Mã các từ khớp `term` (khớp chính xác, hoặc mọi từ bắt đầu bằng term nếu prefix)."""
+        start = bisect.bisect_left(self.words, term)
+        if not prefix:
+            found = start < len(self.words) and self.words[start] == term
+            return self.word_ids[start:start + 1] if found else self.word_ids[:0]
+        stop = bisect.bisect_left(self.words, term + "\U0010ffff", start)
+        ids = self.word_ids[start:stop]
+        if len(ids) > SEARCH_PREFIX_TERMS:
+            ids = ids[np.argsort(-self.doc_freq[ids], kind='stable')[:SEARCH_PREFIX_TERMS]]
+        return ids
+
+    def _term_scores(self, term_ids, scope):
+        """Điểm BM25 của một từ truy vấn (tổng trên các từ khớp tiền tố) cho mọi câu; 0 = không chứa."""
+        if not len(term_ids):
+            return np.zeros(self.size, dtype=np.float32)
+        starts = self.term_offsets[term_ids]
+        lengths = self.term_offsets[term_ids + 1] - starts
+        # Vị trí posting của mọi từ khớp, nối liền: starts[k] + 0..lengths[k]-1
+        positions = np.repeat(starts - (lengths.cumsum() - lengths), lengths) + np.arange(lengths.sum())
+        tf = self.tf_question[positions]
+        if scope == 'question':
+            df = np.repeat(self.doc_freq_question[term_ids], lengths)
+            keep = tf > 0
+            positions, tf, df = positions[keep], tf[keep], df[keep]
+        else:
+            df = np.repeat(lengths, lengths)
+            tf = SEARCH_QUESTION_WEIGHT * tf + self.tf_option[positions]
+        docs = self.postings[positions]
+        idf = np.log1p((self.size - df + 0.5) / (df + 0.5))
+        weights = idf * tf * (BM25_K1 + 1) / (tf + self._norm[scope][docs])
+        return np.bincount(docs, weights=weights, minlength=self.size)
+
+    def search(self, terms, scope='all', gradable_only=False, limit=SEARCH_RESULT_LIMIT):
+        """
+        Tìm các câu chứa mọi từ trong `terms` (kết quả của parse_search_query). Trả về (chỉ số câu,
+        điểm) của tối đa `limit` câu điểm cao nhất, xếp giảm dần, và tổng số câu khớp.
+        """
+        if not terms or not self.size:
+            return np.zeros(0, dtype=np.int64), np.zeros(0), 0
+        total = np.zeros(self.size)
+        matched = self.gradable.copy() if gradable_only else np.ones(self.size, dtype=bool)
+        for term, prefix in terms:
+            scores = self._term_scores(self.expand(term, prefix), scope)
+            matched &= scores > 0
+            total += scores
+        hits = np.flatnonzero(matched)
+        if len(hits) > limit:
+            hits = hits[np.argpartition(-total[hits], limit - 1)[:limit]]
+        hits = hits[np.argsort(-total[hits], kind='stable')]
+        return hits, total[hits], int(np.count_nonzero(matched))
+
+@st.cache_resource(max_entries=SEARCH_INDEX_CACHE, show_spinner="Đang lập chỉ mục tìm kiếm...")
+def bank_search_index(bank_id, _bank):
+    """Chỉ mục của một đề trong kho (đề bất biến nên chỉ lập một lần cho mọi phiên)."""
+    with metric_span("quiz_stage", stage="search_index"):
+        return SearchIndex(_bank)
+
+def search_loaded_banks(query, bank_ids, scope='all', gradable_only=False, limit=SEARCH_RESULT_LIMIT):
+    """
+    Tìm trên các đề `bank_ids` trong kho: mỗi đề có chỉ mục riêng (đề mới chỉ cần lập chỉ mục cho chính
+    nó), kết quả được gộp theo điểm và câu có mặt ở nhiều đề chỉ giữ một lần. Trả về (list (điểm,
+    bank_id, chỉ số câu) giảm dần, tổng số câu khớp trong từng đề).
+    """
+    terms = parse_search_query(query)
+    if not terms:
+        return [], 0
+    registry = get_bank_registry()
+    results = []
+    matched = 0
+    with metric_span("quiz_search"):
+        for bank_id in bank_ids:
+            bank = registry.get(bank_id)
+            if bank is None:
+                continue
+            hits, scores, count = bank_search_index(bank_id, bank).search(terms, scope, gradable_only, limit)
+            results.extend(zip(scores.tolist(), [bank_id] * len(hits), hits.tolist()))
+            matched += count
+        results.sort(reverse=True)
+        if len(bank_ids) > 1:
+            # VD: tải lại cùng file kèm file mới tạo đề gộp chứa lại các câu cũ
+            seen = set()
+            unique = []
+            for result in results:
+                key = question_key(registry.get(result[1]), result[2])
+                if key not in seen:
+                    seen.add(key)
+                    unique.append(result)
+            results = unique
+    return results[:limit], matched
+
+def select_from_banks(selection):
+    """Đề mới gồm các câu (bank, chỉ số câu) theo thứ tự đã cho, có thể lấy từ nhiều đề (như QuizBank.select)."""
+    result = QuizBank()
+    for bank, i in selection:
+        if i in bank.ambiguous:
+            result.ambiguous[len(result)] = bank.ambiguous[i]
+        result.questions.append(bank.question(i))
+        result.options.extend(bank.options_of(i))
+        result.offsets.append(len(result.options))
+        result.correct.append(bank.correct_index(i))
+    return result
+
+# --- ÔN TẬP NGẮT QUÃNG (SM-2, NHẬT KÝ TRẢ LỜI TRÊN SQLITE) ---
+
+# Nhật ký trả lời và trạng thái ôn tập của từng người học (dùng chung cho mọi phiên trên cùng máy)
+SRS_DB_PATH = os.environ.get(
+    "QUIZ_SRS_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "tracnghiem", "review.sqlite3")
+)
+# Câu trả lời được ghi theo lô: mỗi SRS_FLUSH_SECONDS giây hoặc khi đã gom đủ SRS_FLUSH_BATCH câu
+SRS_FLUSH_SECONDS = float(os.environ.get("QUIZ_SRS_FLUSH_SECONDS", "2"))
+SRS_FLUSH_BATCH = 500
+SRS_LOAD_PAGE = 5000
+SRS_DEFAULT_USER = "default"
+
+# SM-2: điểm nhớ 0-5 (>= 3 là nhớ được); trả lời sai phải học lại sau SRS_RELEARN_SECONDS
+SRS_GRADE_WRONG = 1
+SRS_GRADE_CORRECT = 4
+SRS_CORRECT_GRADES = (("Khó", 3), ("Tốt", 4), ("Dễ", 5))
+SRS_RELEARN_SECONDS = 10 * 60
+SRS_INITIAL_EASE = 2.5
+SRS_MIN_EASE = 1.3
+SRS_DAY = 24 * 3600
+# Trạng thái một câu: (due, interval, ease, reps, lapses, last), thời gian tính bằng giây
+SRS_FIELDS = ('due', 'interval', 'ease', 'reps', 'lapses', 'last')
+
+def sm2_review(card, grade, now):
+    """Một bước SM-2 cho câu có trạng thái `card` (None nếu câu mới) được chấm điểm `grade`. Trả về trạng thái mới."""
+    due, interval, ease, reps, lapses, last = card or (now, 0.0, SRS_INITIAL_EASE, 0, 0, 0.0)
+    if grade < 3:
+        # Quên: học lại từ đầu (hệ số dễ giữ nguyên), đếm lần quên nếu câu đã từng thuộc
+        return (now + SRS_RELEARN_SECONDS, float(SRS_RELEARN_SECONDS), ease, 0, lapses + (reps > 0), now)
+    ease = max(SRS_MIN_EASE, ease + 0.1 - (5 - grade) * (0.08 + (5 - grade) * 0.02))
+    if reps == 0:
+        interval = float(SRS_DAY)
+    elif reps == 1:
+        interval = 6.0 * SRS_DAY
+    else:
+        interval = interval * ease
+    return (now + interval, interval, ease, reps + 1, lapses, now)
+
+def format_interval(seconds):
+    """Khoảng thời gian dạng dễ đọc: '10 phút', '6 ngày', '2.5 tháng'."""
+    if seconds < 3600:
+        return f"{max(1, round(seconds / 60))} phút"
+    if seconds < SRS_DAY:
+        return f"{round(seconds / 3600)} giờ"
+    if seconds < 30 * SRS_DAY:
+        return f"{round(seconds / SRS_DAY)} ngày"
+    return f"{seconds / (30 * SRS_DAY):.1f} tháng"
+
+def question_key(bank, i):
+    """Mã 64 bit của câu theo nội dung đã chuẩn hóa: tiến độ ôn tập giữ nguyên khi đề được gộp hay tải lại."""
+    digest = hashlib.blake2b(_normalize_option_text(bank.question(i)).encode("utf-8"), digest_size=8)
+    for option in bank.options_of(i):
+        digest.update(b"\0" + _normalize_option_text(option).encode("utf-8"))
+    return int.from_bytes(digest.digest(), "little", signed=True)
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def bank_question_keys(bank_id, _bank):
+    return np.fromiter((question_key(_bank, i) for i in range(len(_bank))), dtype=np.int64, count=len(_bank))
+
+class AttemptLog:
+    """
+    Nhật ký trả lời dùng chung toàn tiến trình. Câu trả lời của mọi phiên được gom vào hàng đợi và một
+    luồng nền ghi theo lô trong một transaction: bảng attempts (lịch sử, chỉ ghi thêm) và bảng cards
+    (trạng thái SM-2 hiện tại, mỗi người học một dòng cho mỗi câu). Khi nạp chỉ đọc bảng cards.
+    """
+
+    def __init__(self, path=None, flush_seconds=SRS_FLUSH_SECONDS, batch_size=SRS_FLUSH_BATCH):
+        self.path = path or SRS_DB_PATH
+        self.flush_seconds = flush_seconds
+        self.batch_size = batch_size
+        self.written = 0
+        self.errors = 0
+        self._pending = []
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        threading.Thread(target=self._run, name="quiz-srs-writer", daemon=True).start()
+        atexit.register(self.flush)
+
+    def connect(self):
+        """Mở kết nối SQLite (WAL để nhiều tiến trình đọc/ghi đồng thời), tạo bảng nếu chưa có."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cards ("
+            " user TEXT NOT NULL, qkey INTEGER NOT NULL, due REAL NOT NULL, interval REAL NOT NULL,"
+            " ease REAL NOT NULL, reps INTEGER NOT NULL, lapses INTEGER NOT NULL, last REAL NOT NULL,"
+            " updated REAL NOT NULL, PRIMARY KEY (user, qkey)) WITHOUT ROWID"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS cards_updated ON cards(user, updated)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS attempts ("
+            " user TEXT NOT NULL, qkey INTEGER NOT NULL, ts REAL NOT NULL,"
+            " correct INTEGER NOT NULL, grade INTEGER NOT NULL)"
+        )
+        return conn
+
+    def record(self, user, qkey, correct, grade, card):
+        """Đưa một câu trả lời (kèm trạng thái mới của câu) vào hàng đợi ghi."""
+        with self._cond:
+            self._pending.append((user, qkey, correct, grade, card))
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait(self.flush_seconds)
+            self.flush()
+
+    def flush(self):
+        """Ghi mọi câu trả lời đang chờ trong một transaction. Trả về số câu đã ghi; lỗi ghi thì giữ lại để thử lần sau."""
+        with self._write_lock:
+            with self._cond:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            try:
+                with metric_span("quiz_srs_flush"):
+                    conn = self.connect()
+                    try:
+                        conn.execute("BEGIN IMMEDIATE")
+                        # Lấy mốc thời gian sau khi đã giữ khóa ghi: mọi transaction đã commit trước đó có
+                        # updated <= now, nên bên đọc đã dời mốc đồng bộ (updated >= since) vẫn thấy các dòng này
+                        now = time.time()
+                        conn.executemany(
+                            "INSERT INTO attempts(user, qkey, ts, correct, grade) VALUES (?, ?, ?, ?, ?)",
+                            [(user, qkey, card[5], int(correct), grade) for user, qkey, correct, grade, card in batch]
+                        )
+                        # Trạng thái cũ hơn trạng thái đã lưu (phiên khác ghi sau) không được ghi đè
+                        conn.executemany(
+                            "INSERT INTO cards(user, qkey, due, interval, ease, reps, lapses, last, updated)"
+                            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(user, qkey) DO UPDATE SET"
+                            " due = excluded.due, interval = excluded.interval, ease = excluded.ease,"
+                            " reps = excluded.reps, lapses = excluded.lapses, last = excluded.last,"
+                            " updated = excluded.updated WHERE excluded.last >= cards.last",
+                            [(user, qkey, *card, now) for user, qkey, correct, grade, card in batch]
+                        )
+                        conn.execute("COMMIT")
+                    finally:
+                        conn.close()
+            except (sqlite3.Error, OSError):
+                self.errors += 1
+                metric_inc("quiz_srs_write_errors_total")
+                with self._cond:
+                    self._pending[:0] = batch
+                return 0
+            self.written += len(batch)
+            metric_inc("quiz_srs_attempts_written_total", len(batch))
+            return len(batch)
+
+    def load_cards(self, user, since=0.0):
+        """
+        Sinh từng trang (mã câu: mảng int64, giá trị: mảng float64 theo SRS_FIELDS + updated) các câu đã
+        ghi của người học được cập nhật từ thời điểm `since`. Không ghi hàng đợi (việc của luồng nền):
+        câu trả lời chưa ghi lấy bằng pending_cards().
+        """
+        conn = self.connect()
+        try:
+            cursor = conn.execute(
+                "SELECT qkey, due, interval, ease, reps, lapses, last, updated FROM cards"
+                " WHERE user = ? AND updated >= ?",
+                (user, since)
+            )
+            while True:
+                rows = cursor.fetchmany(SRS_LOAD_PAGE)
+                if not rows:
+                    break
+                keys = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+                yield keys, np.array([row[1:] for row in rows], dtype=np.float64)
+        finally:
+            conn.close()
+
+    def pending_cards(self, user):
+        """Trạng thái mới nhất của các câu của người học còn trong hàng đợi ghi: (mã câu, mảng theo SRS_FIELDS)."""
+        with self._cond:
+            latest = {qkey: card for pending_user, qkey, _, _, card in self._pending if pending_user == user}
+        keys = np.fromiter(latest, dtype=np.int64, count=len(latest))
+        return keys, np.array(list(latest.values()), dtype=np.float64).reshape(len(latest), len(SRS_FIELDS))
+
+    def stats(self):
+        with self._cond:
+            pending = len(self._pending)
+        return {'pending': pending, 'written': self.written, 'errors': self.errors}
+
+@st.cache_resource
+def get_attempt_log():
+    return AttemptLog()
+
+class ReviewScheduler:
+    """
+    Lịch ôn tập của một người học trên một đề. Trạng thái SM-2 của mọi câu nằm trong các mảng numpy
+    song song (câu chưa học có due = inf); câu đã học nằm trong heap (due, chỉ số) nên lấy câu đến hạn
+    sớm nhất là O(log n). Khi một câu được lên lịch lại, mục cũ trong heap bị bỏ qua lúc lấy ra.
+    Câu mới được lấy lần lượt theo thứ tự trong đề; câu không xác định được đáp án bị bỏ qua.
+    """
+
+    def __init__(self, user, keys, gradable, log, clock=time.time):
+        n = len(keys)
+        self.user = user
+        self.keys = keys
+        self.gradable = gradable
+        self.log = log
+        self.clock = clock
+        self.due = np.full(n, np.inf)
+        self.interval = np.zeros(n)
+        self.ease = np.full(n, SRS_INITIAL_EASE)
+        self.reps = np.zeros(n, dtype=np.int32)
+        self.lapses = np.zeros(n, dtype=np.int32)
+        self.last = np.zeros(n)
+        self._order = np.argsort(keys, kind="stable")
+        self._sorted_keys = keys[self._order]
+        self._heap = []
+        self._new_cursor = 0
+        self._synced = 0.0
+        self.refresh()
+
+    def refresh(self):
+        """
+        Nạp tăng dần các câu được cập nhật từ lần đồng bộ trước (kể cả từ phiên khác của cùng người học):
+        các câu đã ghi, rồi các câu trả lời còn trong hàng đợi của nhật ký (không chờ ghi xuống đĩa).
+        """
+        changed = 0
+        with metric_span("quiz_srs_load"):
+            for qkeys, values in self.log.load_cards(self.user, self._synced):
+                self._synced = max(self._synced, float(values[:, -1].max()))
+                changed += self._merge(qkeys, values)
+            # Câu chưa ghi không dời mốc đồng bộ: khi được ghi sẽ được đọc lại và bỏ qua vì không mới hơn
+            changed += self._merge(*self.log.pending_cards(self.user))
+        if changed:
+            heapq.heapify(self._heap)
+        return changed
+
+    def _merge(self, qkeys, values):
+        """Áp các trạng thái (theo SRS_FIELDS) mới hơn trạng thái đang giữ; trả về số câu thay đổi."""
+        if not len(self.keys) or not len(qkeys):
+            return 0
+        pos = np.minimum(np.searchsorted(self._sorted_keys, qkeys), len(self.keys) - 1)
+        hit = self._sorted_keys[pos] == qkeys
+        indices, values = self._order[pos[hit]], values[hit]
+        newer = values[:, 5] > self.last[indices]
+        indices, values = indices[newer], values[newer]
+        for column, name in enumerate(SRS_FIELDS):
+            getattr(self, name)[indices] = values[:, column]
+        self._heap.extend(zip(values[:, 0].tolist(), indices.tolist()))
+        return len(indices)
+
+    def card(self, i):
+        """Trạng thái SM-2 của câu i, None nếu chưa học."""
+        if self.last[i] == 0:
+            return None
+        return (float(self.due[i]), float(self.interval[i]), float(self.ease[i]),
+                int(self.reps[i]), int(self.lapses[i]), float(self.last[i]))
+
+    def _peek(self):
+        while self._heap and self._heap[0][0] != self.due[self._heap[0][1]]:
+            heapq.heappop(self._heap)
+        return self._heap[0][1] if self._heap else None
+
+    def _next_new(self):
+        n = len(self.keys)
+        while self._new_cursor < n and (self.last[self._new_cursor] > 0 or not self.gradable[self._new_cursor]):
+            self._new_cursor += 1
+        return self._new_cursor if self._new_cursor < n else None
+
+    def next_item(self, ahead=False):
+        """Câu cần ôn tiếp: câu đến hạn sớm nhất, rồi tới câu mới; ahead=True cho ôn trước hạn. None nếu hết."""
+        top = self._peek()
+        if top is not None and self.due[top] <= self.clock():
+            return top
+        new = self._next_new()
+        if new is not None:
+            return new
+        return top if ahead else None
+
+    def preview(self, i, grade):
+        """Khoảng cách tới lần ôn sau (giây) nếu câu i được chấm `grade`."""
+        return sm2_review(self.card(i), grade, self.clock())[1]
+
+    def answer(self, i, correct, grade=None):
+        """Cập nhật lịch của câu i theo câu trả lời, ghi vào nhật ký (theo lô). Trả về trạng thái mới."""
+        if grade is None:
+            grade = SRS_GRADE_CORRECT if correct else SRS_GRADE_WRONG
+        card = sm2_review(self.card(i), grade, self.clock())
+        for name, value in zip(SRS_FIELDS, card):
+            getattr(self, name)[i] = value
+        heapq.heappush(self._heap, (card[0], i))
+        if len(self._heap) > 2 * len(self.keys) + 64:
+            # Quá nhiều mục cũ: dựng lại heap từ các câu đã học
+            seen = np.flatnonzero(self.last > 0)
+            self._heap = list(zip(self.due[seen].tolist(), seen.tolist()))
+            heapq.heapify(self._heap)
+        self.log.record(self.user, int(self.keys[i]), bool(correct), grade, card)
+        return card
+
+    def difficulty_strata(self):
+        """Chỉ số câu theo độ khó với người học: chưa học, hay quên (đang học lại, từng quên, hệ số dễ đã giảm), đã thuộc."""
+        seen = self.last > 0
+        hard = seen & ((self.reps == 0) | (self.lapses > 0) | (self.ease < SRS_INITIAL_EASE))
+        return [np.flatnonzero(~seen), np.flatnonzero(hard), np.flatnonzero(seen & ~hard)]
+
+    def stats(self):
+        """Số câu đến hạn, câu mới, câu đã học và thời điểm đến hạn gần nhất (None nếu chưa học câu nào)."""
+        seen = self.last > 0
+        learned = int(np.count_nonzero(seen))
+        return {
+            'due': int(np.count_nonzero(self.due <= self.clock())),
+            'new': int(np.count_nonzero(self.gradable & ~seen)),
+            'learned': learned,
+            'next_due': float(self.due[seen].min()) if learned else None,
+        }
+
+def current_learner():
+    return st.session_state.learner.strip() or SRS_DEFAULT_USER
+
+def current_scheduler():
+    """Lịch ôn tập của (người học, đề) hiện tại, giữ trong phiên; None khi đề chưa được đưa vào kho."""
+    bank_id = st.session_state.bank_id
+    if bank_id is None:
         return None
+    scheduler_id = (current_learner(), bank_id)
+    if st.session_state.review_scheduler_id != scheduler_id:
+        bank = current_bank()
+        st.session_state.review_scheduler = ReviewScheduler(
+            scheduler_id[0], bank_question_keys(bank_id, bank), np.asarray(bank.correct) >= 0, get_attempt_log()
+        )
+        st.session_state.review_scheduler_id = scheduler_id
+    return st.session_state.review_scheduler
+
+def record_review_answer(i, correct, grade=None):
+    """Ghi câu trả lời (ôn luyện, kiểm tra, ôn tập) vào lịch ôn tập; bỏ qua câu không xác định được đáp án."""
+    scheduler = current_scheduler()
+    if scheduler is not None and scheduler.gradable[i]:
+        scheduler.answer(i, correct, grade)
 
 # --- KHỞI TẠO VÀ QUẢN LÝ SESSION STATE ---
 
 def initialize_session_state():
     """Khởi tạo các biến trạng thái cần thiết cho ứng dụng."""
-    if 'quiz_data' not in st.session_state:
-        st.session_state.quiz_data = [] # Dữ liệu đề thi đã parse
+    if 'session_uid' not in st.session_state:
+        st.session_state.session_uid = uuid.uuid4().hex
+    if 'bank_id' not in st.session_state:
+        st.session_state.bank_id = None # Mã đề trong kho dùng chung (xem current_bank())
+    if 'pending_bank' not in st.session_state:
+        st.session_state.pending_bank = QuizBank() # Đề đang được phân tích dạng luồng, chưa đưa vào kho
     if 'current_mode' not in st.session_state:
-        st.session_state.current_mode = 'upload' # upload | menu | study | exam | review | result
+        st.session_state.current_mode = 'upload' # upload | menu | study | exam | review | srs | result
     if 'current_index' not in st.session_state:
         st.session_state.current_index = 0
     if 'exam_answers' not in st.session_state:
-        st.session_state.exam_answers = {} # {question_index: user_answer_text}
+        st.session_state.exam_answers = new_answer_sheet(0) # exam_answers[j] = chỉ số lựa chọn hiển thị, -1 nếu chưa trả lời
+    if 'exam_attempt' not in st.session_state:
+        st.session_state.exam_attempt = None # ExamAttempt của lượt kiểm tra gần nhất
     if 'score' not in st.session_state:
         st.session_state.score = None # None | {'correct': 5, 'wrong': 3, 'review_q': [...]}
+    if 'parse_jobs' not in st.session_state:
+        st.session_state.parse_jobs = [] # ParseJob đang chạy ở nền, theo thứ tự file tải lên
+        st.session_state.parse_merged = [] # parse_merged[i] = số câu của job i đã gộp vào pending_bank
+        st.session_state.parse_file_ids = () # file_id của các file ứng với parse_jobs
+    if 'parse_report' not in st.session_state:
+        st.session_state.parse_report = None # None | {'local': 40, 'remote': 2, 'low_confidence': 2, 'invalid': 0, 'files': 1, 'errors': []}
+    if 'learner' not in st.session_state:
+        st.session_state.learner = st.query_params.get("user", "") # Tên người học (tiến độ ôn tập lưu theo tên)
+    if 'review_scheduler' not in st.session_state:
+        st.session_state.review_scheduler = None # ReviewScheduler của (người học, đề) hiện tại
+        st.session_state.review_scheduler_id = None
+        st.session_state.srs_current = None # Chỉ số câu đang ôn ở chế độ srs, None = chọn câu tiếp theo
+        st.session_state.srs_seq = 0 # Tăng sau mỗi câu để radio của lượt mới không giữ lựa chọn cũ
+        st.session_state.srs_ahead = False # Cho phép ôn trước hạn khi không còn câu đến hạn
+    if 'search_banks' not in st.session_state:
+        st.session_state.search_banks = {} # {bank_id: tên file}: các đề đã tải trong phiên, tìm kiếm được
 
 initialize_session_state()
+sync_parse_jobs()
+if st.session_state.bank_id is not None:
+    get_bank_registry().touch(st.session_state.bank_id, st.session_state.session_uid)
+    if get_bank_registry().get(st.session_state.bank_id) is None:
+        # Đề đã bị giải phóng do phiên không hoạt động quá lâu: quay lại màn hình tải file (phân tích lại)
+        st.session_state.bank_id = None
+        st.session_state.parse_file_ids = ()
+        st.session_state.current_mode = 'upload'
+for bank_id in list(st.session_state.search_banks):
+    get_bank_registry().touch(bank_id, st.session_state.session_uid)
+    if get_bank_registry().get(bank_id) is None:
+        del st.session_state.search_banks[bank_id]
 
 # --- HÀM THIẾT LẬP CHẾ ĐỘ ---
 
+def exam_strata(kind):
+    """Các tầng lấy mẫu của đề hiện tại: theo file nguồn (khoảng liên tiếp trong đề) hoặc theo độ khó trong lịch ôn tập."""
+    report = st.session_state.parse_report
+    if kind == 'source' and report and len(report.get('sources', ())) > 1:
+        return [range(start, stop) for name, start, stop in report['sources']]
+    scheduler = current_scheduler() if kind == 'difficulty' else None
+    if scheduler is not None:
+        return scheduler.difficulty_strata()
+    return None
+
+def exam_config():
+    """
+    Tham số dựng bài kiểm tra từ các widget tùy chọn ở menu (xem render_exam_options). Được đọc trong
+    callback của nút bắt đầu nên là giá trị vừa chọn; chưa chọn gì thì là toàn bộ đề, giữ thứ tự gốc.
+    """
+    state = st.session_state
+    return {
+        'size': state.get('exam_size'), 'strata': state.get('exam_strata') or 'none', 'seed': state.get('exam_seed'),
+        'shuffle_questions': state.get('exam_shuffle_questions', False),
+        'shuffle_options': state.get('exam_shuffle_options', False),
+    }
+
+def new_exam_attempt(config=None):
+    """Dựng lượt kiểm tra theo tham số của menu (mặc định: toàn bộ đề, giữ thứ tự); không có mã đề thì chọn ngẫu nhiên."""
+    bank = current_bank()
+    config = config or {}
+    seed = config.get('seed')
+    if seed is None:
+        seed = random.randrange(EXAM_MAX_SEED)
+    strata = config.get('strata', 'none')
+    attempt = build_exam(
+        bank, min(config.get('size') or len(bank), len(bank)), seed, exam_strata(strata),
+        shuffle_questions=config.get('shuffle_questions', False), shuffle_options=config.get('shuffle_options', False)
+    )
+    # Tầng theo độ khó lấy từ lịch ôn tập, thay đổi sau mỗi lần trả lời: cùng mã đề không cho lại cùng bài
+    attempt.reproducible = strata != 'difficulty'
+    return attempt
+
 def set_mode(mode):
     """Thiết lập chế độ, reset trạng thái nếu cần."""
     if mode == 'study' or mode == 'menu':
@@ -145,7 +3339,8 @@ def set_mode(mode):
 
     elif mode == 'exam':
         st.session_state.current_index = 0
-        st.session_state.exam_answers = {}
+        st.session_state.exam_attempt = new_exam_attempt(exam_config())
+        st.session_state.exam_answers = new_answer_sheet(len(st.session_state.exam_attempt))
         st.session_state.current_mode = 'exam'
         st.session_state.score = None
     elif mode == 'review':
@@ -155,102 +3350,145 @@ def set_mode(mode):
             st.session_state.current_mode = 'review'
         else:
             set_mode('result') # Quay lại màn hình kết quả
+    elif mode == 'srs':
+        # Ôn tập ngắt quãng trên toàn bộ đề, câu do lịch SM-2 chọn
+        st.session_state.srs_current = None
+        st.session_state.srs_ahead = False
+        st.session_state.current_mode = 'srs'
+
+def study_search_results(results):
+    """
+    Ôn luyện các câu tìm được (list (điểm, bank_id, chỉ số câu)): gộp thành một đề mới, xếp theo đề
+    nguồn rồi theo thứ tự câu, đưa vào kho và chuyển sang chế độ study.
+    """
+    registry = get_bank_registry()
+    order = {bank_id: k for k, bank_id in enumerate(st.session_state.search_banks)}
+    selection = sorted((order.get(bank_id, len(order)), i, bank_id) for _, bank_id, i in results)
+    sources = []
+    for k, (_, _, bank_id) in enumerate(selection):
+        if not sources or sources[-1][0] != st.session_state.search_banks.get(bank_id):
+            sources.append([st.session_state.search_banks.get(bank_id), k, k])
+        sources[-1][2] = k + 1
+    publish_bank(select_from_banks((registry.get(bank_id), i) for _, i, bank_id in selection))
+    # Không có file nào được phân tích: báo cáo chỉ giữ khoảng câu theo đề nguồn (dùng khi lấy mẫu bài kiểm tra)
+    st.session_state.parse_report = dict(EMPTY_PARSE_REPORT, errors=[], sources=[tuple(source) for source in sources])
+    set_mode('study')
+
+def open_search_bank(bank_id):
+    """Chuyển đề hiện tại sang một đề đã tải trước đó trong phiên."""
+    release_bank(st.session_state.bank_id)
+    get_bank_registry().touch(bank_id, st.session_state.session_uid)
+    st.session_state.bank_id = bank_id
+    st.session_state.pending_bank = QuizBank()
+    st.session_state.parse_report = None
+    set_mode('menu')
 
 # --- HÀM TIỆN ÍCH CHO ĐÁP ÁN ---
 
-def get_question_data(q_index, mode):
-    """Trả về dữ liệu câu hỏi và chỉ mục gốc (nếu đang ở chế độ review)."""
+def get_question_index(q_index, mode):
+    """Trả về chỉ mục gốc của câu hỏi trong đề (khác q_index ở chế độ exam và review), None nếu không có."""
     if mode == 'review':
         if not st.session_state.score or not st.session_state.score.get('review_q'):
-             return None, None
-        
-        original_q_index = st.session_state.score['review_q'][q_index]
-        question_data = st.session_state.quiz_data[original_q_index]
-        return question_data, original_q_index
-    else:
-        question_data = st.session_state.quiz_data[q_index]
-        return question_data, q_index
-
-def get_correct_answer_text(question_data):
-    """Tìm đáp án đúng trong list options dựa trên correct_answer (chữ cái/text) và định dạng."""
-    correct_key = question_data['correct_answer'].strip()
-    options = question_data['options']
-    option_labels = ['A', 'B', 'C', 'D', 'E', 'F']
-    
-    # Ưu tiên tìm theo chữ cái
-    if len(correct_key) == 1 and correct_key.upper() in option_labels:
-        idx = option_labels.index(correct_key.upper())
-        if idx < len(options):
-            return f"{option_labels[idx]}. {options[idx]}"
-    
-    # Fallback: Tìm theo nội dung văn bản
-    for i, opt in enumerate(options):
-        # So sánh nội dung văn bản
-        if opt.strip() == correct_key.strip():
-            return f"{option_labels[i]}. {opt}"
-            
-    # Fallback cuối cùng: Trả về văn bản gốc của đáp án đúng (có thể là chữ cái hoặc nội dung)
-    return correct_key
+             return None
+        return st.session_state.score['review_q'][q_index]
+    if mode == 'exam':
+        return st.session_state.exam_attempt.question_index(q_index)
+    return q_index
+
+def get_option_permutation(q_index, mode):
+    """Thứ tự hiển thị các lựa chọn (permutation[k] = chỉ số gốc), theo lượt kiểm tra ở chế độ exam và review."""
+    attempt = st.session_state.exam_attempt
+    if mode == 'exam':
+        return attempt.permutation(q_index)
+    if mode == 'review' and attempt is not None:
+        # Ôn lại câu sai với đúng thứ tự lựa chọn đã thấy trong bài kiểm tra
+        return attempt.permutation(st.session_state.score['review_pos'][q_index])
+    return range(current_bank().option_count(get_question_index(q_index, mode)))
+
+def format_option(bank, q_index, option_index, permutation=None):
+    """Lựa chọn hiển thị thứ option_index (VD: 'B. Nội dung'), đổi sang lựa chọn gốc qua permutation nếu có."""
+    original = permutation[option_index] if permutation is not None else option_index
+    return f"{option_label(option_index)}. {bank.option(q_index, original)}"
+
+def go_to_question(q_index, clear_key=None):
+    """Callback điều hướng: đổi câu hiện tại (và xóa trạng thái chọn của câu cũ nếu cần)."""
+    st.session_state.current_index = q_index
+    if clear_key is not None and clear_key in st.session_state:
+        del st.session_state[clear_key]
+
+def get_correct_answer_text(bank, q_index, permutation=None):
+    """
+    Văn bản đáp án đúng đã định dạng (VD: 'B. Nội dung đáp án B'), dùng chỉ số đã giải sẵn khi biên dịch.
+    Với permutation (lựa chọn đã xáo), nhãn là vị trí hiển thị của đáp án đúng.
+    """
+    correct_index = bank.correct_index(q_index)
+    if correct_index >= 0:
+        if permutation is not None:
+            return format_option(bank, q_index, permutation.index(correct_index), permutation)
+        return format_option(bank, q_index, correct_index)
+    # Đáp án không xác định được: trả về văn bản gốc của đáp án đúng
+    return str(bank.ambiguous[q_index][0] or "(không xác định)")
 
 # --- HÀM RENDER CÂU HỎI CHUNG ---
 
+@instrument_render
 def render_question(q_index, mode):
     """Hiển thị một câu hỏi dựa trên chỉ mục và chế độ."""
     
-    question_data, original_q_index = get_question_data(q_index, mode)
+    bank = current_bank()
+    original_q_index = get_question_index(q_index, mode)
     
-    if question_data is None:
+    if original_q_index is None:
          st.error("Không tìm thấy dữ liệu câu hỏi.")
          return
          
     # Tính toán tổng số câu hỏi cần hiển thị
-    total_questions = len(st.session_state.quiz_data) if mode == 'exam' or mode == 'study' else len(st.session_state.score['review_q'])
+    if mode == 'exam':
+        total_questions = len(st.session_state.exam_attempt)
+    else:
+        total_questions = len(bank) if mode == 'study' else len(st.session_state.score['review_q'])
     
     display_q_number = original_q_index + 1 if mode == 'review' else q_index + 1
     
     st.markdown(f"**Câu {display_q_number} / {total_questions}**")
-    st.markdown(f"#### {question_data['question']}")
+    st.markdown(f"#### {bank.question(original_q_index)}")
 
     # Tạo key duy nhất cho radio button
     radio_key = f"{mode}_q_{original_q_index}" if mode == 'review' else f"{mode}_q_{q_index}"
     
-    # Chuẩn bị options để hiển thị (thêm chữ cái A, B, C...)
-    labeled_options = []
-    option_labels = ['A', 'B', 'C', 'D', 'E', 'F']
-    for i, opt in enumerate(question_data['options']):
-        if i < len(option_labels):
-            labeled_options.append(f"{option_labels[i]}. {opt}")
-        else:
-            labeled_options.append(opt)
+    # Radio dùng vị trí hiển thị của lựa chọn làm giá trị; permutation đổi sang lựa chọn gốc
+    permutation = get_option_permutation(q_index, mode)
+    option_indices = range(len(permutation))
+    format_func = lambda k: format_option(bank, original_q_index, k, permutation)
 
     # --- CHẾ ĐỘ ÔN LUYỆN (STUDY / REVIEW) ---
     if mode == 'study' or mode == 'review':
         
         # Callback khi chọn đáp án
-        def handle_study_selection(selected_text):
-            # Lưu đáp án đã chọn vào session state
-            st.session_state[f"study_selected_{radio_key}"] = selected_text
-            # Ghi nhận kết quả
-            st.session_state.is_answered = True
+        def handle_study_selection():
+            # Lần chọn đầu tiên được ghi vào lịch ôn tập
+            selected = st.session_state[radio_key]
+            if selected is not None and st.session_state.get(f"study_selected_{radio_key}") is None:
+                record_review_answer(original_q_index, permutation[selected] == bank.correct_index(original_q_index))
+            # Lưu chỉ số đáp án đã chọn vào session state
+            st.session_state[f"study_selected_{radio_key}"] = selected
 
         # Lấy đáp án đã chọn trong chế độ học tập (dùng key riêng)
         study_selected = st.session_state.get(f"study_selected_{radio_key}")
 
         # Radio button
-        selected_option_text = st.radio(
+        st.radio(
             "Chọn đáp án:",
-            options=labeled_options,
+            options=option_indices,
+            format_func=format_func,
             key=radio_key,
-            on_change=handle_study_selection,
-            args=(st.session_state[radio_key],)
+            index=study_selected,
+            on_change=handle_study_selection
         )
         
         # Sau khi chọn, hiển thị kết quả
-        if study_selected:
-            correct_answer_text = get_correct_answer_text(question_data)
-            
-            # Kiểm tra xem đáp án chọn có chứa văn bản của đáp án đúng không
-            is_correct = correct_answer_text in study_selected
+        if study_selected is not None:
+            is_correct = permutation[study_selected] == bank.correct_index(original_q_index)
             
             # Hiển thị kết quả
             if is_correct:
@@ -259,18 +3497,20 @@ def render_question(q_index, mode):
                 st.error("❌ Sai rồi.")
             
             # Hiển thị đáp án đúng
-            st.info(f"Đáp án đúng là: **{correct_answer_text}**")
+            st.info(f"Đáp án đúng là: **{get_correct_answer_text(bank, original_q_index, permutation)}**")
             
             st.markdown("---")
             
-            # Nút Next
+            # Nút Next (callback chạy trước khi fragment vẽ lại, không cần st.rerun())
             if q_index < total_questions - 1:
-                if st.button("Câu tiếp theo >>", key=f"next_study_{q_index}"):
-                    st.session_state.current_index += 1
-                    # Xóa trạng thái chọn của câu hiện tại để radio button reset
-                    if f"study_selected_{radio_key}" in st.session_state:
-                         del st.session_state[f"study_selected_{radio_key}"]
-                    st.rerun()
+                st.button(
+                    "Câu tiếp theo >>", key=f"next_study_{q_index}",
+                    on_click=go_to_question, args=(q_index + 1, f"study_selected_{radio_key}")
+                )
+            elif mode == 'study' and parse_in_progress():
+                st.info("Đang phân tích thêm câu hỏi, vui lòng chờ giây lát rồi bấm cập nhật.")
+                # Bấm nút chỉ chạy lại fragment, đọc lại số câu đã phân tích
+                st.button("Cập nhật câu hỏi mới", key=f"refresh_study_{q_index}")
             else:
                 st.success(f"Chúc mừng, bạn đã hoàn thành phần {'ôn lại' if mode == 'review' else 'ôn luyện'}!")
                 if st.button("Quay lại Menu Chính"):
@@ -280,20 +3520,20 @@ def render_question(q_index, mode):
     # --- CHẾ ĐỘ KIỂM TRA (EXAM) ---
     elif mode == 'exam':
         
-        # Lấy đáp án đã chọn trước đó (nếu có)
-        initial_value = st.session_state.exam_answers.get(q_index)
-        
-        # Tìm index của đáp án đã chọn (None nếu chưa chọn)
-        initial_index = labeled_options.index(initial_value) if initial_value in labeled_options else None
+        # Lấy đáp án đã chọn trước đó (None nếu chưa chọn)
+        initial_index = st.session_state.exam_answers[q_index]
+        if initial_index < 0:
+            initial_index = None
         
         def handle_exam_selection():
-             # Lưu đáp án vào session state ngay khi người dùng tương tác
-             selected_text = st.session_state[radio_key]
-             st.session_state.exam_answers[q_index] = selected_text
+             # Lưu chỉ số đáp án vào phiếu trả lời ngay khi người dùng tương tác
+             selected = st.session_state[radio_key]
+             st.session_state.exam_answers[q_index] = -1 if selected is None else selected
 
         st.radio(
             "Chọn đáp án:",
-            options=labeled_options,
+            options=option_indices,
+            format_func=format_func,
             key=radio_key,
             index=initial_index,
             on_change=handle_exam_selection
@@ -305,15 +3545,11 @@ def render_question(q_index, mode):
         
         with col_prev:
             if q_index > 0:
-                if st.button("<< Câu trước", key="prev_exam"):
-                    st.session_state.current_index -= 1
-                    st.rerun()
+                st.button("<< Câu trước", key="prev_exam", on_click=go_to_question, args=(q_index - 1,))
         
         with col_next:
             if q_index < total_questions - 1:
-                if st.button("Câu tiếp theo >>", key="next_exam"):
-                    st.session_state.current_index += 1
-                    st.rerun()
+                st.button("Câu tiếp theo >>", key="next_exam", on_click=go_to_question, args=(q_index + 1,))
             elif q_index == total_questions - 1:
                 # Nút nộp bài ở câu cuối
                 if st.button("NỘP BÀI KIỂM TRA", use_container_width=True, type="primary"):
@@ -321,70 +3557,142 @@ def render_question(q_index, mode):
                     st.rerun()
 
 def calculate_score():
-    """Tính toán điểm số và lưu vào session_state."""
-    total = len(st.session_state.quiz_data)
-    correct_count = 0
-    wrong_count = 0
-    review_q_indices = [] # Chỉ mục các câu hỏi sai (trong mảng quiz_data)
-    
-    for i, question_data in enumerate(st.session_state.quiz_data):
-        user_answer_text = st.session_state.exam_answers.get(i)
-        
-        # Lấy văn bản đáp án đúng đã được định dạng (VD: 'B. Nội dung đáp án B')
-        correct_answer_text = get_correct_answer_text(question_data)
-        
-        # Kiểm tra nếu người dùng đã chọn và đáp án đúng có trong nội dung đáp án chọn
-        is_correct = user_answer_text and correct_answer_text in user_answer_text
-        
-        if is_correct:
-            correct_count += 1
-        else:
-            wrong_count += 1
-            # Chỉ thêm vào danh sách ôn lại nếu đã có câu trả lời (hoặc chưa trả lời, tính là sai)
-            review_q_indices.append(i) 
+    """
+    Tính toán điểm số (qua bộ chấm điểm vector hóa, một lượt làm) và lưu vào session_state. Phiếu trả lời
+    ghi vị trí hiển thị nên được đổi về lựa chọn gốc qua hoán vị của lượt kiểm tra trước khi chấm.
+    """
+    bank = current_bank()
+    attempt = st.session_state.exam_attempt
+    total = len(attempt)
+    questions = np.frombuffer(attempt.questions, dtype=np.uint32).astype(np.int64)
+    answers = attempt.original_answers(st.session_state.exam_answers)
+    result = score_attempts(bank, answers_matrix([answers], total), questions)
+    # Vị trí (trong bài) và chỉ mục (trong đề) các câu hỏi sai, kể cả câu chưa trả lời
+    review_positions = np.flatnonzero(~result['hits'][0])
+    # Các câu đã trả lời được ghi vào lịch ôn tập (theo lô)
+    for j in np.flatnonzero(answers >= 0).tolist():
+        record_review_answer(int(questions[j]), bool(result['hits'][0][j]))
 
     st.session_state.score = {
-        'correct': correct_count,
-        'wrong': wrong_count,
+        'correct': int(result['scores'][0]),
+        'wrong': len(review_positions),
         'total': total,
-        'review_q': review_q_indices
+        'review_q': questions[review_positions].tolist(),
+        'review_pos': review_positions.tolist(),
+        'seed': attempt.seed,
+        'reproducible': attempt.reproducible,
     }
     st.session_state.current_mode = 'result'
 
 # --- HÀM RENDER CÁC MÀN HÌNH ---
 
+@instrument_render
 def render_upload_screen():
     """Màn hình tải file và menu chính."""
-    uploaded_file = st.file_uploader(
-        "1. Tải file Word (.docx) chứa đề thi trắc nghiệm của bạn.",
-        type=['docx']
+    uploaded_files = st.file_uploader(
+        "1. Tải một hoặc nhiều file Word (.docx) chứa đề thi trắc nghiệm của bạn, hoặc đề đã biên dịch (.qbank).",
+        type=['docx', 'qbank'],
+        accept_multiple_files=True
     )
-    
-    if uploaded_file is not None and st.session_state.current_mode == 'upload':
-        raw_text = read_docx(uploaded_file)
-        if raw_text:
-             if API_KEY:
-                 parsed_data = parse_quiz_data_with_gemini(raw_text, API_KEY)
-                 
-                 if parsed_data and isinstance(parsed_data, list) and len(parsed_data) > 0:
-                     st.session_state.quiz_data = parsed_data
-                     st.success(f"Phân tích thành công! Tìm thấy {len(parsed_data)} câu hỏi.")
-                     set_mode('menu')
-                     st.rerun()
-                 elif parsed_data is not None:
-                      st.error("Không tìm thấy câu hỏi nào hoặc cấu trúc đề thi không rõ ràng. Vui lòng kiểm tra lại file Word.")
-             else:
-                 st.error("⚠️ Không tìm thấy API Key. Vui lòng thêm 'GEMINI_API_KEY' vào Streamlit Secrets.")
 
-    if st.session_state.current_mode == 'menu' and st.session_state.quiz_data:
+    file_ids = tuple(uploaded_file.file_id for uploaded_file in uploaded_files or [])
+    if st.session_state.current_mode == 'menu' and file_ids and file_ids != st.session_state.parse_file_ids:
+        # Tải thêm đề khi đang ở menu: đề cũ vẫn tìm kiếm được (xem render_search_panel)
+        st.session_state.current_mode = 'upload'
+    if st.session_state.current_mode == 'upload':
+        # Mỗi file là một job nền; các đề được gộp theo thứ tự file thành một đề duy nhất
+        if file_ids != st.session_state.parse_file_ids and len(file_ids) == 1 and is_qbank_name(uploaded_files[0].name):
+            import_qbank_file(uploaded_files[0])
+        elif file_ids != st.session_state.parse_file_ids:
+            start_parse_jobs(uploaded_files or [], API_KEY)
+            if file_ids:
+                # Mở menu ngay khi có đủ vài câu đầu tiên; phần còn lại tiếp tục được phân tích ở nền
+                with st.spinner("Đang phân tích cấu trúc đề thi..."):
+                    wait_for_first_questions(STREAM_MIN_QUESTIONS)
+                sync_parse_jobs()
+
+        if file_ids and bank_ready_for_menu():
+            set_mode('menu')
+            st.rerun()
+        elif parse_in_progress():
+            render_parse_progress()
+        elif file_ids:
+            st.error("Không tìm thấy câu hỏi nào hoặc cấu trúc đề thi không rõ ràng. Vui lòng kiểm tra lại file đã tải lên.")
+            report = st.session_state.parse_report
+            for error in (report['errors'] if report else []):
+                st.caption(error)
+
+    if st.session_state.current_mode == 'menu' and len(current_bank()):
         render_menu_screen()
         
+DEDUP_REPORT_LIMIT = 50
+
+@instrument_render
 def render_menu_screen():
     """Màn hình chọn chế độ ôn luyện/kiểm tra."""
     st.header("2. Chọn Chế độ")
-    st.subheader(f"Đã tải {len(st.session_state.quiz_data)} câu hỏi.")
+    bank = current_bank()
+    st.subheader(f"Đã tải {len(bank)} câu hỏi.")
+    report = st.session_state.parse_report
+    if report and not report['files'] and report['sources']:
+        st.caption("Đề ôn luyện từ kết quả tìm kiếm · " + " · ".join(
+            f"{name}: {stop - start} câu" for name, start, stop in report['sources']
+        ))
+    elif report:
+        st.caption(
+            f"{report['files']} file · Phân tích cục bộ: {report['local']} câu · Phân tích bằng AI: {report['remote']} câu "
+            f"(từ {report['low_confidence']} đoạn độ tin cậy thấp)"
+            + (f" · Nạp từ .qbank: {report['imported']} câu" if report['imported'] else "")
+            + (f" · Lấy từ cache: {report['cached']} câu" if report['cached'] else "")
+            + (f" · Bỏ {report['invalid']} câu không hợp lệ" if report['invalid'] else "")
+        )
+        for error in report['errors']:
+            st.warning(error)
+    if report and report['tokens_raw']:
+        saved = report['tokens_raw'] - report['tokens_sent']
+        with st.expander(
+            f"🔢 Token gửi AI: ~{report['tokens_sent']:,} (rút gọn {saved:,} token, "
+            f"{saved / report['tokens_raw']:.0%} văn bản gốc)"
+        ):
+            st.caption(
+                "Ước tính trước/sau khi bỏ số trang, phần thủ tục và header/footer lặp lại; "
+                "prompt/đầu ra là số token Gemini báo về (0 nếu lấy từ cache)."
+            )
+            st.dataframe(
+                [
+                    {'file': name, 'gốc': raw, 'gửi': sent, 'tiết kiệm': raw - sent, 'prompt': prompt, 'đầu ra': output}
+                    for name, raw, sent, prompt, output in report['token_files']
+                ],
+                use_container_width=True
+            )
+    dedup = report.get('dedup') if report else None
+    if dedup and dedup['duplicates']:
+        with st.expander(f"🧹 Đã gộp {dedup['duplicates']} câu trùng lặp ({len(dedup['groups'])} nhóm)"):
+            for i, count in dedup['groups'][:DEDUP_REPORT_LIMIT]:
+                st.markdown(f"- **Câu {i + 1}**: gộp {count} bản sao — {bank.question(i)[:80]}")
+            if len(dedup['groups']) > DEDUP_REPORT_LIMIT:
+                st.caption(f"... và {len(dedup['groups']) - DEDUP_REPORT_LIMIT} nhóm khác")
+    if dedup and dedup['conflicts']:
+        with st.expander(f"⚠️ {len(dedup['conflicts'])} nhóm câu trùng có đáp án khác nhau (chưa gộp)"):
+            for group in dedup['conflicts'][:DEDUP_REPORT_LIMIT]:
+                st.markdown("- " + " · ".join(f"**Câu {i + 1}**: {get_correct_answer_text(bank, i)}" for i in group))
+    if bank.ambiguous:
+        with st.expander(f"⚠️ {len(bank.ambiguous)} câu không xác định được đáp án (luôn tính là sai)"):
+            for i, (key, reason) in sorted(bank.ambiguous.items()):
+                st.markdown(f"- **Câu {i + 1}**: {reason}")
+    # Fragment tự chạy lại mỗi giây: chỉ dựng khi còn file đang phân tích
+    if parse_in_progress():
+        render_parse_progress()
+    if st.session_state.bank_id is not None:
+        # Lưu đề đã biên dịch để lần sau nạp ngay, không cần đọc Word hay gọi Gemini
+        st.download_button(
+            "💾 Tải đề đã biên dịch (.qbank)",
+            qbank_export_bytes(st.session_state.bank_id, bank),
+            file_name=f"de_thi_{st.session_state.bank_id}.qbank",
+            mime="application/octet-stream"
+        )
     
-    col1, col2 = st.columns(2)
+    col1, col2, col3 = st.columns(3)
     
     with col1:
         st.markdown("### 📝 Ôn Luyện (Study Mode)")
@@ -396,10 +3704,110 @@ def render_menu_screen():
     with col2:
         st.markdown("### ⏱️ Kiểm Tra (Exam Mode)")
         st.info("**Tính năng:** Làm bài ẩn, **nộp bài** để xem kết quả tổng quát.")
-        if st.button("BẮT ĐẦU KIỂM TRA", use_container_width=True, type="primary"):
-            set_mode('exam')
+        render_exam_options(bank)
+        # Bài kiểm tra lấy mẫu trên toàn bộ đề nên chỉ mở khi phân tích xong
+        # Callback: đề được dựng theo tùy chọn vừa chọn ở trên trước khi chạy lại script
+        st.button(
+            "BẮT ĐẦU KIỂM TRA", use_container_width=True, type="primary", disabled=parse_in_progress(),
+            on_click=set_mode, args=('exam',)
+        )
+
+    with col3:
+        st.markdown("### 🧠 Ôn Tập Ngắt Quãng")
+        st.info("**Tính năng:** Câu **đến hạn** được ôn lại theo lịch SM-2, tiến độ lưu theo **tên người học**.")
+        # Lịch ôn tập gắn với đề đã phân tích xong (mã câu tính trên toàn bộ đề)
+        if st.button("BẮT ĐẦU ÔN TẬP", use_container_width=True, disabled=parse_in_progress() or st.session_state.bank_id is None):
+            set_mode('srs')
+            st.rerun()
+
+    render_search_panel()
+
+@st.fragment
+@instrument_render
+def render_search_panel():
+    """Tìm câu hỏi trên mọi đề đã tải trong phiên; gõ truy vấn chỉ chạy lại phần này (fragment)."""
+    banks = st.session_state.search_banks
+    if not banks:
+        return
+    st.divider()
+    st.markdown("### 🔎 Tìm câu hỏi")
+    query = st.text_input(
+        "Từ khóa", key="search_query", placeholder="VD: thu do viet* (không cần gõ dấu; * để tìm theo tiền tố)"
+    )
+    col_banks, col_scope, col_gradable = st.columns([3, 2, 2])
+    selected = list(banks)
+    if len(banks) > 1:
+        selected = col_banks.multiselect("Đề", selected, default=selected, format_func=banks.get, key="search_bank_filter")
+    scope = col_scope.selectbox("Tìm trong", list(SEARCH_SCOPES), format_func=SEARCH_SCOPES.get, key="search_scope")
+    gradable_only = col_gradable.checkbox("Chỉ câu có đáp án", key="search_gradable")
+
+    if len(banks) > 1 or st.session_state.bank_id not in banks:
+        col_open, col_button = st.columns([3, 1], vertical_alignment="bottom")
+        target = col_open.selectbox("Đề đã tải trong phiên", list(banks), format_func=banks.get, key="search_open_bank")
+        if col_button.button(
+            "Mở đề", key="search_open", use_container_width=True,
+            disabled=parse_in_progress() or target == st.session_state.bank_id
+        ):
+            open_search_bank(target)
             st.rerun()
+
+    if not query.strip():
+        return
+    start = time.perf_counter()
+    results, matched = search_loaded_banks(query, selected, scope, gradable_only, SEARCH_STUDY_LIMIT)
+    st.caption(
+        f"{matched} câu khớp · {(time.perf_counter() - start) * 1000:.0f} ms"
+        + (f" · hiển thị {SEARCH_RESULT_LIMIT} câu liên quan nhất" if len(results) > SEARCH_RESULT_LIMIT else "")
+    )
+    registry = get_bank_registry()
+    for score, bank_id, i in results[:SEARCH_RESULT_LIMIT]:
+        bank = registry.get(bank_id)
+        st.markdown(
+            f"- **{banks.get(bank_id, bank_id)} · Câu {i + 1}**: {bank.question(i)[:200]}  \n"
+            f"  ✅ {get_correct_answer_text(bank, i)}"
+        )
+    # Đề mới được dựng trong lúc chạy nên dùng kiểu if-button rồi chạy lại toàn bộ script (ra khỏi fragment)
+    if results and st.button(
+        f"📝 Ôn luyện {len(results)} câu tìm được", key="search_study", type="primary", disabled=parse_in_progress()
+    ):
+        study_search_results(results)
+        st.rerun()
             
+def render_exam_options(bank):
+    """
+    Tùy chọn dựng bài kiểm tra (số câu, cách lấy mẫu, xáo trộn, mã đề). Giá trị nằm trong session_state
+    theo key của widget và chỉ được đọc khi bấm bắt đầu (exam_config()); mặc định giữ bài kiểm tra như
+    trước khi có tùy chọn: toàn bộ đề, đúng thứ tự gốc.
+    """
+    report = st.session_state.parse_report
+    kinds = ['none']
+    if report and len(report.get('sources', ())) > 1:
+        kinds.append('source')
+    if st.session_state.bank_id is not None:
+        kinds.append('difficulty')
+    # Số câu đã chọn cho đề trước có thể lớn hơn đề hiện tại: bỏ để dùng lại mặc định
+    if (st.session_state.get('exam_size') or 0) > len(bank):
+        del st.session_state['exam_size']
+    if st.session_state.get('exam_strata', 'none') not in kinds:
+        del st.session_state['exam_strata']
+    with st.expander("⚙️ Tùy chọn bài kiểm tra"):
+        st.number_input(
+            "Số câu", min_value=1, max_value=len(bank), value=len(bank), step=1, key="exam_size",
+            help=f"Đề lớn nên lấy mẫu một phần, VD: {EXAM_DEFAULT_QUESTIONS} câu."
+        )
+        st.selectbox("Lấy mẫu", kinds, format_func=EXAM_STRATA_LABELS.get, key="exam_strata")
+        st.checkbox("Xáo thứ tự câu hỏi", value=False, key="exam_shuffle_questions")
+        st.checkbox("Xáo thứ tự lựa chọn", value=False, key="exam_shuffle_options")
+        st.number_input(
+            "Mã đề", min_value=0, max_value=EXAM_MAX_SEED - 1, value=None, step=1, placeholder="ngẫu nhiên",
+            help=(
+                "Cùng đề, cùng tùy chọn và cùng mã đề sẽ tạo lại đúng bài kiểm tra đó, trừ khi lấy mẫu theo độ "
+                "khó: các tầng độ khó thay đổi theo lịch ôn tập sau mỗi lần trả lời."
+            ),
+            key="exam_seed"
+        )
+
+@instrument_render
 def render_quiz_main():
     """Hiển thị giao diện chính cho Study, Exam, hoặc Review."""
     
@@ -416,10 +3824,15 @@ def render_quiz_main():
         st.header("📝 CHẾ ĐỘ ÔN LUYỆN")
     elif mode == 'exam':
         st.header("⏱️ CHẾ ĐỘ KIỂM TRA")
+        st.caption(f"Mã đề: {st.session_state.exam_attempt.seed} · {len(st.session_state.exam_attempt)} câu")
     elif mode == 'review':
         st.header("🔁 ÔN LẠI CÂU SAI")
+    elif mode == 'srs':
+        st.header("🧠 ÔN TẬP NGẮT QUÃNG")
     
-    data_to_display = st.session_state.quiz_data
+    if mode == 'study' and parse_in_progress():
+        render_parse_progress()
+
     if mode == 'review':
          # Đảm bảo list review_q tồn tại và không rỗng
          if not st.session_state.score or not st.session_state.score.get('review_q'):
@@ -427,12 +3840,63 @@ def render_quiz_main():
               set_mode('result')
               st.rerun()
               return
+
+    render_quiz_pane(mode)
+
+# Số ô mỗi trang của bảng điều hướng câu hỏi (giữ chi phí vẽ không đổi theo độ dài đề)
+QUESTION_GRID_PAGE = 50
+QUESTION_GRID_COLUMNS = 10
+
+@instrument_render
+def render_question_grid(mode, total_questions):
+    """Bảng điều hướng: nhảy thẳng tới câu k (ô nhập số) và lưới các câu quanh câu hiện tại."""
+    current = st.session_state.current_index
+    answers = st.session_state.exam_answers if mode == 'exam' else None
+
+    # Đồng bộ ô nhập với câu hiện tại (có thể đã đổi bằng nút điều hướng)
+    st.session_state[f"jump_{mode}"] = current + 1
+    st.number_input(
+        "Đi tới câu", min_value=1, max_value=total_questions, key=f"jump_{mode}",
+        on_change=lambda: go_to_question(st.session_state[f"jump_{mode}"] - 1)
+    )
+    if answers is not None:
+        st.caption(f"Đã trả lời {len(answers) - answers.count(-1)}/{len(answers)} câu (✓: đã trả lời)")
+
+    page_start = current // QUESTION_GRID_PAGE * QUESTION_GRID_PAGE
+    page_end = min(page_start + QUESTION_GRID_PAGE, total_questions)
+    columns = st.columns(QUESTION_GRID_COLUMNS)
+    for i in range(page_start, page_end):
+        answered = answers is not None and answers[i] >= 0
+        columns[(i - page_start) % QUESTION_GRID_COLUMNS].button(
+            f"{'✓' if answered else ''}{i + 1}", key=f"grid_{mode}_{i}",
+            type="primary" if i == current else "secondary",
+            on_click=go_to_question, args=(i,), use_container_width=True
+        )
+
+@st.fragment
+@instrument_render
+def render_quiz_pane(mode):
+    """
+    Khung câu hỏi, nút điều hướng và phiếu trả lời được vẽ lại độc lập (fragment): chọn đáp án hay
+    chuyển câu chỉ chạy lại phần này, không chạy lại sidebar và các màn hình khác.
+    """
+    if st.session_state.bank_id is not None and not len(current_bank()):
+        # Đề đã bị giải phóng (phiên không hoạt động quá lâu): chạy lại toàn bộ script để quay về màn hình tải file
+        st.rerun()
+    if mode == 'srs':
+        render_srs_question()
+        return
+
+    data_to_display = st.session_state.exam_attempt if mode == 'exam' else current_bank()
+    if mode == 'review':
          data_to_display = st.session_state.score['review_q'] # Chỉ là index của câu hỏi sai
          
     data_len = len(data_to_display)
 
     if data_len > 0 and st.session_state.current_index < data_len:
         render_question(st.session_state.current_index, mode)
+        if st.toggle("Bảng điều hướng câu hỏi", key=f"show_grid_{mode}"):
+            render_question_grid(mode, data_len)
     elif data_len > 0:
         # Trường hợp đã hoàn thành (Study/Review)
         st.success(f"Bạn đã hoàn thành toàn bộ phần {'ôn lại' if mode == 'review' else 'ôn luyện'}!")
@@ -440,6 +3904,78 @@ def render_quiz_main():
              st.session_state.current_mode = 'result'
              st.rerun()
 
+def answer_srs_question(i, correct, grade):
+    """Callback: ghi điểm nhớ của câu vừa ôn và chuyển sang câu tiếp theo."""
+    record_review_answer(i, correct, grade)
+    st.session_state.srs_current = None
+    st.session_state.srs_seq += 1
+
+def study_ahead():
+    st.session_state.srs_ahead = True
+
+@instrument_render
+def render_srs_question():
+    """Một lượt ôn tập: câu do lịch SM-2 chọn, chấm ngay, người học tự đánh giá mức độ nhớ nếu trả lời đúng."""
+    bank = current_bank()
+    scheduler = current_scheduler()
+    if scheduler is None:
+        st.error("Đề chưa phân tích xong, chưa thể ôn tập.")
+        return
+
+    i = st.session_state.srs_current
+    if i is None:
+        # Đọc thêm thay đổi từ phiên khác của cùng người học (chỉ các câu mới cập nhật)
+        scheduler.refresh()
+        i = scheduler.next_item(ahead=st.session_state.srs_ahead)
+        st.session_state.srs_current = i
+    stats = scheduler.stats()
+    st.caption(
+        f"Người học: **{current_learner()}** · Đến hạn: {stats['due']} · Câu mới: {stats['new']} · "
+        f"Đã học: {stats['learned']}"
+    )
+    if i is None:
+        st.success("🎉 Bạn đã ôn hết các câu đến hạn!")
+        if stats['next_due'] is not None:
+            st.info(f"Câu tiếp theo đến hạn sau {format_interval(max(0, stats['next_due'] - time.time()))}.")
+            st.button("Ôn trước hạn", key="srs_study_ahead", on_click=study_ahead)
+        return
+
+    card = scheduler.card(i)
+    st.markdown(f"**Câu {i + 1} / {len(bank)}** · " + ("câu mới" if card is None else f"đã ôn {card[3]} lần liên tiếp"))
+    st.markdown(f"#### {bank.question(i)}")
+    radio_key = f"srs_q_{st.session_state.srs_seq}"
+    st.radio(
+        "Chọn đáp án:",
+        options=range(bank.option_count(i)),
+        format_func=lambda k: format_option(bank, i, k),
+        key=radio_key,
+        index=None
+    )
+    selected = st.session_state.get(radio_key)
+    if selected is None:
+        return
+
+    correct = selected == bank.correct_index(i)
+    if correct:
+        st.success("✅ Chính xác! Bạn nhớ câu này ở mức nào?")
+    else:
+        st.error("❌ Sai rồi.")
+    st.info(f"Đáp án đúng là: **{get_correct_answer_text(bank, i)}**")
+    st.markdown("---")
+    if correct:
+        # Mỗi nút hiện khoảng cách tới lần ôn sau nếu chọn mức đó
+        for column, (label, grade) in zip(st.columns(len(SRS_CORRECT_GRADES)), SRS_CORRECT_GRADES):
+            column.button(
+                f"{label} · {format_interval(scheduler.preview(i, grade))}", key=f"srs_grade_{grade}",
+                on_click=answer_srs_question, args=(i, True, grade), use_container_width=True
+            )
+    else:
+        st.button(
+            f"Câu tiếp theo >> (ôn lại sau {format_interval(scheduler.preview(i, SRS_GRADE_WRONG))})",
+            key="srs_next", on_click=answer_srs_question, args=(i, False, SRS_GRADE_WRONG)
+        )
+
+@instrument_render
 def render_result_screen():
     """Màn hình kết quả sau khi nộp bài."""
     score = st.session_state.score
@@ -449,6 +3985,10 @@ def render_result_screen():
         return
 
     st.header("🎉 KẾT QUẢ KIỂM TRA")
+    if score.get('reproducible', True):
+        st.caption(f"Mã đề: {score['seed']} (nhập lại mã này trong tùy chọn bài kiểm tra để làm lại đúng bài này)")
+    else:
+        st.caption(f"Mã đề: {score['seed']} (lấy mẫu theo độ khó thay đổi theo lịch ôn tập nên không tạo lại được đúng bài này)")
     st.markdown("---")
     
     # Tính điểm và tỷ lệ phần trăm
@@ -490,25 +4030,47 @@ def render_result_screen():
 
 # Sidebar Navigation/Status
 st.sidebar.title("Trạng thái và Cấu hình")
-if st.session_state.quiz_data:
-    st.sidebar.markdown(f"**Tổng câu hỏi:** **{len(st.session_state.quiz_data)}**")
+if len(current_bank()):
+    st.sidebar.markdown(f"**Tổng câu hỏi:** **{len(current_bank())}**")
     st.sidebar.markdown(f"**Chế độ hiện tại:** {st.session_state.current_mode.capitalize()}")
-
-    if st.session_state.current_mode not in ['menu', 'upload']:
-        st.sidebar.markdown(f"**Vị trí:** Câu **{st.session_state.current_index + 1}**")
+    # Vị trí câu hiện tại được hiển thị trong khung câu hỏi (fragment) để luôn cập nhật
+st.sidebar.text_input(
+    "Người học", key="learner", placeholder=SRS_DEFAULT_USER, help="Tiến độ ôn tập ngắt quãng được lưu theo tên này.",
+    on_change=lambda: st.query_params.update(user=st.session_state.learner.strip())
+)
 
 # Hiển thị các màn hình dựa trên mode
 if st.session_state.current_mode == 'upload' or st.session_state.current_mode == 'menu':
     render_upload_screen()
 elif st.session_state.current_mode == 'result':
     render_result_screen()
-elif st.session_state.current_mode in ['study', 'exam', 'review']:
+elif st.session_state.current_mode in ['study', 'exam', 'review', 'srs']:
     render_quiz_main()
 
 # Lưu ý quan trọng cho người dùng về API Key và thư viện
 st.sidebar.markdown("---")
 st.sidebar.markdown("💡 **Lưu ý:**")
-st.sidebar.markdown("- Ứng dụng cần thư viện `python-docx` (`pip install python-docx`).")
 st.sidebar.markdown("- Cần cấu hình Khóa API **'GEMINI_API_KEY'** trong Streamlit Secrets để phân tích file Word.")
+cache_stats = parse_cache_stats()
+if cache_stats:
+    st.sidebar.caption(
+        f"Cache phân tích: {cache_stats['entries']} file, {cache_stats['bytes'] / 1024:.0f} KB "
+        f"(hit {cache_stats['hits']} / miss {cache_stats['misses']})"
+    )
+if st.query_params.get("admin") == "1":
+    render_bank_registry_admin()
+if st.query_params.get("debug") == "1":
+    render_metrics_debug_panel()
 if not API_KEY:
      st.sidebar.error("⚠️ THIẾU API KEY! Vui lòng cấu hình ngay.")
+
+record_startup("first script run", time.perf_counter() - _SCRIPT_START)
+
+# Thời gian một lần chạy script (không tính các lần chạy lại riêng của fragment)
+if _METRICS is not None:
+    _METRICS.observe("quiz_script_run_seconds", time.perf_counter() - _SCRIPT_START)
+    if METRICS_FILE:
+        try:
+            _METRICS.export(METRICS_FILE)
+        except OSError:
+            pass
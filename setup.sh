@@ -9,3 +9,8 @@ headless = true\n\
 enableCORS=false\n\
 port = $PORT\n\
 " > ~/.streamlit/config.toml
+# Nạp trước cache phân tích (xem prewarm.py) ở nền: server bind $PORT ngay (không vượt thời hạn khởi động
+# của nền tảng dù thư mục đề lớn), file nào đã nạp xong thì người dùng nhận đề ngay từ cache
+if [ -n "$QUIZ_PREWARM_DIR" ]; then
+    python prewarm.py "$QUIZ_PREWARM_DIR" --workers "${QUIZ_PREWARM_WORKERS:-2}" &
+fi
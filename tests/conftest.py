@@ -0,0 +1,43 @@
+"""
+Cấu hình chung cho pytest: cache phân tích và nhật ký ôn tập ghi vào thư mục tạm (không đụng tới dữ
+liệu thật), rồi nạp ứng dụng như một module (các hàm Streamlit chạy ở chế độ "bare", không cần server).
+"""
+import logging
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+_WORKDIR = tempfile.mkdtemp(prefix="quiz_tests_")
+os.environ.setdefault("QUIZ_PARSE_CACHE_PATH", os.path.join(_WORKDIR, "parse_cache.sqlite3"))
+os.environ.setdefault("QUIZ_SRS_PATH", os.path.join(_WORKDIR, "review.sqlite3"))
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+
+@pytest.fixture(scope="session")
+def app():
+    import quiz_app_streamlit
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith("streamlit"):
+            logging.getLogger(name).setLevel(logging.ERROR)
+    return quiz_app_streamlit
+
+
+@pytest.fixture
+def empty_parse_cache(app, tmp_path, monkeypatch):
+    """Cache phân tích trống riêng cho một test (để mọi đoạn đều thực sự gọi client giả lập)."""
+    monkeypatch.setattr(app, "PARSE_CACHE_PATH", str(tmp_path / "parse_cache.sqlite3"))
+
+
+@pytest.fixture
+def gemini(app, monkeypatch):
+    """GeminiClientManager riêng cho một test: không giới hạn tốc độ, không ngủ thật (ghi lại thời gian chờ)."""
+    manager = app.GeminiClientManager(rpm=0, tpm=0, sleep=lambda seconds: manager.sleeps.append(seconds), seed=0)
+    manager.sleeps = []
+    monkeypatch.setattr(app, "_GEMINI", manager)
+    return manager
@@ -0,0 +1,25 @@
+"""Kho đề dùng chung: lease của phiên được gia hạn khi đọc đề, kể cả khi chỉ một fragment chạy lại."""
+import time
+
+import streamlit as st
+
+
+def test_reading_the_bank_renews_the_lease(app, monkeypatch):
+    registry = app.BankRegistry()
+    monkeypatch.setattr(app, "get_bank_registry", lambda: registry)
+    bank = app.QuizBank([{"question": "Câu hỏi", "options": ["a", "b"], "correct_answer": "A"}])
+    st.session_state.session_uid = "session"
+    st.session_state.bank_id = registry.register(bank, "session")
+    # Lần chạy toàn bộ script gần nhất đã cách đây 20 phút (VD: đang làm bài kiểm tra dài)
+    registry._leases[st.session_state.bank_id]["session"] -= 20 * 60
+
+    assert len(app.current_bank()) == 1
+    registry.evict_idle(time.time() + app.BANK_IDLE_TTL - 60)
+    assert len(app.current_bank()) == 1
+
+
+def test_idle_bank_is_evicted(app):
+    registry = app.BankRegistry()
+    bank_id = registry.register(app.QuizBank([{"question": "q", "options": ["a", "b"], "correct_answer": "B"}]), "s")
+    assert registry.evict_idle(time.time() + app.BANK_IDLE_TTL + 1) == 1
+    assert registry.get(bank_id) is None
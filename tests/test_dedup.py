@@ -0,0 +1,53 @@
+"""Gộp câu gần trùng (MinHash + LSH): chỉ gộp bản sao cùng đáp án, câu khác nhau không bao giờ bị gộp."""
+
+CAPITAL = {
+    "question": "Thủ đô của nước Cộng hòa Xã hội Chủ nghĩa Việt Nam là thành phố nào?",
+    "options": ["Hà Nội", "Huế", "Đà Nẵng", "Thành phố Hồ Chí Minh"],
+    "correct_answer": "A",
+}
+OTHER = [
+    {"question": "Sông nào dài nhất Việt Nam tính theo phần chảy trên lãnh thổ?", "options": ["Sông Đồng Nai", "Sông Hồng"], "correct_answer": "A"},
+    {"question": "Đỉnh núi cao nhất Việt Nam có tên là gì?", "options": ["Fansipan", "Bà Đen"], "correct_answer": "A"},
+    {"question": "Tỉnh nào có diện tích lớn nhất nước ta hiện nay?", "options": ["Nghệ An", "Gia Lai"], "correct_answer": "A"},
+]
+
+
+def test_duplicate_with_reordered_options_is_collapsed(app):
+    reordered = {
+        "question": "Câu 7: " + CAPITAL["question"],
+        "options": ["Huế", "Thành phố Hồ Chí Minh", "Hà Nội", "Đà Nẵng"],
+        "correct_answer": "C",
+    }
+    bank = app.QuizBank([CAPITAL] + OTHER + [reordered])
+    deduped, report, index_map = app.dedupe_bank(bank)
+
+    assert len(deduped) == 4
+    assert report['duplicates'] == 1 and report['groups'] == [(0, 1)] and report['conflicts'] == []
+    assert deduped.to_quiz_data()[0] == CAPITAL
+    assert index_map == [0, 1, 2, 3, 0]
+
+
+def test_copies_that_differ_only_in_the_answer_are_a_conflict(app):
+    wrong = dict(CAPITAL, correct_answer="B")
+    bank = app.QuizBank([CAPITAL] + OTHER + [wrong])
+    deduped, report, index_map = app.dedupe_bank(bank)
+
+    assert len(deduped) == 5
+    assert report['duplicates'] == 0 and report['groups'] == []
+    assert report['conflicts'] == [[0, 4]]
+    assert [deduped.correct_index(i) for i in (0, 4)] == [0, 1]
+    assert index_map == [0, 1, 2, 3, 4]
+
+
+def test_unrelated_questions_are_never_merged(app):
+    # Cùng khuôn câu hỏi, khác nội dung: nhiều shingle chung nhưng dưới ngưỡng Jaccard
+    templated = [
+        {"question": f"Kết quả của phép tính {a} cộng {a + 1} bằng bao nhiêu?", "options": [str(2 * a + 1), str(2 * a)], "correct_answer": "A"}
+        for a in range(1, 40)
+    ]
+    bank = app.QuizBank([CAPITAL] + OTHER + templated)
+    deduped, report, index_map = app.dedupe_bank(bank)
+
+    assert deduped is bank
+    assert report == {'duplicates': 0, 'groups': [], 'conflicts': []}
+    assert index_map == list(range(len(bank)))
@@ -0,0 +1,60 @@
+"""Đọc .docx theo luồng (iterparse): thứ tự đoạn văn, nội dung ô bảng và nhận diện định dạng đánh dấu."""
+import io
+
+from docx import Document
+from docx.enum.text import WD_COLOR_INDEX
+from make_docx import LABELS, write_exam_docx
+
+
+def _blocks(app, path):
+    with open(path, "rb") as f:
+        return list(app.iter_docx_blocks(f))
+
+
+def test_paragraph_order_and_table_cells(app, tmp_path):
+    path = tmp_path / "de.docx"
+    # tables=True: câu 5 có các lựa chọn nằm trong một hàng bảng 4 ô
+    answers = write_exam_docx(path, 6, tables=True)
+    blocks = _blocks(app, path)
+    texts = [text for text, _ in blocks]
+
+    assert texts[:2] == ["SỞ GIÁO DỤC VÀ ĐÀO TẠO - TRƯỜNG THPT MẪU", "ĐỀ KIỂM TRA TRẮC NGHIỆM - Thời gian làm bài: 45 phút"]
+    starts = [next(k for k, text in enumerate(texts) if text.startswith(f"Câu {i}:")) for i in range(1, 7)]
+    assert starts == sorted(starts)
+    # Câu 1: cả bốn lựa chọn trên một dòng, rồi dòng đáp án
+    assert texts[starts[0] + 1].startswith("A. ") and " D. " in texts[starts[0] + 1]
+    assert texts[starts[0] + 2] == f"Đáp án đúng là {answers[0]}"
+    # Câu 5: hàng bảng thành một block, các ô cách nhau bởi tab, theo thứ tự ô
+    row = texts[starts[4] + 1].split("\t")
+    assert [cell[:2] for cell in row] == [f"{label}." for label in LABELS]
+    assert texts[starts[4] + 2] == f"Đáp án: {answers[4]}"
+    assert len(texts) == starts[5] + 6
+
+
+def test_bold_option_is_marked(app, tmp_path):
+    path = tmp_path / "de.docx"
+    answers = write_exam_docx(path, 2)
+    blocks = _blocks(app, path)
+    start = next(k for k, (text, _) in enumerate(blocks) if text.startswith("Câu 2:"))
+    # Câu 2: đáp án đúng được in đậm cả dòng, các lựa chọn khác không có đánh dấu
+    options = blocks[start + 1:start + 5]
+    assert [bool(marks) for _, marks in options] == [label == answers[1] for label in LABELS]
+    marked_text, marks = options[LABELS.index(answers[1])]
+    assert marks == ((0, len(marked_text)),)
+
+
+def test_underline_and_highlight_are_marks(app):
+    document = Document()
+    paragraph = document.add_paragraph("A. ")
+    paragraph.add_run("gạch chân").underline = True
+    paragraph.add_run(" và ")
+    paragraph.add_run("tô sáng").font.highlight_color = WD_COLOR_INDEX.YELLOW
+    paragraph.add_run(" và ")
+    paragraph.add_run("không đậm").bold = False
+    buffer = io.BytesIO()
+    document.save(buffer)
+    buffer.seek(0)
+
+    ((text, marks),) = list(app.iter_docx_blocks(buffer))
+    assert text == "A. gạch chân và tô sáng và không đậm"
+    assert [text[start:end] for start, end in marks] == ["gạch chân", "tô sáng"]
@@ -0,0 +1,36 @@
+"""Bài kiểm tra dựng theo tùy chọn ở menu, đọc tại thời điểm bấm bắt đầu."""
+import streamlit as st
+
+
+def _start_with_bank(app, monkeypatch, count):
+    registry = app.BankRegistry()
+    monkeypatch.setattr(app, "get_bank_registry", lambda: registry)
+    questions = [{"question": f"Câu {i}", "options": ["a", "b", "c"], "correct_answer": "A"} for i in range(count)]
+    st.session_state.session_uid = "session"
+    st.session_state.bank_id = registry.register(app.QuizBank(questions), "session")
+    for key in ("exam_size", "exam_strata", "exam_seed", "exam_shuffle_questions", "exam_shuffle_options"):
+        st.session_state.pop(key, None)
+
+
+def test_default_exam_is_the_whole_bank_in_order(app, monkeypatch):
+    _start_with_bank(app, monkeypatch, 80)
+    attempt = app.new_exam_attempt(app.exam_config())
+    assert list(attempt.questions) == list(range(80))
+    assert all(list(attempt.permutation(j)) == [0, 1, 2] for j in range(80))
+
+
+def test_exam_uses_the_options_chosen_in_the_same_run(app, monkeypatch):
+    _start_with_bank(app, monkeypatch, 80)
+    st.session_state.exam_size = 10
+    st.session_state.exam_seed = 7
+    st.session_state.exam_shuffle_questions = True
+    attempt = app.new_exam_attempt(app.exam_config())
+    assert len(attempt.questions) == 10
+    assert attempt.seed == 7
+    assert list(attempt.questions) == list(app.new_exam_attempt(app.exam_config()).questions)
+
+
+def test_only_fixed_strata_are_reproducible(app, monkeypatch):
+    _start_with_bank(app, monkeypatch, 20)
+    assert app.new_exam_attempt({'strata': 'none', 'seed': 3}).reproducible
+    assert not app.new_exam_attempt({'strata': 'difficulty', 'seed': 3}).reproducible
@@ -0,0 +1,75 @@
+"""Client Gemini dùng chung: hạn mức tốc độ, thử lại lỗi tạm thời (backoff) và thử lại đoạn trả về lỗi."""
+import pytest
+from fake_gemini import FakeGeminiClient
+from google.genai.errors import APIError
+
+
+def _chunks(count):
+    return [f"Câu {i}: Hỏi số {i}?\nA. Có\nB. Không\nĐáp án: B" for i in range(1, count + 1)]
+
+
+def _api_error(code):
+    return APIError(code, {"error": {"code": code, "message": "Giả lập"}})
+
+
+def test_rate_limited_requests_are_retried_with_backoff(app, gemini, empty_parse_cache):
+    client = FakeGeminiClient(rate_limit_every=2)
+    results = app.parse_chunks_with_gemini(_chunks(5), client, max_workers=1)
+
+    assert [result[0]["question"] for result in results] == [f"Hỏi số {i}?" for i in range(1, 6)]
+    # Mỗi lần gọi thứ chẵn bị 429: mỗi đoạn trừ đoạn đầu bị từ chối một lần rồi thành công
+    assert client.models.calls == 9
+    assert len(gemini.sleeps) == 4
+    assert all(gemini.backoff_base / 2 <= delay <= gemini.backoff_base for delay in gemini.sleeps)
+
+
+def test_retries_stop_after_max_retries(app, gemini):
+    calls = []
+
+    def request():
+        calls.append(None)
+        raise _api_error(503)
+
+    with pytest.raises(APIError):
+        gemini.call(request, tokens=1)
+    assert len(calls) == gemini.max_retries + 1
+    # Thời gian chờ tăng theo hàm mũ (nửa cố định, nửa ngẫu nhiên) và không vượt backoff_max
+    for attempt, delay in enumerate(gemini.sleeps):
+        cap = min(gemini.backoff_max, gemini.backoff_base * 2 ** attempt)
+        assert cap / 2 <= delay <= cap
+
+
+def test_permanent_errors_are_not_retried(app, gemini):
+    calls = []
+
+    def request():
+        calls.append(None)
+        raise _api_error(400)
+
+    with pytest.raises(APIError):
+        gemini.call(request, tokens=1)
+    assert len(calls) == 1 and gemini.sleeps == []
+
+
+def test_invalid_responses_are_retried_per_chunk(app, gemini, empty_parse_cache):
+    client = FakeGeminiClient(fail_every=3)
+    results = app.parse_chunks_with_gemini(_chunks(4), client, max_workers=1)
+
+    assert [len(result) for result in results] == [1, 1, 1, 1]
+    assert client.models.calls == 5
+    assert gemini.sleeps == []
+
+
+def test_requests_wait_for_the_rate_limit(app, gemini):
+    now = [0.0]
+    gemini._requests = app.TokenBucket(60, clock=lambda: now[0])
+    gemini._tokens = app.TokenBucket(600, clock=lambda: now[0])
+    gemini._sleep = lambda seconds: now.__setitem__(0, now[0] + seconds)
+
+    assert sum(gemini.acquire(1) for _ in range(60)) == 0
+    # Hết 60 request của phút đầu: request tiếp theo chờ một lượt nạp lại (1 giây)
+    assert gemini.acquire(1) == pytest.approx(1.0)
+    # Hạn mức token cũng được áp dụng: 600 token/phút = 10 token/giây
+    now[0] += 60
+    assert gemini.acquire(600) == 0
+    assert gemini.acquire(50) == pytest.approx(5.0)
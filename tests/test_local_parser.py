@@ -0,0 +1,84 @@
+"""Bộ phân tích cục bộ: đáp án suy ra từ định dạng (in đậm/gạch chân) và dòng "Đáp án"."""
+import io
+
+from docx import Document
+
+QUESTION = [("Câu 1: 2 + 2 = ?", [])]
+# Chỉ nhãn "A." ... "D." được in đậm (nhiều đề in đậm nhãn để dễ đọc), nội dung lựa chọn thì không
+BOLD_LABELS = [(line, [(0, 2)]) for line in ("A. 4", "B. 22222", "C. 5555", "D. 3333")]
+
+
+def test_bold_labels_are_not_an_answer_mark(app):
+    entries = app.parse_quiz_locally(iter(QUESTION + BOLD_LABELS))
+    assert [kind for kind, _ in entries] == ['remote']
+
+
+def test_bold_labels_with_answer_line_stay_local(app):
+    entries = app.parse_quiz_locally(iter(QUESTION + BOLD_LABELS + [("Đáp án: B", [])]))
+    assert entries == [('local', {'question': '2 + 2 = ?', 'options': ['4', '22222', '5555', '3333'], 'correct_answer': 'B'})]
+
+
+def test_bold_option_text_is_the_answer(app):
+    lines = [("A. 4", []), ("B. 22222", [(3, 8)]), ("C. 5555", []), ("D. 3333", [])]
+    entries = app.parse_quiz_locally(iter(QUESTION + lines))
+    assert entries[0][0] == 'local'
+    assert entries[0][1]['correct_answer'] == 'B'
+
+
+ANSWERED = [("Câu 1: 2 + 2 = ?", []), ("A. 3", []), ("B. 4", []), ("Đáp án: B", [])]
+NEXT = [("Câu 2: 3 + 3 = ?", []), ("A. 6", []), ("B. 5", []), ("Đáp án: A", [])]
+
+
+def test_explanation_after_the_answer_line_is_skipped(app):
+    explanation = [("Lời giải: vì 2 + 2 = 4", []), ("Cộng hai số rồi so sánh. Chọn A sai.", [])]
+    entries = app.parse_quiz_locally(iter(ANSWERED + explanation + NEXT))
+    assert entries == [
+        ('local', {'question': '2 + 2 = ?', 'options': ['3', '4'], 'correct_answer': 'B'}),
+        ('local', {'question': '3 + 3 = ?', 'options': ['6', '5'], 'correct_answer': 'A'}),
+    ]
+
+
+def test_unknown_line_after_the_answer_line_is_sent_to_gemini(app):
+    entries = app.parse_quiz_locally(iter(ANSWERED + [("vì 2 + 2 = 4", [])] + NEXT))
+    assert [kind for kind, _ in entries] == ['remote', 'local']
+    assert "vì 2 + 2 = 4" in entries[0][1]
+
+
+def test_page_number_after_the_answer_line_is_ignored(app):
+    entries = app.parse_quiz_locally(iter(ANSWERED + [("Trang 2/5", []), ("", [])] + NEXT))
+    assert [kind for kind, _ in entries] == ['local', 'local']
+    assert entries[0][1]['options'] == ['3', '4']
+
+
+def test_horizontal_answer_key_table(app):
+    questions = []
+    for number in range(1, 5):
+        questions += [(f"Câu {number}: Câu hỏi số {number}?", []), ("A. Có", []), ("B. Không", []), ("C. Chưa rõ", [])]
+    # Bảng đáp án nằm ngang, chia làm hai khối (các ô của một hàng bảng được nối bằng tab)
+    key = [
+        ("BẢNG ĐÁP ÁN", []),
+        ("Câu\t1\t2\t3", []), ("Đáp án\tB\tC\tA", []),
+        ("Câu\t4", []), ("ĐA\tb", []),
+    ]
+    entries = app.parse_quiz_locally(iter(questions + key))
+    assert [kind for kind, _ in entries] == ['local'] * 4
+    assert [question['correct_answer'] for _, question in entries] == ['B', 'C', 'A', 'B']
+
+
+def test_horizontal_answer_key_table_from_docx(app):
+    document = Document()
+    for line in ("Câu 1: Một cộng một?", "A. 1", "B. 2", "Câu 2: Hai cộng hai?", "A. 4", "B. 5"):
+        document.add_paragraph(line)
+    table = document.add_table(rows=2, cols=3)
+    for row, cells in zip(table.rows, (("Câu", "1", "2"), ("Đáp án", "B", "A"))):
+        for cell, value in zip(row.cells, cells):
+            cell.text = value
+    buffer = io.BytesIO()
+    document.save(buffer)
+    buffer.seek(0)
+
+    entries = app.parse_quiz_locally(app.iter_docx_blocks(buffer))
+    assert entries == [
+        ('local', {'question': 'Một cộng một?', 'options': ['1', '2'], 'correct_answer': 'B'}),
+        ('local', {'question': 'Hai cộng hai?', 'options': ['4', '5'], 'correct_answer': 'A'}),
+    ]
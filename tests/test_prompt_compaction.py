@@ -0,0 +1,91 @@
+"""Rút gọn văn bản trước khi gửi Gemini: chỉ bỏ phần thủ tục, không bỏ nội dung câu hỏi."""
+
+STEM = "Chọn phát biểu đúng về hàm số sau:"
+HEADER = "Ôn tập chương 1 - Giải tích 12"
+
+
+def _document(count, header_every=2):
+    lines = []
+    for i in range(1, count + 1):
+        if i % header_every == 1:
+            lines += [HEADER, f"Trang {i // header_every + 1}"]
+        lines += [f"Câu {i}:", STEM, f"y = x^{i} + {i}", "A. Đồng biến", "B. Nghịch biến", "Đáp án: A"]
+    return "\n".join(lines)
+
+
+def test_repeated_question_stems_are_kept(app):
+    text = _document(6)
+    compact = app.compact_quiz_text(text)
+    assert compact.count(STEM) == 6
+    assert all(f"y = x^{i} + {i}" in compact for i in range(1, 7))
+
+
+def test_repeated_lines_outside_questions_are_dropped(app):
+    compact = app.compact_quiz_text(_document(6))
+    assert HEADER not in compact
+    assert "Trang 2" not in compact
+    assert app.repeated_lines([_document(6)]) == {HEADER}
+
+
+def test_repeated_lines_are_counted_across_parts(app):
+    parts = [_document(2), _document(2), _document(2)]
+    repeated = app.repeated_lines(parts)
+    assert repeated == {HEADER}
+    assert all(app.compact_quiz_text(part, repeated).count(STEM) == 2 for part in parts)
+
+
+def _exam(count):
+    """Đề có header/số trang lặp lại giữa các câu, kèm các câu hỏi mà tài liệu sau khi phân tích phải có."""
+    lines, expected = [], []
+    for i in range(1, count + 1):
+        if i % 10 == 1:
+            lines += ["SỞ GIÁO DỤC VÀ ĐÀO TẠO - TRƯỜNG THPT MẪU", HEADER, f"Trang {i // 10 + 1}"]
+        lines += [f"Câu {i}:", STEM, f"y = x^{i} + {i}", f"A. Đồng biến trên ({i}; +∞)", "B. Nghịch biến", "Đáp án: B"]
+        expected.append({
+            "question": f"{STEM}\ny = x^{i} + {i}",
+            "options": [f"Đồng biến trên ({i}; +∞)", "Nghịch biến"],
+            "correct_answer": "B",
+        })
+    return "\n".join(lines), expected
+
+
+def test_compacted_document_keeps_every_question(app, gemini, empty_parse_cache, monkeypatch):
+    from fake_gemini import FakeGeminiClient
+
+    monkeypatch.setattr(app, "PROMPT_COMPACTION", True)
+    text, expected = _exam(120)
+    tokens = app.TokenUsage()
+    questions = app.parse_quiz_data_with_gemini.__wrapped__(text, None, 1500, _client=FakeGeminiClient(), _tokens=tokens)
+
+    assert questions == expected
+    assert tokens.sent < tokens.raw
+
+
+def test_every_request_fits_the_token_budget(app, gemini, empty_parse_cache):
+    from fake_gemini import FakeGeminiClient
+
+    client = FakeGeminiClient()
+    prompts = []
+    generate = client.models.generate_content
+
+    def record(model, contents, config=None):
+        prompts.append(contents)
+        return generate(model, contents, config)
+
+    client.models.generate_content = record
+    text, expected = _exam(400)
+    # Một đoạn theo chunk_tokens lớn hơn nhiều so với hạn mức mỗi request: phải được chia tiếp
+    questions = app.parse_quiz_data_with_gemini.__wrapped__(
+        text, None, 10 * app.GEMINI_REQUEST_TOKEN_BUDGET, _client=client
+    )
+
+    assert questions == expected
+    assert len(prompts) > 1
+    assert all(app.estimate_tokens(prompt) <= app.GEMINI_REQUEST_TOKEN_BUDGET for prompt in prompts)
+
+
+def test_oversized_lines_are_split_within_the_budget(app):
+    budget = app.PROMPT_OVERHEAD_TOKENS + 50
+    chunks = app.enforce_token_budget(["x" * 1000, "Câu 1: ngắn"], budget)
+    assert all(app.estimate_tokens(chunk) <= 50 for chunk in chunks)
+    assert "".join(chunks[:-1]) == "x" * 1000 and chunks[-1] == "Câu 1: ngắn"
@@ -0,0 +1,31 @@
+"""File đề .qbank: nạp lại đúng nội dung, và mọi lỗi dữ liệu được phát hiện ngay khi nạp (ValueError)."""
+import struct
+
+import pytest
+
+QUESTIONS = [
+    {"question": "Đâu là thủ đô của Việt Nam?", "options": ["Đà Nẵng", "Hà Nội", "Huế"], "correct_answer": "B"},
+    {"question": "Đâu là sông dài nhất?", "options": ["Mê Kông", "Hồng"], "correct_answer": "A"},
+]
+
+
+def test_round_trip(app):
+    bank = app.load_qbank(app.export_qbank(app.QuizBank(QUESTIONS)))
+    assert bank.to_quiz_data() == QUESTIONS
+
+
+def test_invalid_utf8_is_rejected_at_load(app):
+    data = bytearray(app.export_qbank(app.QuizBank(QUESTIONS)))
+    data[-1] = 0xFF
+    with pytest.raises(ValueError, match="UTF-8"):
+        app.load_qbank(bytes(data))
+
+
+def test_string_offset_inside_a_character_is_rejected_at_load(app):
+    data = bytearray(app.export_qbank(app.QuizBank(QUESTIONS)))
+    # Chuỗi thứ hai (câu hỏi thứ hai) bắt đầu lệch một byte, vào giữa ký tự "Đ"; cả vùng chuỗi vẫn là UTF-8 hợp lệ
+    position = app.QBANK_HEADER.size + 4
+    (offset,) = struct.unpack_from("<I", data, position)
+    struct.pack_into("<I", data, position, offset + 1)
+    with pytest.raises(ValueError, match="UTF-8"):
+        app.load_qbank(bytes(data))
@@ -0,0 +1,49 @@
+"""Lịch ôn tập SM-2: đồng bộ giữa các phiên của cùng người học mà không ghi đĩa trong luồng script."""
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+
+def _scheduler(app, log, user="hv"):
+    keys = np.arange(100, 110, dtype=np.int64)
+    return app.ReviewScheduler(user, keys, np.ones(len(keys), dtype=bool), log)
+
+
+def test_refresh_reads_pending_answers_without_flushing(app, tmp_path):
+    log = app.AttemptLog(str(tmp_path / "review.sqlite3"), flush_seconds=3600)
+    first, second, other = _scheduler(app, log), _scheduler(app, log), _scheduler(app, log, user="khac")
+    card = first.answer(3, True)
+
+    assert second.refresh() == 1
+    assert second.card(3) == card
+    assert other.refresh() == 0
+    assert log.written == 0 and log.stats()['pending'] == 1
+
+    # Khi luồng nền ghi xong, lần nạp sau đọc lại câu đó nhưng không coi là thay đổi
+    assert log.flush() == 1
+    assert second.refresh() == 0
+    assert _scheduler(app, log).card(3) == card
+
+
+def test_flush_waiting_for_the_write_lock_is_not_missed_by_readers(app, tmp_path):
+    path = str(tmp_path / "review.sqlite3")
+    log = app.AttemptLog(path, flush_seconds=3600)
+    log.connect().close()
+    # Tiến trình khác đang giữ khóa ghi khi nhật ký này bắt đầu ghi
+    other = sqlite3.connect(path, timeout=30, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    log.record("hv", 1, True, 4, (1.0, 1.0, 2.5, 1, 0, 1.0))
+    writer = threading.Thread(target=log.flush)
+    writer.start()
+    time.sleep(0.2)
+    since = time.time()
+    other.execute("INSERT INTO cards VALUES ('hv', 2, 1.0, 1.0, 2.5, 1, 0, 1.0, ?)", (since,))
+    other.execute("COMMIT")
+    other.close()
+    writer.join()
+
+    # Bên đọc đã thấy dòng của tiến trình kia nên mốc đồng bộ là `since`: dòng ghi sau vẫn phải được đọc
+    keys = np.concatenate([page_keys for page_keys, _ in log.load_cards("hv", since)])
+    assert sorted(keys.tolist()) == [1, 2]
@@ -0,0 +1,38 @@
+"""Chấm điểm vector hóa: đúng/sai, thứ hạng, độ khó, độ phân biệt và thống kê lựa chọn trên ma trận lượt làm."""
+import numpy as np
+
+
+def _bank(app):
+    return app.QuizBank([
+        {"question": "Câu 1", "options": ["a", "b", "c", "d"], "correct_answer": "A"},
+        {"question": "Câu 2", "options": ["a", "b", "c"], "correct_answer": "C"},
+        # Không xác định được đáp án: luôn tính là sai
+        {"question": "Câu 3", "options": ["a", "b"], "correct_answer": "không rõ"},
+    ])
+
+
+def test_score_attempts(app):
+    bank = _bank(app)
+    assert bank.correct_index(2) == -1
+    answers = app.answers_matrix([[0, 2, 0], [1, 2, -1], [-1, 0, 1], [0]], len(bank))
+    result = app.score_attempts(bank, answers)
+
+    assert result['hits'].tolist() == [
+        [True, True, False], [False, True, False], [False, False, False], [True, False, False],
+    ]
+    assert result['scores'].tolist() == [2, 1, 0, 1]
+    assert result['percentiles'].tolist() == [87.5, 50.0, 12.5, 50.0]
+    assert result['difficulty'].tolist() == [0.5, 0.5, 0.0]
+    # Nhóm cao/thấp gồm round(4 * 27%) = 1 lượt: lượt 0 (2 điểm) và lượt 2 (0 điểm)
+    assert result['discrimination'].tolist() == [1.0, 1.0, 0.0]
+    assert result['distractors'].tolist() == [[2, 1, 0, 0], [1, 0, 2, 0], [1, 1, 0, 0]]
+    assert result['unanswered'].tolist() == [1, 1, 2]
+
+
+def test_score_sampled_exam_columns(app):
+    bank = _bank(app)
+    # Bài kiểm tra gồm câu 2 rồi câu 1 của đề
+    result = app.score_attempts(bank, np.array([[2, 1]]), questions=[1, 0])
+    assert result['hits'].tolist() == [[True, False]]
+    assert result['distractors'].tolist() == [[0, 0, 1, 0], [0, 1, 0, 0]]
+    assert result['discrimination'].tolist() == [0.0, 0.0]
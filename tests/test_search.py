@@ -0,0 +1,87 @@
+"""Tìm kiếm toàn văn: bỏ dấu tiếng Việt, tiền tố, phạm vi tìm kiếm và thứ tự xếp hạng BM25."""
+import numpy as np
+
+
+def _bank(app, items):
+    return app.QuizBank([
+        {"question": question, "options": list(options), "correct_answer": "A"} for question, options in items
+    ])
+
+
+def _search(index, app, query, scope='all'):
+    hits, scores, total = index.search(app.parse_search_query(query), scope)
+    return hits.tolist(), scores, total
+
+
+GEOGRAPHY = [
+    ("Thủ đô của Việt Nam là thành phố nào?", ("Hà Nội", "Huế")),
+    ("Thành phố cảng lớn nhất miền Bắc?", ("Hải Phòng", "Đà Nẵng")),
+    ("Sông nào chảy qua Hà Nội?", ("Sông Hồng", "Sông Mã")),
+    ("Đỉnh núi cao nhất Đông Dương?", ("Fansipan", "Bạch Mã")),
+]
+
+
+def test_queries_without_diacritics_match(app):
+    index = app.SearchIndex(_bank(app, GEOGRAPHY))
+    hits, _, total = _search(index, app, "ha noi")
+    assert sorted(hits) == [0, 2] and total == 2
+    assert _search(index, app, "DA NANG")[0] == [1]
+    assert _search(index, app, "đỉnh")[0] == [3]
+
+
+def test_prefix_queries(app):
+    index = app.SearchIndex(_bank(app, GEOGRAPHY))
+    # "ha*" khớp "hà", "hải"; "pho*" khớp "phố", "phòng"
+    assert sorted(_search(index, app, "ha* pho*")[0]) == [0, 1]
+    assert _search(index, app, "fan*")[0] == [3]
+    assert _search(index, app, "fan")[0] == []
+
+
+def test_question_scope_ignores_options(app):
+    index = app.SearchIndex(_bank(app, GEOGRAPHY))
+    assert sorted(_search(index, app, "ha noi")[0]) == [0, 2]
+    assert _search(index, app, "ha noi", scope='question')[0] == [2]
+    assert _search(index, app, "hai phong", scope='question')[0] == []
+
+
+def test_ranking(app):
+    index = app.SearchIndex(_bank(app, [
+        ("Câu hỏi về lịch sử thế giới", ("Hiệp định Paris", "Khác")),
+        ("Hiệp định Paris được ký năm nào?", ("1973", "1954")),
+        ("Hiệp định Paris và hiệp định Giơnevơ khác nhau thế nào?", ("Nội dung", "Thời gian")),
+    ]))
+    hits, scores, total = _search(index, app, "hiep dinh")
+    # Nhiều lần xuất hiện trong câu hỏi > một lần trong câu hỏi > chỉ có trong lựa chọn
+    assert hits == [2, 1, 0] and total == 3
+    assert np.all(np.diff(scores) < 0)
+
+
+def test_question_scope_idf_ignores_option_only_matches(app):
+    # Cùng độ dài mọi câu hỏi và lựa chọn; chỉ khác ở chỗ từ "paris" có trong lựa chọn của các câu khác
+    question = [("Thủ đô nước Pháp là Paris", ("Đúng", "Sai"))]
+    with_options = question + [(f"Câu hỏi số {i} khác", ("Paris", "Roma")) for i in range(5)]
+    without_options = question + [(f"Câu hỏi số {i} khác", ("Berlin", "Roma")) for i in range(5)]
+    scores = [
+        _search(app.SearchIndex(_bank(app, items)), app, "paris", scope='question')[1]
+        for items in (with_options, without_options)
+    ]
+    assert len(scores[0]) == 1
+    assert scores[0][0] == scores[1][0]
+
+
+def test_index_is_built_when_a_bank_is_published(app, monkeypatch):
+    import streamlit as st
+
+    registry = app.BankRegistry()
+    built = []
+    monkeypatch.setattr(app, "get_bank_registry", lambda: registry)
+    monkeypatch.setattr(app, "bank_search_index", lambda bank_id, bank: built.append((bank_id, len(bank))))
+    st.session_state.session_uid = "session"
+    st.session_state.bank_id = None
+    st.session_state.search_banks = {}
+
+    app.publish_bank(_bank(app, GEOGRAPHY), "dia_ly.docx")
+    assert built == [(st.session_state.bank_id, len(GEOGRAPHY))]
+    # Đề tạm (VD: kết quả tìm kiếm) không có tên file thì không lập chỉ mục
+    app.publish_bank(_bank(app, GEOGRAPHY[:1]))
+    assert len(built) == 1
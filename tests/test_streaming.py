@@ -0,0 +1,23 @@
+"""Phân tích dạng luồng: menu chỉ mở khi đã có đủ vài câu đầu tiên (hoặc đã phân tích xong)."""
+import streamlit as st
+
+
+def _pending(app, count, jobs):
+    questions = [{"question": f"Câu {i}", "options": ["a", "b"], "correct_answer": "A"} for i in range(count)]
+    st.session_state.bank_id = None
+    st.session_state.pending_bank = app.QuizBank(questions)
+    st.session_state.parse_jobs = jobs
+
+
+def test_menu_waits_for_the_minimum_while_parsing(app):
+    _pending(app, 1, [object()])
+    assert not app.bank_ready_for_menu()
+    _pending(app, app.STREAM_MIN_QUESTIONS, [object()])
+    assert app.bank_ready_for_menu()
+
+
+def test_short_document_opens_the_menu_once_parsed(app):
+    _pending(app, 1, [])
+    assert app.bank_ready_for_menu()
+    _pending(app, 0, [])
+    assert not app.bank_ready_for_menu()